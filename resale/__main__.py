@@ -0,0 +1,24 @@
+# Command line entry points of the package.
+#     python -m resale score listings.csv scores.csv --n-jobs 4
+#     python -m resale serve --model model.txt --port 8000
+#     python -m resale benchmark --suite
+
+# The command modules are only imported when they are run, so that the
+# startup of one command does not pay for the imports of the others.
+
+import importlib
+import sys
+
+# Fixed constants mapping the commands to the modules with their main().
+COMMANDS = {"score": "batch_scoring", "serve": "inference_server", "benchmark": "benchmark"}
+
+def main(argv = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) == 0 or argv[0] not in COMMANDS:
+        print("usage: python -m resale {{{}}} ...".format(",".join(COMMANDS)))
+        return 2
+    module = importlib.import_module("." + COMMANDS[argv[0]], "resale")
+    return module.main(argv[1:])
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -20,7 +20,11 @@ import pandas as pd
 from . import statistics
 from . import h3_statistics
 from . import linear_regression
+from . import load_data
+from . import trend_registry
+from . import profiling
 
+@profiling.profile
 def adjust_resale_price_by_location(df, 
                                     median_prices = None, 
                                     price_column = "resale_price", 
@@ -29,6 +33,9 @@ def adjust_resale_price_by_location(df,
                                     vander_order = 4, # 8?
                                     model = "least_squares", 
                                     which = "town",
+                                    basis = "legendre",
+                                    n_jobs = 1,
+                                    select_order = None,
                                     kwargs = {}):
     """
     Adjust the resale price per town to account for temporal changes.
@@ -43,20 +50,24 @@ def adjust_resale_price_by_location(df,
         vander_order: int (optinal)
         model: string (optional)
         which: string (optional)
+        basis: string (optional)
+        n_jobs: int (optional), the number of processes for the median prices
+                and the L1 norm models
+        select_order: string (optional), "loo" or "gcv" to choose the order of
+                      each location, with vander_order as the highest order
         kwargs: dict (optional)
     Outputs
         new_df: DataFrame
-        temporal_models: dict
+        temporal_models: TrendModelRegistry
     """
-    temporal_models = {}
-    
     # If median_prices is not provided, perform the require computations.
     if median_prices is None and which == "town":
         # Get median prices aggregated by "town".
         median_prices = statistics.get_monthly_median_price(df, 
                                                             "year_month", 
                                                             price_column, 
-                                                            which)
+                                                            which,
+                                                            n_jobs = n_jobs)
     elif median_prices is None and which == "h3":
         # Or get the median prices aggregated by "h3".
         k = kwargs.get("k_ring_distance", 1)
@@ -64,7 +75,12 @@ def adjust_resale_price_by_location(df,
                                                                           "year_month",
                                                                           price_column,
                                                                           k_ring_distance = k,
-                                                                          h3_column_name = which)
+                                                                          h3_column_name = which,
+                                                                          n_jobs = n_jobs)
+    elif median_prices is None and which is None:
+        # Or get median prices without any aggregation.
+        median_prices = statistics.get_monthly_median_price(df, "year_month", price_column,
+                                                            n_jobs = n_jobs)
     
     # Obtain the start year in the DataFrame. This is an int e.g. 2015.
     #start_year = df["year"].min()
@@ -80,40 +96,33 @@ def adjust_resale_price_by_location(df,
         # Current month.
         end_year_month = df["year_month"].max()
     
-    # Build a different linear regression model to update the historical prices 
-    # for each location.
+    # Build the linear regression models updating the historical prices of 
+    # every location in a single batched fit, and keep them in a compact registry.
+    fits = build_price_adjustment_models(median_prices = median_prices, 
+                                         price_column = price_column,
+                                         start_year_month = start_year_month, 
+                                         which = which,
+                                         vander_order = vander_order, 
+                                         model = model,
+                                         basis = basis,
+                                         n_jobs = n_jobs,
+                                         select_order = select_order,
+                                         min_order = kwargs.get("min_order", 
+                                                                linear_regression.MIN_ORDER))
+    temporal_models = trend_registry.TrendModelRegistry.from_fits(fits, which, price_column)
+    temporal_models.attach_data(median_prices)
+    
+    # Every location needs a trend model, else its adjusted prices are undefined.
+    if which is not None:
+        unknown = temporal_models.location_codes(df[which].values) < 0
+        if unknown.any():
+            raise KeyError("No trend models for {} rows with the {}: {}.".format(
+                unknown.sum(), which, sorted(set(df[which].values[unknown]), key = str)))
+    
     # Then for each monthly resale price, calculate the required adjustment factor.
-    new_df = [] # More efficient way to concatenate DataFrames is to use lists.
-    for location in sorted(df[which].unique()):
-        # 1. Build the adjustment models.
-        d, G, m = build_price_adjustment_model(median_prices = median_prices, 
-                                               price_column = price_column,
-                                               location = location, 
-                                               start_year_month = start_year_month, 
-                                               which = which,
-                                               vander_order = vander_order, 
-                                               model = model)
-        
-        temporal_models[location] = {}
-        temporal_models[location]["model"] = m.copy()
-        temporal_models[location]["G"] = G.copy()
-        temporal_models[location]["d"] = d.copy()
-        temporal_models[location]["r2"] = linear_regression.r2(d[price_column].values, G, m)
-        temporal_models[location]["N"] = len(median_prices[median_prices[which] == location]) 
-        
-        # 2. Calculate the adjustments.
-        # TO DO: improve the code here!
-        tmp_df = add_price_adjustment_factor(df = df, 
-                                             temporal_models = temporal_models, 
-                                             location = location,
-                                             start_year_month = start_year_month, 
-                                             end_year_month = end_year_month,
-                                             vander_order = vander_order, 
-                                             which = which)
-        
-        new_df.append(tmp_df)
-    # This is the more efficient method of concatenating DataFrames...    
-    new_df = pd.concat(new_df, ignore_index = True)
+    new_df = add_price_adjustment_factors(df = df, 
+                                          temporal_models = temporal_models,
+                                          end_year_month = end_year_month)
     
     # Use the adjustment factor to calculate the adjusted resale price.
     new_df["{}_adj".format(price_column)] = new_df[price_column] * new_df["adj_factor"]
@@ -121,17 +130,18 @@ def adjust_resale_price_by_location(df,
 
     return new_df, temporal_models
 
+@profiling.profile
 def adjust_resale_price_globally(df, 
                                  median_prices = None, 
                                  price_column = "resale_price", 
                                  start_year_month = None,
                                  next_month = False,
                                  vander_order = 4,
-                                 model = "least_squares"):
+                                 model = "least_squares",
+                                 basis = "legendre"):
     """
-    Adjust the resale price per town to account for temporal changes.
-    This is to ensure that all historical data are "updated" to the 
-    latest prices.
+    Adjust the resale price of all data together to account for temporal changes.
+    This is adjust_resale_price_by_location() with a single global location.
     Inputs
         df: DataFrame
         median_prices: DataFrame
@@ -140,52 +150,243 @@ def adjust_resale_price_globally(df,
         next_month: bool (optional)
         vander_order: int (optinal)
         model: string (optional)
+        basis: string (optional)
     Outputs
         new_df: DataFrame
-        temporal_models: dict
-    TODO: merge this function with the function above! There should not be two functions!
+        temporal_models: dict, with the "model" coefficients of the basis "G",
+                         the median prices "d", and the TrendModelRegistry
+                         "registry" of the single global model
+    """
+    new_df, registry = adjust_resale_price_by_location(df, 
+                                                       median_prices = median_prices, 
+                                                       price_column = price_column, 
+                                                       start_year_month = start_year_month,
+                                                       next_month = next_month,
+                                                       vander_order = vander_order,
+                                                       model = model,
+                                                       which = None,
+                                                       basis = basis)
+    temporal_models = registry[None]
+    temporal_models["registry"] = registry
+    return new_df, temporal_models
+
+@profiling.profile
+def adjust_resale_price_multilevel(df, 
+                                   levels = ["global", "town", "h3"],
+                                   price_column = "resale_price", 
+                                   start_year_month = None,
+                                   next_month = False,
+                                   vander_order = 4,
+                                   model = "least_squares", 
+                                   basis = "legendre",
+                                   shrinkage = 0,
+                                   n_jobs = 1,
+                                   select_order = None,
+                                   kwargs = {}):
+    """
+    Adjust the resale price at several levels of location in one pass, for
+    example globally, per town and per H3 cell. All levels share the month
+    index of the rows, the kernel G and the target month, and each level adds
+    its own "adj_factor_<level>" column.
+    With shrinkage > 0, the factors of locations with few months of data are
+    shrunk toward the factors of their parent level (the previous level in
+    levels), using the weight N / (N + shrinkage) on the log factors, where
+    N is the number of months with data of the location.
+    Inputs
+        df: DataFrame
+        levels: list (optional), "global" or column names, from coarse to fine
+        price_column: string (optional)
+        start_year_month: datetime (optional)
+        next_month: bool (optional)
+        vander_order: int (optinal)
+        model: string (optional)
+        basis: string (optional)
+        shrinkage: float (optional)
+        n_jobs: int (optional)
+        select_order: string (optional)
+        kwargs: dict (optional)
+    Outputs
+        new_df: DataFrame
+        temporal_models: dict of TrendModelRegistry, keyed by level
     """
-    
-    # If median_prices is not provided, perform the require computations.
-    if median_prices is None:
-        # Get median prices without any aggregation.
-        median_prices = statistics.get_monthly_median_price(df, "year_month", price_column)
-    
-    # Obtain the start year in the DataFrame. This is an int e.g. 2015.
-    #start_year = df["year"].min()
-    
-    # This on the other hand is a datetime object.
     if start_year_month is None:
         start_year_month = df["year_month"].min()
-        
     if next_month == True:
-        # Next month.
         end_year_month = df["year_month"].max() + pd.DateOffset(months = 1)
     else:
-        # Current month.
         end_year_month = df["year_month"].max()
     
-    d, G, m = build_price_adjustment_model(median_prices, price_column, location = None, 
-                                           start_year_month = start_year_month,
-                                           which = None, vander_order = vander_order, 
-                                           model = model)
+    # 1. Shared by all levels: the month index, the kernel and the target month.
+    months = linear_regression.months_to_G(df["year_month"], start_year_month)
+    domain = (months.min(), months.max())
+    month_index = months - domain[0]
+    n_months = domain[1] - domain[0] + 1
+    G = linear_regression.make_basis(np.arange(domain[0], domain[1] + 1), 
+                                     vander_order, basis, domain)
+    target_month = linear_regression.month_to_G(end_year_month, start_year_month)
+    g_start = G[month_index]
+    g_end = linear_regression.make_basis([target_month], vander_order, basis, domain)[0]
+    prices = df[price_column].values
     
+    new_df = df.assign(adj_months = months, target_month = target_month)
     temporal_models = {}
-    temporal_models["d"] = d.copy()
-    temporal_models["G"] = G.copy()
-    temporal_models["model"] = m.copy()
+    parent_log_factor = None
     
-    tmp_df = add_price_adjustment_factor(df, temporal_models = temporal_models, location = None, 
-                                         start_year_month = start_year_month, 
-                                         end_year_month = end_year_month, 
-                                         vander_order = vander_order, which = None)
+    for level in levels:
+        which = None if level == "global" else level
+        
+        # 2. The dense (location x month) median prices of the level.
+        if which is None:
+            codes = np.zeros(len(df), dtype = int)
+            locations = np.array([None])
+        else:
+            codes, locations = pd.factorize(df[which], sort = True)
+            locations = np.asarray(locations)
+        # Rows with a missing location, with the code -1, get no factor of their own.
+        valid = codes >= 0
+            
+        if which == "h3" and kwargs.get("k_ring_distance", 1) > 0:
+            median_prices = h3_statistics.get_all_k_ring_monthly_median_price(
+                df, "year_month", price_column, 
+                k_ring_distance = kwargs.get("k_ring_distance", 1), h3_column_name = which,
+                n_jobs = n_jobs)
+            _, D, mask, _ = pivot_median_prices(median_prices, price_column, start_year_month, 
+                                                which, domain)
+        else:
+            # A single groupby over integer keys of the location and month.
+            keys = codes[valid] * n_months + month_index[valid]
+            medians = pd.Series(prices[valid]).groupby(keys).median()
+            D = np.full([len(locations), n_months], np.nan)
+            np.put(D, medians.index.values, medians.values)
+            mask = np.isfinite(D)
+        
+        # 3. Fit all locations of the level together.
+        min_order = kwargs.get("min_order", linear_regression.MIN_ORDER)
+        M, info = fit_price_adjustment_models(G, D, mask, model, n_jobs, select_order,
+                                              min_order, basis)
+        fits = {"locations": locations,
+                "model": M,
+                "r2": linear_regression.batch_r2(G, D, M, mask),
+                "N": mask.sum(axis = 1),
+                "basis": basis,
+                "domain": domain,
+                "vander_order": vander_order,
+                "model_name": model,
+                "start_year_month": start_year_month}
+        fits.update(info)
+        if model == "least_squares" and select_order is None:
+            fits["statistics"] = linear_regression.batch_normal_equations(G, D, mask)
+        temporal_models[level] = trend_registry.TrendModelRegistry.from_fits(fits, which, 
+                                                                             price_column)
+        
+        # 4. The adjustment factors of every row, shrunk toward the parent level.
+        # Rows without a location take the factor of the parent level if
+        # shrinking, as if their location had no data, and else NaN.
+        log_factor = np.full(len(df), np.nan)
+        start_index = np.einsum("np,np->n", g_start[valid], M[codes[valid]])
+        end_index = np.dot(M, g_end)[codes[valid]]
+        log_factor[valid] = np.log(end_index / start_index)
+        if parent_log_factor is not None and shrinkage > 0:
+            N = np.where(valid, fits["N"][codes], 0)
+            w = N / (N + shrinkage)
+            log_factor = np.where(valid, w * log_factor + (1 - w) * parent_log_factor,
+                                  parent_log_factor)
+        new_df["adj_factor_{}".format(level)] = np.exp(log_factor)
+        parent_log_factor = log_factor
     
-    # Use the adjustment factor to calculate the adjusted resale price.
-    tmp_df["{}_adj".format(price_column)] = tmp_df[price_column] * tmp_df["adj_factor"]
-    tmp_df["{}_adj".format(price_column)] = tmp_df["{}_adj".format(price_column)].astype(int)
-    return tmp_df, temporal_models
+    return new_df, temporal_models
+
+@profiling.profile
+def adjust_resale_price_by_rpi(df, 
+                               rpi = None,
+                               price_column = "resale_price", 
+                               target_year_month = None,
+                               next_month = False,
+                               town_residuals = False,
+                               vander_order = 4,
+                               model = "least_squares",
+                               basis = "legendre",
+                               online = True):
+    """
+    Adjust the resale price with the HDB resale price index (RPI) instead of
+    fitted trends, using the ratio of the RPI of the targeted month to that of
+    the sale month. No medians or regressions are needed, which makes this a
+    quick national adjustment and a baseline for the trend models.
+    Each month takes the latest RPI at or before it (an as-of join on the 
+    integer month), so months after the last RPI use the last RPI. 
+    Optionally, per-town trends are fitted to the RPI adjusted prices, to 
+    capture the residual changes of each town relative to the nation.
+    Inputs
+        df: DataFrame
+        rpi: DataFrame (optional), from load_data.load_resale_price_index()
+        price_column: string (optional)
+        target_year_month: datetime (optional), defaults to the latest month
+        next_month: bool (optional)
+        town_residuals: bool (optional)
+        vander_order: int (optional)
+        model, basis: string (optional)
+        online: bool (optional)
+    Outputs
+        new_df: DataFrame
+        temporal_models: TrendModelRegistry or None
+    """
+    if rpi is None:
+        rpi = load_data.load_resale_price_index(online = online)
+    
+    if target_year_month is None:
+        target_year_month = df["year_month"].max()
+        if next_month == True:
+            target_year_month = target_year_month + pd.DateOffset(months = 1)
+    target_year_month = pd.Timestamp(target_year_month)
+    
+    # As-of join of the RPI on integer months counted from a common start.
+    start_year_month = min(df["year_month"].min(), rpi["year_month"].min())
+    rpi = rpi.sort_values("year_month")
+    rpi_months = linear_regression.months_to_G(rpi["year_month"], start_year_month)
+    rpi_values = np.append(np.nan, rpi["index"].values)
+    
+    months = linear_regression.months_to_G(df["year_month"], start_year_month)
+    target_month = linear_regression.month_to_G(target_year_month, start_year_month)
+    # Index 0 of rpi_values is NaN for months before the first RPI.
+    start_index = rpi_values[np.searchsorted(rpi_months, months, side = "right")]
+    end_index = rpi_values[np.searchsorted(rpi_months, target_month, side = "right")]
+    
+    new_df = df.assign(adj_factor_rpi = end_index / start_index)
+    new_df["adj_factor"] = new_df["adj_factor_rpi"]
+    temporal_models = None
     
+    if town_residuals == True:
+        # Fit the town trends of the RPI adjusted prices. Months before the 
+        # first RPI have no adjusted prices, so the trends are only fitted and
+        # evaluated from the first month covered, rather than extrapolated.
+        rpi_column = "{}_rpi".format(price_column)
+        new_df[rpi_column] = new_df[price_column] * new_df["adj_factor_rpi"]
+        covered = np.isfinite(new_df["adj_factor_rpi"].values)
+        median_prices = statistics.get_monthly_median_price(new_df[covered], "year_month", 
+                                                            rpi_column, "town")
+        fits = build_price_adjustment_models(median_prices, rpi_column, 
+                                             new_df.loc[covered, "year_month"].min(),
+                                             "town", vander_order, model, basis)
+        temporal_models = trend_registry.TrendModelRegistry.from_fits(fits, "town", rpi_column)
+        residuals = add_price_adjustment_factors(new_df[covered], temporal_models, 
+                                                 target_year_month)
+        new_df["adj_factor_town"] = np.nan
+        new_df.loc[covered, "adj_factor_town"] = residuals["adj_factor"].values
+        new_df["adj_factor"] = new_df["adj_factor_rpi"] * new_df["adj_factor_town"]
+    
+    # Left as float, as months before the first RPI have NaN factors.
+    new_df["{}_adj".format(price_column)] = new_df[price_column] * new_df["adj_factor"]
+    return new_df, temporal_models
+
 # Price adjustment based on the median resale price.
+ADJUSTMENT_MODELS = {"least_squares": linear_regression.least_squares,
+                     "l1_norm_inversion": linear_regression.l1_norm_inversion,
+                     "huber": linear_regression.huber_regression,
+                     "l1_irls": linear_regression.l1_irls}
+
+# Robust models fitted with the batched iteratively reweighted least squares.
+IRLS_MODELS = {"huber": "huber", "l1_irls": "l1"}
+
 def build_price_adjustment_model(median_prices, price_column, location, start_year_month, 
                                   which = "town", vander_order = 4, model = "least_squares"):
     """
@@ -202,9 +403,6 @@ def build_price_adjustment_model(median_prices, price_column, location, start_ye
         G: array
         m: array
     """
-    ADJUSTMENT_MODELS = {"least_squares": linear_regression.least_squares,
-                         "l1_norm_inversion": linear_regression.l1_norm_inversion}
-                         
     adjustment_model = ADJUSTMENT_MODELS.get(model, linear_regression.least_squares)
     
     if which is None:
@@ -234,6 +432,140 @@ def build_price_adjustment_model(median_prices, price_column, location, start_ye
     m = adjustment_model(G, d[price_column].values)
     return d, G, m
    
+@profiling.profile
+def build_price_adjustment_models(median_prices, 
+                                  price_column, 
+                                  start_year_month, 
+                                  which = "town", 
+                                  vander_order = 4, 
+                                  model = "least_squares",
+                                  basis = "legendre",
+                                  n_jobs = 1,
+                                  select_order = None,
+                                  min_order = linear_regression.MIN_ORDER):
+    """
+    Batched version of build_price_adjustment_model(), which fits the trend 
+    models of every location in a single call. The monthly median prices are
+    pivoted into a dense (location x month) array with a mask for the missing 
+    months, and all locations share one kernel G over the full month range.
+    The default "legendre" basis keeps vander_order = 8 well conditioned.
+    Inputs
+        median_prices: DataFrame
+        price_column: string
+        start_year_month: datetime
+        which: string (optional)
+        vander_order: int (optional)
+        model: string (optional)
+        basis: string (optional)
+        n_jobs: int (optional), the number of processes for the L1 norm models
+        select_order: string (optional), "loo" or "gcv" to choose the order of
+                      each location, with vander_order as the highest order
+        min_order: int (optional)
+    Outputs
+        fits: dict
+    """
+    locations, D, mask, domain = pivot_median_prices(median_prices, price_column, 
+                                                     start_year_month, which)
+    G = linear_regression.make_basis(np.arange(domain[0], domain[1] + 1), 
+                                     vander_order, basis, domain)
+    M, info = fit_price_adjustment_models(G, D, mask, model, n_jobs, select_order, 
+                                          min_order, basis)
+    
+    fits = {"locations": locations,
+            "model": M,
+            "r2": linear_regression.batch_r2(G, D, M, mask),
+            "N": mask.sum(axis = 1),
+            "basis": basis,
+            "domain": domain,
+            "vander_order": vander_order,
+            "model_name": model,
+            "start_year_month": start_year_month}
+    fits.update(info)
+    
+    if model == "least_squares" and select_order is None:
+        # Keep the normal equations so that the models can be updated incrementally.
+        fits["statistics"] = linear_regression.batch_normal_equations(G, D, mask)
+    return fits
+
+def pivot_median_prices(median_prices, price_column, start_year_month, which = "town",
+                        domain = None):
+    """
+    Pivot the monthly median prices into a dense (location x month) array, 
+    with a mask for the missing months.
+    Inputs
+        median_prices: DataFrame
+        price_column: string
+        start_year_month: datetime
+        which: string (optional)
+        domain: tuple (optional), the first and last month of the array
+    Outputs
+        locations: array, sorted
+        D: array (n_locations, n_months)
+        mask: array of bool (n_locations, n_months)
+        domain: tuple
+    """
+    months = linear_regression.months_to_G(median_prices["year_month"], start_year_month)
+    if domain is None:
+        domain = (months.min(), months.max())
+    
+    if which is None:
+        locations = np.array([None])
+        codes = np.zeros(len(median_prices), dtype = int)
+    else:
+        codes, locations = pd.factorize(median_prices[which], sort = True)
+        locations = np.asarray(locations)
+    
+    # Missing months are left as NaN.
+    D = np.full([len(locations), domain[1] - domain[0] + 1], np.nan)
+    D[codes, months - domain[0]] = median_prices[price_column].values
+    mask = np.isfinite(D)
+    return locations, D, mask, domain
+
+def fit_price_adjustment_models(G, D, mask, model = "least_squares", n_jobs = 1,
+                                select_order = None, 
+                                min_order = linear_regression.MIN_ORDER, basis = "legendre"):
+    """
+    Fit the trend models of every row of D with the kernel G.
+    With select_order = "loo" or "gcv", the order of each least squares model 
+    is chosen among min_order to vander_order by closed form cross validation.
+    Inputs
+        G: array (n_months, n_params)
+        D: array (n_locations, n_months)
+        mask: array of bool (n_locations, n_months)
+        model: string (optional)
+        n_jobs: int (optional), the number of processes for the L1 norm models
+        select_order: string (optional)
+        min_order: int (optional)
+        basis: string (optional), the basis of G
+    Outputs
+        M: array (n_locations, n_params)
+        info: dict, the convergence report of the IRLS models, or the chosen 
+              order and its score
+    """
+    info = {}
+    if select_order is not None:
+        if model != "least_squares":
+            raise ValueError("Order selection is only available for least squares models.")
+        M, order, scores = linear_regression.batch_order_selection(G, D, mask, min_order, 
+                                                                   select_order, 
+                                                                   basis == "legendre")
+        info["order"] = order
+        info["cv_score"] = scores[np.arange(len(order)), order - 1]
+    elif model == "least_squares" or model not in ADJUSTMENT_MODELS:
+        M = linear_regression.batch_least_squares(G, D, mask)
+    elif model == "l1_norm_inversion":
+        M = linear_regression.batch_l1_norm_inversion(G, D, mask, n_jobs = n_jobs)
+    elif model in IRLS_MODELS:
+        M, info = linear_regression.batch_irls(G, D, mask, loss = IRLS_MODELS[model])
+        if not info["converged"].all():
+            print("IRLS did not converge for {} locations.".format((~info["converged"]).sum()))
+    else:
+        # Models without a batched implementation are fitted one location at a time.
+        adjustment_model = ADJUSTMENT_MODELS[model]
+        M = np.vstack([adjustment_model(G[mask[i]], D[i, mask[i]]) 
+                       for i in range(len(D))])
+    return M, info
+
 def add_price_adjustment_factor(df, 
                                 temporal_models, 
                                 location, 
@@ -242,51 +574,93 @@ def add_price_adjustment_factor(df,
                                 vander_order = 4, 
                                 which = "town"):
     """
-    Adds a price adjustment factor column to df. The adjust resale price will 
-    be the product between the original resale price and this factor.
+    Adds a price adjustment factor column to the rows of df of one location. 
+    The adjust resale price will be the product between the original resale 
+    price and this factor.
     Inputs
         df: DataFrame
-        temporal_models: dict
+        temporal_models: TrendModelRegistry
         location: string
-        start_year_month: datetime
+        start_year_month: datetime, unused, the registry keeps its own
         end_year_month: datetime 
-        vander_order: int (optional)
+        vander_order: int (optional), unused, the registry keeps its own
         which: string (optional)
     Outputs
         tmp_df: DataFrame
     """
     # Use all rows of data without caring about location.
     if which is None:
-        tmp_df = df.copy()
-        model = temporal_models["model"]
+        tmp_df = df
     # Or extract for a particular location.
     else:
         tmp_df = df[df[which] == location]
-        model = temporal_models[location]["model"]
-    
-    # Calculate the number of months from the start date to the sales date.
-    months_from_start = tmp_df["year_month"].apply(linear_regression.month_to_G, 
-                                                   args = (start_year_month,))
     
-    # Less buggy way of adding a column of values to a DataFrame:
-    tmp_df = tmp_df.assign(adj_months = months_from_start)
-    
-    # start_index is the predictions for the original resale price. This is 
-    # an array of time series values.
-    start_index = np.dot(np.vander(tmp_df["adj_months"].values, vander_order), model)
+    # The trend models are evaluated in the basis of the registry.
+    return add_price_adjustment_factors(tmp_df, temporal_models, end_year_month)
+
+@profiling.profile
+def add_price_adjustment_factors(df, temporal_models, end_year_month):
+    """
+    Vectorized version of add_price_adjustment_factor() for all locations at
+    once, using the trend models in a TrendModelRegistry.
+    Inputs
+        df: DataFrame
+        temporal_models: TrendModelRegistry
+        end_year_month: datetime
+    Outputs
+        tmp_df: DataFrame
+    """
+    start_year_month = temporal_models.start_year_month
+    if temporal_models.which is None:
+        codes = np.zeros(len(df), dtype = int)
+    else:
+        codes = temporal_models.location_codes(df[temporal_models.which].values)
     
+    months_from_start = linear_regression.months_to_G(df["year_month"], start_year_month)
     target_month = linear_regression.month_to_G(end_year_month, start_year_month)
+    tmp_df = df.assign(adj_months = months_from_start, target_month = target_month)
     
-    #tmp_df["target_month"] = end_year_month
-    tmp_df["target_month"] = target_month
-    
-    # end_index is the predictions of the resale price for the targeted month.
-    # This targeted month is either the current month or the next month.
-    end_index = np.dot(np.vander([target_month], vander_order), model)
-    
-    # By taking the ratio between the end_index and the start_index, we can
-    # get an adjustment factor to be multiplied to the individual resale prices
-    # to correct for the changes in time.
+    # start_index are the trend values at the sale months, and end_index the
+    # trend values at the targeted month (either the current or next month).
+    start_index = temporal_models.predict(codes, months_from_start)
+    end_index = temporal_models.predict(codes, target_month)
     tmp_df["adj_factor"] = end_index / start_index
-    
     return tmp_df
+
+@profiling.profile
+def update_price_adjustment_models(temporal_models, 
+                                   df = None,
+                                   median_prices = None, 
+                                   forgetting = 1.0,
+                                   kwargs = {}):
+    """
+    Incrementally update the least squares trend models with new months of 
+    data, without refitting on the full history. Only the median prices of
+    the new rows are computed.
+    Inputs
+        temporal_models: TrendModelRegistry
+        df: DataFrame (optional), the new rows only
+        median_prices: DataFrame (optional), the medians of the new months
+        forgetting: float (optional)
+        kwargs: dict (optional)
+    Outputs
+        temporal_models: TrendModelRegistry
+    """
+    which = temporal_models.which
+    price_column = temporal_models.price_column
+    
+    if median_prices is None and which == "h3":
+        k = kwargs.get("k_ring_distance", 1)
+        median_prices = h3_statistics.get_all_k_ring_monthly_median_price(df, 
+                                                                          "year_month",
+                                                                          price_column,
+                                                                          k_ring_distance = k,
+                                                                          h3_column_name = which)
+    elif median_prices is None:
+        median_prices = statistics.get_monthly_median_price(df, 
+                                                            "year_month", 
+                                                            price_column, 
+                                                            which)
+    
+    temporal_models.update(median_prices, forgetting = forgetting)
+    return temporal_models
@@ -0,0 +1,214 @@
+# Rolling-origin backtesting of the adjust + train + predict chain.
+
+# A random train_test_split() leaks future months into the training data, so
+# the test errors of model.evaluate_model() are optimistic. Instead, each fold
+# of a backtest has an origin month: the temporal trends are fitted and the
+# model is trained only on the months before the origin, with the prices
+# adjusted to the origin month, and the model then predicts the sales of the
+# months from the origin onwards. The origins walk forward month by month.
+
+# The (configuration, fold) pairs are independent, and run in a process pool.
+# The predictions of every fold are collected in one DataFrame, from which the
+# metrics are computed with vectorized group bys, sliced by any columns such as
+# town, flat_type or month.
+
+# The binned datasets of the folds are never reused by later runs, so they are
+# cached in a temporary directory of the run, which is deleted at the end.
+
+from concurrent.futures import ProcessPoolExecutor
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# Relative imports.
+from . import adjust_price
+from . import model
+from . import profiling
+
+# Fixed constants for the default configuration of the chain.
+CONFIG = {"name": "default",
+          "features": model.FEATURES,
+          "price_column": "price_per_sqm",
+          "adjust_params": {"which": "town", "vander_order": 4, "model": "least_squares",
+                            "basis": "legendre"},
+          "model_params": model.MODEL_PARAMS,
+          "early_stopping_rounds": 50,
+          "base": 10}
+# Columns kept for each prediction, used to slice the metrics.
+SLICE_COLUMNS = ["town", "flat_type", "year_month"]
+
+# Folds.
+def make_folds(year_month, n_folds = 12, horizon = 1, step = 1, train_months = None):
+    """
+    Make rolling-origin folds ending at the last month of the data.
+    Inputs
+        year_month: array of datetime, the months of the sales
+        n_folds: int (optional)
+        horizon: int (optional), the number of months tested in each fold
+        step: int (optional), the number of months between the origins
+        train_months: int (optional), the length of a sliding training window,
+                      or None to train on every month before the origin
+    Outputs
+        folds: list of dict, with the "fold" number, and the "train_start",
+               "origin" and "test_end" months, with the test months in
+               [origin, test_end)
+    """
+    months = pd.DatetimeIndex(pd.unique(pd.to_datetime(year_month))).sort_values()
+    first, last = months[0], months[-1]
+    folds = []
+    for i in range(n_folds):
+        origin = last - pd.DateOffset(months = horizon - 1 + (n_folds - 1 - i) * step)
+        if train_months is None:
+            train_start = first
+        else:
+            train_start = max(first, origin - pd.DateOffset(months = train_months))
+        if origin <= train_start:
+            continue
+        folds.append({"fold": i, "train_start": train_start, "origin": origin,
+                      "test_end": origin + pd.DateOffset(months = horizon)})
+    return folds
+
+# Folds, which run in the worker processes.
+_DF = None # The data of each worker process, sent once by the initializer.
+
+def _init_worker(df):
+    global _DF
+    _DF = df
+
+def _run_fold(args):
+    # Must be at the module level to be pickled.
+    config, fold, threads, cache_dir = args
+    return run_fold(_DF, config, fold, threads, cache_dir)
+
+@profiling.profile
+def run_fold(df, config, fold, n_jobs = 1, cache_dir = None):
+    """
+    Run the adjust + train + predict chain of one configuration on one fold.
+    Inputs
+        df: DataFrame, cleaned with clean_data.clean_data()
+        config: dict, see CONFIG
+        fold: dict, from make_folds()
+        n_jobs: int (optional), the number of LightGBM threads
+        cache_dir: string (optional), for the binned datasets, defaults to a
+                   temporary directory deleted after training
+    Outputs
+        predictions: DataFrame, with the SLICE_COLUMNS of the test sales, the
+                     true and predicted resale prices, and the fold
+    """
+    config = dict(CONFIG, **config)
+    price_column = config["price_column"]
+    train = df[(df["year_month"] >= fold["train_start"]) & (df["year_month"] < fold["origin"])]
+    test = df[(df["year_month"] >= fold["origin"]) & (df["year_month"] < fold["test_end"])]
+
+    # 1. Adjust the training prices to the origin month, the month after the
+    # last training month, with trends fitted only on the training months.
+    train, _ = adjust_price.adjust_resale_price_by_location(train, price_column = price_column,
+                                                            next_month = True,
+                                                            **config["adjust_params"])
+
+    # 2. Train the model on the adjusted prices.
+    X = train[config["features"]].values
+    y = model.y_scaler(train["{}_adj".format(price_column)].values.astype(float), config["base"])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result = model.train_model(X, y, model_params = config["model_params"],
+                                   random_state = fold["fold"],
+                                   early_stopping_rounds = config["early_stopping_rounds"],
+                                   n_jobs = n_jobs, base = config["base"],
+                                   cache_dir = tmp_dir if cache_dir is None else cache_dir,
+                                   verbose = False)
+
+    # 3. Predict the test months.
+    y_pred = model.y_descaler(result["model"].predict(test[config["features"]].values),
+                              config["base"])
+    if price_column == "price_per_sqm":
+        y_pred = y_pred * test["floor_area_sqm"].values
+
+    predictions = test[SLICE_COLUMNS].copy()
+    predictions["config"] = config["name"]
+    predictions["fold"] = fold["fold"]
+    predictions["origin"] = fold["origin"]
+    predictions["horizon"] = ((test["year_month"].dt.year - fold["origin"].year) * 12 +
+                              test["year_month"].dt.month - fold["origin"].month + 1)
+    predictions["y_true"] = test["resale_price"].values.astype(float)
+    predictions["y_pred"] = y_pred
+    return predictions
+
+@profiling.profile
+def backtest(df, configs = [CONFIG], folds = None, n_jobs = 1, threads_per_fold = 1,
+             cache_dir = None, verbose = True):
+    """
+    Backtest configurations of the adjust + train + predict chain with
+    rolling-origin folds, running the (configuration, fold) pairs in a
+    process pool.
+    Inputs
+        df: DataFrame, cleaned with clean_data.clean_data()
+        configs: list of dict (optional), each overriding some of CONFIG,
+                 with distinct names
+        folds: list of dict (optional), from make_folds(), defaults to 12
+               monthly folds
+        n_jobs: int (optional), the number of processes
+        threads_per_fold: int (optional)
+        cache_dir: string (optional), for the binned datasets, defaults to a
+                   temporary directory deleted at the end
+        verbose: bool (optional)
+    Outputs
+        predictions: DataFrame, see run_fold()
+    """
+    if folds is None:
+        folds = make_folds(df["year_month"])
+    # Only send the columns used by the configurations to the workers.
+    columns = set(SLICE_COLUMNS + ["resale_price", "floor_area_sqm"])
+    for config in configs:
+        config = dict(CONFIG, **config)
+        columns.update(config["features"] + [config["price_column"]])
+        columns.add(config["adjust_params"].get("which", "town") or "town")
+    df = df[[c for c in df.columns if c in columns]]
+
+    run_dir = tempfile.mkdtemp(prefix = "backtest-") if cache_dir is None else cache_dir
+    tasks = [(config, fold, threads_per_fold, run_dir) for config in configs for fold in folds]
+    try:
+        if n_jobs is None or n_jobs <= 1:
+            _init_worker(df)
+            predictions = [_run_fold(task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers = n_jobs, initializer = _init_worker,
+                                     initargs = (df,)) as executor:
+                predictions = list(executor.map(_run_fold, tasks))
+    finally:
+        if cache_dir is None:
+            shutil.rmtree(run_dir, ignore_errors = True)
+    predictions = pd.concat(predictions, ignore_index = True)
+
+    if verbose == True:
+        print(backtest_metrics(predictions, ["config"]).to_string())
+    return predictions
+
+# Metrics.
+def backtest_metrics(predictions, by = ["config"]):
+    """
+    Compute the error metrics of backtest predictions for every group, from
+    sums over the groups instead of a function call per group.
+    Inputs
+        predictions: DataFrame, from backtest()
+        by: list of string (optional), e.g. ["config", "town"] or
+            ["config", "flat_type", "year_month"]
+    Outputs
+        metrics: DataFrame, with n, mae, rmse, mape, bias and r2 per group
+    """
+    y, y_pred = predictions["y_true"].values, predictions["y_pred"].values
+    error = y_pred - y
+    sums = pd.DataFrame({"n": 1, "abs_error": np.abs(error), "sq_error": error ** 2,
+                         "ape": np.abs(error) / y, "error": error, "y": y, "y2": y ** 2})
+    sums = sums.groupby([predictions[c] for c in by]).sum()
+
+    n = sums["n"]
+    metrics = pd.DataFrame({"n": n,
+                            "mae": sums["abs_error"] / n,
+                            "rmse": np.sqrt(sums["sq_error"] / n),
+                            "mape": sums["ape"] / n,
+                            "bias": sums["error"] / n}, index = sums.index)
+    ss_tot = sums["y2"] - sums["y"] ** 2 / n
+    metrics["r2"] = 1 - sums["sq_error"] / ss_tot.where(ss_tot > 0)
+    return metrics.reset_index()
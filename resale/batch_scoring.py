@@ -0,0 +1,368 @@
+# Score large files of candidate listings in batches.
+
+# Pricing a nightly export of listings row by row with
+# inference_data.make_inference_data() and predict() is slow. Instead, the
+# input CSV or Parquet file is streamed in chunks, and the features of each
+# chunk are built with vectorized joins: the geocoded addresses are looked up
+# with one pandas Index.get_indexer() call, and the string formatters of
+# clean_data run once per distinct value instead of once per row. The chunks
+# are scored in a process pool whose workers load the model and the geocoded
+# addresses once, and the results are written as they arrive, in input order.
+
+# From the command line:
+#     python -m resale score listings.csv scores.csv --model model.txt --n-jobs 4
+
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+# Relative imports.
+from . import clean_data
+from . import geocode
+from . import model
+from . import model_registry
+from . import profiling
+from . import tree_predictor
+
+# Fixed constants.
+CHUNK_SIZE = 50000
+# The columns of the listings used to build the features. Only these are sent
+# to the workers. The location is taken from latitude and longitude, else from
+# address, else from block and street_name, and the age from age, else from
+# lease_commence_date.
+INPUT_COLUMNS = ["latitude", "longitude", "address", "block", "street_name", "flat_type",
+                 "storey_range", "age", "lease_commence_date", "floor_area_sqm"]
+PARQUET_SUFFIXES = [".parquet", ".pq"]
+
+def load_model(path = None):
+    """
+    Load a model for scoring.
+    Inputs
+        path: string (optional), a LightGBM model file, a TreePredictor .npz
+              file or a model registry directory, defaults to the current
+              version of the default model registry
+    Outputs
+        m: lgb.Booster or tree_predictor.TreePredictor
+    """
+    if path is None:
+        return model_registry.ModelRegistry().load()
+    if os.path.isdir(path):
+        return model_registry.ModelRegistry(path).load()
+    if path.endswith(".npz"):
+        return tree_predictor.TreePredictor.load(path)
+    import lightgbm as lgb
+    return lgb.Booster(model_file = path)
+
+class AddressIndex:
+    """
+    The geocoded addresses as a pandas Index and coordinate arrays, to look
+    up the coordinates of many addresses at once.
+    """
+    def __init__(self, address_dict):
+        """
+        Inputs
+            address_dict: dict, from geocode.load_geocoded_addresses_json()
+        """
+        self.index = pd.Index(list(address_dict.keys()))
+        # The extra NaN at the end is picked by the -1 of unknown addresses.
+        self.latitude = np.array([float(v["latitude"]) for v in address_dict.values()] + [np.nan])
+        self.longitude = np.array([float(v["longitude"]) for v in address_dict.values()] + [np.nan])
+
+    def lookup(self, address):
+        """
+        Inputs
+            address: array of string
+        Outputs
+            latitude, longitude: array, NaN for unknown addresses
+        """
+        i = self.index.get_indexer(address)
+        return self.latitude[i], self.longitude[i]
+
+def map_unique(values, func):
+    """
+    Apply a formatter to each distinct value instead of to each row.
+    Inputs
+        values: Series
+        func: function, e.g. clean_data.flat_type_formatter
+    Outputs
+        mapped: array of float, NaN for missing values or values func rejects
+    """
+    codes, uniques = pd.factorize(values)
+    # The extra NaN at the end is picked by the -1 code of missing values.
+    mapped = np.full(len(uniques) + 1, np.nan)
+    for i, x in enumerate(uniques):
+        try:
+            mapped[i] = func(x)
+        except (ValueError, TypeError, IndexError):
+            pass
+    return mapped[codes]
+
+def make_features(df, address_index, current_year = clean_data.CURRENT_YEAR):
+    """
+    Build the model.FEATURES of a chunk of listings, the vectorized
+    equivalent of inference_data.make_inference_data() on every row.
+    Inputs
+        df: DataFrame, with some of the INPUT_COLUMNS
+        address_index: AddressIndex
+        current_year: int (optional)
+    Outputs
+        X: array (n_samples, n_features)
+        valid: array of bool, the rows with all the features
+    """
+    if "latitude" in df and "longitude" in df:
+        latitude = df["latitude"].values.astype(float)
+        longitude = df["longitude"].values.astype(float)
+    else:
+        if "address" in df:
+            address = df["address"].values
+        else:
+            codes, uniques = pd.factorize(df["street_name"].fillna("").astype(str))
+            streets = np.array([clean_data.street_name_cleaner(x) for x in uniques] + [""],
+                               dtype = object)
+            address = df["block"].astype(str).values + " " + streets[codes]
+        latitude, longitude = address_index.lookup(address)
+
+    flat_type = map_unique(df["flat_type"], clean_data.flat_type_formatter)
+    flat_type[flat_type < 0] = np.nan # The error value of unknown flat types.
+    storey_range = map_unique(df["storey_range"], clean_data.storey_range_formatter)
+    if "age" in df:
+        age = df["age"].values.astype(float)
+    else:
+        age = current_year - df["lease_commence_date"].values.astype(float)
+
+    features = {"latitude": latitude, "longitude": longitude, "flat_type_num": flat_type,
+                "storey_range_num": storey_range, "age": age}
+    X = np.column_stack([features[feature] for feature in model.FEATURES])
+    return X, np.isfinite(X).all(axis = 1)
+
+@profiling.profile
+def score_chunk(df, m, address_index, base = 10, n_threads = None):
+    """
+    Predict the prices of a chunk of listings.
+    Inputs
+        df: DataFrame
+        m: lgb.Booster or tree_predictor.TreePredictor
+        address_index: AddressIndex
+        base: int (optional), the base of model.y_scaler() used for the target
+        n_threads: int (optional), the number of LightGBM threads
+    Outputs
+        predictions: DataFrame, with the predicted price_per_sqm_pred, and
+                     resale_price_pred if floor_area_sqm is given, NaN for
+                     the rows missing features
+    """
+    X, valid = make_features(df, address_index)
+    price_per_sqm = np.full(len(df), np.nan)
+    if valid.any():
+        if n_threads is not None and hasattr(m, "model_to_string"):
+            y = m.predict(X[valid], num_threads = n_threads)
+        else:
+            y = m.predict(X[valid])
+        price_per_sqm[valid] = model.y_descaler(y, base)
+
+    predictions = pd.DataFrame({"price_per_sqm_pred": price_per_sqm})
+    if "floor_area_sqm" in df:
+        predictions["resale_price_pred"] = price_per_sqm * df["floor_area_sqm"].values
+    return predictions
+
+# Scoring, which runs in the worker processes.
+_MODEL = None
+_ADDRESS_INDEX = None
+_BASE = 10
+_THREADS = None
+
+def _init_worker(model_path, geocode_dir, geocode_json, base, threads):
+    # Load the model and the geocoded addresses once per worker.
+    global _MODEL, _ADDRESS_INDEX, _BASE, _THREADS
+    _MODEL = load_model(model_path)
+    _ADDRESS_INDEX = AddressIndex(geocode.load_geocoded_addresses_json(geocode_dir,
+                                                                       geocode_json))
+    _BASE = base
+    _THREADS = threads
+
+def _score_chunk(df, csv = False):
+    # Must be at the module level to be pickled. Returns the chunk with its
+    # predictions, already formatted as CSV rows for a CSV output, so that the
+    # formatting, which takes as long as the predictions, also runs in the
+    # workers.
+    predictions = score_chunk(df[[c for c in INPUT_COLUMNS if c in df]], _MODEL,
+                              _ADDRESS_INDEX, _BASE, _THREADS)
+    scored = pd.concat([df.reset_index(drop = True), predictions], axis = 1)
+    n_missing = int(predictions["price_per_sqm_pred"].isna().sum())
+    if csv == True:
+        scored = (list(scored.columns), scored.to_csv(header = False, index = False))
+    return scored, len(df), n_missing
+
+# Streaming the input and output files.
+def is_parquet(path):
+    return os.path.splitext(path)[1].lower() in PARQUET_SUFFIXES
+
+def read_chunks(path, chunk_size = CHUNK_SIZE):
+    """
+    Stream a CSV (optionally compressed) or Parquet file in chunks.
+    Inputs
+        path: string
+        chunk_size: int (optional)
+    Outputs
+        chunks: iterator of DataFrame
+    """
+    if is_parquet(path):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size = chunk_size):
+            yield batch.to_pandas()
+    else:
+        # Blocks such as "1A" must stay strings, and so must blocks such as "123".
+        yield from pd.read_csv(path, chunksize = chunk_size, dtype = {"block": str})
+
+class ChunkWriter:
+    """
+    Append DataFrames, or CSV rows formatted elsewhere, to a CSV or Parquet
+    file. The rows are written to a
+    temporary file which replaces the output only when all chunks are written,
+    so a failed run never leaves a partial output.
+        with ChunkWriter("scores.csv") as writer:
+            writer.write(df)
+    """
+    def __init__(self, path):
+        """
+        Inputs
+            path: string, Parquet if it ends with .parquet or .pq, else CSV
+        """
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.parquet = is_parquet(path)
+        self.fp = None
+        self.writer = None
+        self.schema = None
+
+    def write(self, df):
+        if self.parquet == True:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            # Later chunks are cast to the schema of the first, as a column
+            # which is empty in one chunk would otherwise change its type.
+            table = pa.Table.from_pandas(df, schema = self.schema, preserve_index = False)
+            if self.writer is None:
+                self.schema = table.schema
+                self.writer = pq.ParquetWriter(self.tmp_path, self.schema)
+            self.writer.write_table(table)
+        else:
+            header = self.fp is None
+            if self.fp is None:
+                self.fp = open(self.tmp_path, "w", newline = "")
+            df.to_csv(self.fp, header = header, index = False)
+
+    def write_csv(self, columns, rows):
+        """
+        Inputs
+            columns: list, for the header
+            rows: string, from DataFrame.to_csv(header = False, index = False)
+        """
+        if self.fp is None:
+            self.write(pd.DataFrame(columns = columns))
+        self.fp.write(rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        for f in [self.writer, self.fp]:
+            if f is not None:
+                f.close()
+        if os.path.exists(self.tmp_path):
+            if exc_type is None:
+                os.replace(self.tmp_path, self.path)
+            else:
+                os.remove(self.tmp_path)
+        return False
+
+@profiling.profile
+def score_file(input_path, output_path, model_path = None, chunk_size = CHUNK_SIZE,
+               n_jobs = 1, threads_per_worker = 1, base = 10,
+               geocode_dir = geocode.DIR, geocode_json = geocode.GEOCODED_ADDRESSES,
+               verbose = True):
+    """
+    Score a file of listings, writing the listings with their predicted prices.
+    Inputs
+        input_path: string, a CSV or Parquet file with some of the INPUT_COLUMNS
+        output_path: string, a CSV or Parquet file
+        model_path: string (optional), see load_model()
+        chunk_size: int (optional)
+        n_jobs: int (optional), the number of worker processes
+        threads_per_worker: int (optional), the number of LightGBM threads
+        base: int (optional)
+        geocode_dir, geocode_json: string (optional)
+        verbose: bool (optional)
+    Outputs
+        report: dict, with the number of rows, of rows without features, of
+                chunks, the time and the rows per second
+    """
+    start = time.perf_counter()
+    report = {"n_rows": 0, "n_missing": 0, "n_chunks": 0}
+    initargs = (model_path, geocode_dir, geocode_json, base, threads_per_worker)
+
+    with ChunkWriter(output_path) as writer:
+        def write(result):
+            scored, n_rows, n_missing = result
+            if isinstance(scored, tuple):
+                writer.write_csv(*scored)
+            else:
+                writer.write(scored)
+            report["n_rows"] += n_rows
+            report["n_missing"] += n_missing
+            report["n_chunks"] += 1
+
+        if n_jobs is None or n_jobs <= 1:
+            _init_worker(*initargs)
+            for chunk in read_chunks(input_path, chunk_size):
+                write(_score_chunk(chunk))
+        else:
+            csv = writer.parquet == False
+            with ProcessPoolExecutor(max_workers = n_jobs, initializer = _init_worker,
+                                     initargs = initargs) as executor:
+                # Keep a bounded number of chunks in flight, so that the memory
+                # does not grow with the file, and write them in input order.
+                pending = deque()
+                for chunk in read_chunks(input_path, chunk_size):
+                    pending.append(executor.submit(_score_chunk, chunk, csv))
+                    if len(pending) >= 2 * n_jobs:
+                        write(pending.popleft().result())
+                while len(pending) > 0:
+                    write(pending.popleft().result())
+
+    report["time"] = time.perf_counter() - start
+    report["rows_per_second"] = report["n_rows"] / report["time"]
+    if verbose == True:
+        print("Scored {} rows in {} chunks in {:.1f} s, {:.0f} rows/s. {} rows are missing "
+              "features.".format(report["n_rows"], report["n_chunks"], report["time"],
+                                 report["rows_per_second"], report["n_missing"]))
+    return report
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "python -m resale score",
+                                     description = "Score a CSV or Parquet file of listings.")
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("--model", default = None,
+                        help = "a LightGBM model file, a TreePredictor .npz file or a model "
+                               "registry directory, defaults to the current registry model")
+    parser.add_argument("--chunk-size", type = int, default = CHUNK_SIZE)
+    parser.add_argument("--n-jobs", type = int, default = 1)
+    parser.add_argument("--threads-per-worker", type = int, default = 1)
+    parser.add_argument("--base", default = "10", choices = ["10", "e"])
+    parser.add_argument("--geocode-dir", default = geocode.DIR)
+    parser.add_argument("--geocode-json", default = geocode.GEOCODED_ADDRESSES)
+    args = parser.parse_args(argv)
+
+    score_file(args.input, args.output, args.model, args.chunk_size, args.n_jobs,
+               args.threads_per_worker, 10 if args.base == "10" else "e", args.geocode_dir,
+               args.geocode_json)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
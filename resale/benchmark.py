@@ -0,0 +1,437 @@
+# Benchmarks for the computationally heavy parts of the pipeline.
+# Run with: python -m resale.benchmark
+
+# The micro benchmarks compare alternative implementations of single steps.
+# The benchmark suite instead runs every stage of the pipeline on synthetic
+# data, records the time and peak memory of each stage in a json file, and
+# fails when a stage is slower or uses more memory than in a baseline file:
+#   python -m resale.benchmark --suite --rows 100000 --save-baseline
+#   python -m resale.benchmark --suite --rows 100000 --baseline
+
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+
+# Relative imports.
+from . import adjust_price
+from . import clean_data
+from . import h3_geocode
+from . import h3_statistics
+from . import linear_regression
+from . import model
+from . import profiling
+from . import synthetic_data
+
+# Fixed constants for the benchmark suite results on local disk.
+CURR_PATH = os.path.dirname(__file__)
+BENCHMARK_DIR = os.path.join(CURR_PATH, "../cache/benchmarks/")
+BASELINE_FILE = "baseline.json"
+LATEST_FILE = "latest.json"
+STAGES = ["clean", "geocode_join", "h3_assignment", "k_ring_medians", "adjust_price",
+          "features", "train", "inference"]
+
+# Synthetic data for the benchmarks.
+def make_synthetic_median_prices(n_locations = 100,
+                                 n_months = 120,
+                                 missing_fraction = 0.1,
+                                 start_year_month = "2012-01-01",
+                                 price_column = "resale_price",
+                                 which = "town",
+                                 random_state = None):
+    """
+    Make monthly median prices in the format of statistics.get_monthly_median_price()
+    for many locations, each following a smooth random trend plus noise.
+    Inputs
+        n_locations, n_months: int (optional)
+        missing_fraction: float (optional)
+        start_year_month: string (optional)
+        price_column, which: string (optional)
+        random_state: int (optional)
+    Outputs
+        median_prices: DataFrame
+    """
+    rng = np.random.default_rng(random_state)
+    t = np.linspace(-1, 1, n_months)
+
+    # Cubic trends around 400k with a few percent of monthly noise.
+    coefs = rng.normal(0, [0.05, 0.05, 0.15, 0.0], size = [n_locations, 4])
+    coefs[:, 3] = rng.uniform(3e5, 6e5, n_locations)
+    trend = coefs[:, 3:] * (1 + np.dot(coefs[:, :3], np.vstack([t ** 3, t ** 2, t])))
+    prices = trend * (1 + rng.normal(0, 0.02, size = trend.shape))
+
+    locations = np.repeat(["L{:05d}".format(i) for i in range(n_locations)], n_months)
+    year_month = pd.date_range(start_year_month, periods = n_months, freq = "MS")
+    median_prices = pd.DataFrame({"year_month": np.tile(year_month, n_locations),
+                                  price_column: prices.ravel(),
+                                  which: locations})
+
+    keep = rng.random(len(median_prices)) >= missing_fraction
+    return median_prices[keep].reset_index(drop = True)
+
+# Benchmarks.
+def benchmark_trend_fitting(n_locations = 200,
+                            n_months = 240,
+                            vander_order = 8,
+                            missing_fraction = 0.1,
+                            random_state = 0,
+                            verbose = True):
+    """
+    Compare the per-location loop over adjust_price.build_price_adjustment_model()
+    against the batched adjust_price.build_price_adjustment_models() for speed,
+    and for numerical stability through the condition numbers of the kernels
+    and the R2 of the fitted trends.
+    Inputs
+        n_locations, n_months, vander_order: int (optional)
+        missing_fraction: float (optional)
+        random_state: int (optional)
+        verbose: bool (optional)
+    Outputs
+        results: dict
+    """
+    median_prices = make_synthetic_median_prices(n_locations, n_months, missing_fraction,
+                                                 random_state = random_state)
+    start_year_month = median_prices["year_month"].min()
+    months = np.arange(1, n_months + 1)
+    results = {"n_locations": n_locations, "n_months": n_months,
+               "vander_order": vander_order}
+
+    # 1. The current per-location loop.
+    start_time = time.perf_counter()
+    loop_r2 = []
+    for location in sorted(median_prices["town"].unique()):
+        try:
+            d, G, m = adjust_price.build_price_adjustment_model(median_prices, "resale_price",
+                                                                location, start_year_month,
+                                                                "town", vander_order)
+            loop_r2.append(linear_regression.r2(d["resale_price"].values, G, m))
+        except np.linalg.LinAlgError:
+            loop_r2.append(np.nan)
+    results["loop_time"] = time.perf_counter() - start_time
+    results["loop_r2"] = np.nanmedian(loop_r2)
+    results["loop_failures"] = int(np.sum(np.isnan(loop_r2)))
+    results["vander_cond"] = np.linalg.cond(linear_regression.make_basis(months, vander_order,
+                                                                         "vander"))
+
+    # 2. The batched engine, for each of the available bases.
+    for basis in linear_regression.BASES:
+        start_time = time.perf_counter()
+        fits = adjust_price.build_price_adjustment_models(median_prices, "resale_price",
+                                                          start_year_month, "town",
+                                                          vander_order, basis = basis)
+        results["{}_time".format(basis)] = time.perf_counter() - start_time
+        results["{}_r2".format(basis)] = np.median(fits["r2"])
+        G = linear_regression.make_basis(months, vander_order, basis)
+        results["{}_cond".format(basis)] = np.linalg.cond(G)
+
+    if verbose == True:
+        print("Trend fitting: {} locations, {} months, vander_order = {}.".format(
+            n_locations, n_months, vander_order))
+        print("Loop: {:.3f} s, median R2: {:.4f}, failures: {}, cond(G): {:.2e}.".format(
+            results["loop_time"], results["loop_r2"], results["loop_failures"],
+            results["vander_cond"]))
+        for basis in linear_regression.BASES:
+            print("Batched {}: {:.3f} s ({:.0f}x), median R2: {:.4f}, cond(G): {:.2e}.".format(
+                basis, results["{}_time".format(basis)],
+                results["loop_time"] / results["{}_time".format(basis)],
+                results["{}_r2".format(basis)], results["{}_cond".format(basis)]))
+    return results
+
+def benchmark_l1_inversion(n_locations = 26,
+                           n_months = 400,
+                           vander_order = 4,
+                           outlier_fraction = 0.05,
+                           n_jobs = -1,
+                           random_state = 0,
+                           verbose = True):
+    """
+    Compare the original dense L1 norm inversion, looped over locations, with
+    the HiGHS based linear_regression.l1_norm_inversion(), both serially and 
+    with a process pool. The defaults mimic a town level run over the full 
+    history since 1990.
+    Inputs
+        n_locations, n_months, vander_order: int (optional)
+        outlier_fraction: float (optional)
+        n_jobs: int (optional)
+        random_state: int (optional)
+        verbose: bool (optional)
+    Outputs
+        results: dict
+    """
+    rng = np.random.default_rng(random_state)
+    median_prices = make_synthetic_median_prices(n_locations, n_months, 0.0,
+                                                 random_state = random_state)
+    D = median_prices["resale_price"].values.reshape(n_locations, n_months)
+    # Add outlier months, which is what the L1 norm is for.
+    outliers = rng.random(D.shape) < outlier_fraction
+    D = D * np.where(outliers, rng.uniform(0.5, 1.5, D.shape), 1.0)
+    mask = np.ones(D.shape, dtype = bool)
+    G = linear_regression.make_basis(np.arange(1, n_months + 1), vander_order, "legendre")
+    results = {"n_locations": n_locations, "n_months": n_months}
+
+    start_time = time.perf_counter()
+    M_dense = np.vstack([linear_regression.dense_l1_norm_inversion(G, d) for d in D])
+    results["dense_time"] = time.perf_counter() - start_time
+
+    for name, jobs in [("serial", 1), ("parallel", n_jobs)]:
+        start_time = time.perf_counter()
+        M = linear_regression.batch_l1_norm_inversion(G, D, mask, n_jobs = jobs, chunk_size = 2)
+        results["{}_time".format(name)] = time.perf_counter() - start_time
+        results["{}_max_rel_diff".format(name)] = np.max(np.abs(M - M_dense) / 
+                                                         np.abs(M_dense).max(axis = 1)[:, None])
+
+    if verbose == True:
+        print("L1 norm inversion: {} locations, {} months, vander_order = {}.".format(
+            n_locations, n_months, vander_order))
+        print("Dense loop: {:.3f} s.".format(results["dense_time"]))
+        for name in ["serial", "parallel"]:
+            print("HiGHS {}: {:.3f} s ({:.0f}x), max relative difference: {:.1e}.".format(
+                name, results["{}_time".format(name)],
+                results["dense_time"] / results["{}_time".format(name)],
+                results["{}_max_rel_diff".format(name)]))
+    return results
+
+def benchmark_tree_predictor(batch_sizes = [1, 10, 1000],
+                             n_samples = 20000,
+                             n_repeats = 200,
+                             model_params = model.MODEL_PARAMS,
+                             random_state = 0,
+                             verbose = True):
+    """
+    Compare the prediction latency of a trained LGBMRegressor, and of its
+    underlying Booster, against the NumPy tree predictor from 
+    model.export_tree_predictor(), for several batch sizes, and check that
+    the predictions are the same.
+    Inputs
+        batch_sizes: list of int (optional)
+        n_samples: int (optional), the size of the synthetic training set
+        n_repeats: int (optional)
+        model_params: dict (optional)
+        random_state: int (optional)
+        verbose: bool (optional)
+    Outputs
+        results: dict
+    """
+    rng = np.random.default_rng(random_state)
+    # Features in the ranges of model.FEATURES.
+    low = np.array([1.27, 103.6, 1, 1, 0])
+    high = np.array([1.47, 104.0, 7, 17, 55])
+    X = rng.uniform(low, high, size = [n_samples, len(low)])
+    y = (5.7 - 0.004 * X[:, 4] + 0.01 * X[:, 3] + 0.1 * np.sin(20 * X[:, 0]) + 
+         rng.normal(0, 0.02, n_samples))
+    regressor = lgb.LGBMRegressor(**model_params, random_state = random_state, 
+                                  verbose = -1).fit(X, y)
+    predictor = model.export_tree_predictor(regressor)
+    results = {"n_trees": predictor.n_trees}
+
+    X_test = rng.uniform(low, high, size = [max(batch_sizes), len(low)])
+    results["max_abs_diff"] = np.max(np.abs(regressor.predict(X_test) - 
+                                            predictor.predict(X_test)))
+    for batch_size in batch_sizes:
+        X_batch = X_test[:batch_size]
+        for name, predict in [("regressor", regressor.predict),
+                              ("booster", regressor.booster_.predict),
+                              ("numpy", predictor.predict)]:
+            times = []
+            for i in range(n_repeats):
+                start_time = time.perf_counter()
+                predict(X_batch)
+                times.append(time.perf_counter() - start_time)
+            results["{}_{}".format(name, batch_size)] = np.median(times)
+
+    if verbose == True:
+        print("Tree predictor: {} trees, max absolute difference: {:.1e}.".format(
+            results["n_trees"], results["max_abs_diff"]))
+        for batch_size in batch_sizes:
+            print("Batch size {}: LGBMRegressor {:.3f} ms, Booster {:.3f} ms, "
+                  "NumPy {:.3f} ms ({:.1f}x).".format(
+                batch_size, 1e3 * results["regressor_{}".format(batch_size)],
+                1e3 * results["booster_{}".format(batch_size)],
+                1e3 * results["numpy_{}".format(batch_size)],
+                results["regressor_{}".format(batch_size)] / 
+                results["numpy_{}".format(batch_size)]))
+    return results
+
+# The benchmark suite.
+def measure(func, *args, interval = 0.005, **kwargs):
+    """
+    Call a function, measuring its wall and CPU time, and its peak memory 
+    above the memory at the start, sampled by a background thread. Unlike
+    tracemalloc, this does not slow the function down, and includes the
+    memory allocated outside of Python, e.g. by LightGBM.
+    Inputs
+        func: function
+        args, kwargs: the arguments of func
+        interval: float (optional), seconds between the memory samples
+    Outputs
+        result: the output of func
+        stats: dict, with "time", "cpu_time" and "peak_memory_mb"
+    """
+    start_memory = profiling.resident_memory()
+    peak = [start_memory]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], profiling.resident_memory())
+
+    if start_memory is not None:
+        thread = threading.Thread(target = sample, daemon = True)
+        thread.start()
+    start_time, start_cpu_time = time.perf_counter(), time.process_time()
+    result = func(*args, **kwargs)
+    stats = {"time": time.perf_counter() - start_time,
+             "cpu_time": time.process_time() - start_cpu_time,
+             "peak_memory_mb": None}
+    if start_memory is not None:
+        done.set()
+        thread.join()
+        peak[0] = max(peak[0], profiling.resident_memory())
+        stats["peak_memory_mb"] = (peak[0] - start_memory) / 2 ** 20
+    return result, stats
+
+def run_benchmark_suite(n_rows = 100000,
+                        n_estimators = 200,
+                        h3_resolution = 8,
+                        k_ring_distance = 1,
+                        stages = STAGES,
+                        random_state = 0,
+                        verbose = True):
+    """
+    Run the stages of the pipeline on synthetic data from synthetic_data, and
+    measure each of them.
+    Inputs
+        n_rows: int (optional)
+        n_estimators: int (optional)
+        h3_resolution, k_ring_distance: int (optional)
+        stages: list (optional), a subset of STAGES
+        random_state: int (optional)
+        verbose: bool (optional)
+    Outputs
+        results: dict, with the settings and a dict of the stats of each stage
+    """
+    df, address_dict = synthetic_data.make_synthetic_data(n_rows, random_state = random_state)
+    results = {"n_rows": n_rows, "n_estimators": n_estimators, "h3_resolution": h3_resolution,
+               "k_ring_distance": k_ring_distance, "random_state": random_state,
+               "created": datetime.now().isoformat(timespec = "seconds"),
+               "python": platform.python_version(), "platform": platform.platform(),
+               "stages": {}}
+
+    def run(stage, func, *args, **kwargs):
+        # Stages which are not selected still run, as later stages need their
+        # outputs, but are not recorded.
+        result, stats = measure(func, *args, **kwargs)
+        out = result[0] if isinstance(result, tuple) else result
+        stats.update(rows_in = len(args[0]), rows_out = len(out) if hasattr(out, "shape") else None)
+        if stage in stages:
+            results["stages"][stage] = stats
+            if verbose == True:
+                print("{:<16}{:>9.3f} s{:>9.1f} MB{:>12} rows".format(
+                    stage, stats["time"], 
+                    np.nan if stats["peak_memory_mb"] is None else stats["peak_memory_mb"],
+                    stats["rows_out"] if stats["rows_out"] is not None else "-"))
+        return result
+
+    # The geocode join is part of the cleaning, but is also measured alone.
+    df = run("clean", clean_data.clean_data, df, address_dict)
+    run("geocode_join", clean_data.get_latitude_and_longitude,
+        df.drop(columns = ["latitude", "longitude"]), address_dict)
+    df = run("h3_assignment", h3_geocode.latlon_to_h3, df, h3_resolution)
+    run("k_ring_medians", h3_statistics.get_all_k_ring_monthly_median_price, df,
+        "year_month", "price_per_sqm", k_ring_distance, "h3")
+    df, _ = run("adjust_price", adjust_price.adjust_resale_price_by_location, df,
+                price_column = "price_per_sqm")
+    X, y = run("features", model.make_Xy, df, model.FEATURES, model.TARGET, True)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        result = run("train", model.train_model, X, y,
+                     model_params = dict(model.MODEL_PARAMS, n_estimators = n_estimators),
+                     random_state = random_state, cache_dir = cache_dir, verbose = False)
+    run("inference", result["model"].predict, X)
+    return results
+
+def compare_results(results, baseline, threshold = 0.25, min_time = 0.05, min_memory_mb = 16):
+    """
+    Compare benchmark suite results against a baseline. A stage regresses when
+    its time or peak memory is more than threshold above the baseline, and by
+    more than min_time or min_memory_mb, which ignores the noise of small stages.
+    Inputs
+        results, baseline: dict, from run_benchmark_suite()
+        threshold: float (optional)
+        min_time: float (optional), seconds
+        min_memory_mb: float (optional)
+    Outputs
+        comparison: DataFrame, with a row per stage and metric
+    """
+    rows = []
+    for stage, stats in results["stages"].items():
+        if stage not in baseline["stages"]:
+            continue
+        for metric, minimum in [("time", min_time), ("peak_memory_mb", min_memory_mb)]:
+            current, base = stats.get(metric, None), baseline["stages"][stage].get(metric, None)
+            if current is None or base is None:
+                continue
+            rows.append({"stage": stage, "metric": metric, "baseline": base, "current": current,
+                         "ratio": current / base if base > 0 else np.nan,
+                         "regression": (current > base * (1 + threshold)) and 
+                                       (current - base > minimum)})
+    return pd.DataFrame(rows, columns = ["stage", "metric", "baseline", "current", "ratio",
+                                         "regression"])
+
+def save_results(results, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+    with open(path, "w") as fp:
+        json.dump(results, fp, indent = 2)
+
+def load_results(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmarks of the resale flat prices pipeline.")
+    parser.add_argument("--suite", action = "store_true", 
+                        help = "run the stage benchmark suite instead of the micro benchmarks")
+    parser.add_argument("--rows", type = int, default = 100000)
+    parser.add_argument("--n-estimators", type = int, default = 200)
+    parser.add_argument("--stages", nargs = "+", default = STAGES, choices = STAGES)
+    parser.add_argument("--output", default = os.path.join(BENCHMARK_DIR, LATEST_FILE))
+    parser.add_argument("--baseline", nargs = "?", const = os.path.join(BENCHMARK_DIR, BASELINE_FILE),
+                        help = "compare against a baseline file, failing on regressions")
+    parser.add_argument("--save-baseline", action = "store_true")
+    parser.add_argument("--threshold", type = float, default = 0.25)
+    args = parser.parse_args(argv)
+
+    if args.suite == False:
+        benchmark_trend_fitting(vander_order = 4)
+        benchmark_trend_fitting(vander_order = 8)
+        benchmark_l1_inversion()
+        benchmark_tree_predictor()
+        return 0
+
+    results = run_benchmark_suite(args.rows, args.n_estimators, stages = args.stages)
+    save_results(results, args.output)
+    if args.save_baseline == True:
+        save_results(results, os.path.join(BENCHMARK_DIR, BASELINE_FILE))
+    if args.baseline is not None:
+        baseline = load_results(args.baseline)
+        if baseline["n_rows"] != results["n_rows"]:
+            print("The baseline has {} rows, not {}.".format(baseline["n_rows"], results["n_rows"]))
+            return 2
+        comparison = compare_results(results, baseline, args.threshold)
+        print(comparison.to_string(index = False))
+        if comparison["regression"].any():
+            print("Regressions in: {}.".format(
+                ", ".join(comparison.loc[comparison["regression"], "stage"].unique())))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,13 +5,19 @@ import numpy as np
 
 # Relative imports.
 from . import geocode
+from . import profiling
+from . import property_information
 
 # Fixed constants.
 CURRENT_YEAR = datetime.today().year
 
 # Main cleaning function.
-def clean_data(df):
+@profiling.profile
+def clean_data(df, address_dict = None, property_table = None):
     # Prepare the cleaned versions of the features. New columns are added to the DataFrame.
+    # address_dict defaults to the geocoded addresses in "processed data/".
+    # property_table, from property_information.load_property_information(), adds
+    # the block level features if given.
     
     # 1. Get "price_per_sqm" from "resale_price" and "floor_area_sqm".
     df = get_price_per_sqm(df)
@@ -41,8 +47,12 @@ def clean_data(df):
     df = get_age(df, CURRENT_YEAR)
     
     # 10. Obtain latitude and longitude, and normalize them.
-    df = get_latitude_and_longitude(df)
+    df = get_latitude_and_longitude(df, address_dict)
     #df = clean_latitude_and_longitude(df)
+    
+    # 11. Join the block level features of "address".
+    if property_table is not None:
+        df = property_information.join_property_information(df, property_table)
     return df
     
     
@@ -296,12 +306,15 @@ def clean_lease_commence_date(df, current_year = CURRENT_YEAR):
     return df
 
 # latitude and longitude
-def get_latitude_and_longitude(df):
+@profiling.profile
+def get_latitude_and_longitude(df, address_dict = None):
     """
     Use pre-geocoded addresses in "processed data/geocoded_addresses.json"
-    to obtain the latitudes and longitudes for each address.
+    to obtain the latitudes and longitudes for each address, unless another
+    address_dict is given.
     """
-    address_dict = geocode.load_geocoded_addresses_json("processed data/")
+    if address_dict is None:
+        address_dict = geocode.load_geocoded_addresses_json("processed data/")
     
     if "address" not in df:
         if "street_name_cleaned" not in df:
@@ -0,0 +1,236 @@
+# Find the comparable sales ("comps") of a flat among the past transactions.
+
+# Valuers price a flat from the k most similar recent sales nearby. Filtering
+# the whole DataFrame for every query is slow, so the cleaned and adjusted
+# transactions are indexed once:
+# 1. A KD-tree over the distinct block locations, in km, finds the blocks
+#    nearest to the flat.
+# 2. The transactions are sorted by (block, flat type, month), which gives a
+#    month-sorted posting list for every block and flat type, stored as one
+#    sorted integer key. The sales of the candidate blocks within the time
+#    window are then found with two vectorized binary searches.
+# The candidates are ranked by a score which adds up their distance, age,
+# storey difference and floor area difference, each divided by a scale, and
+# the top k are returned with their adjusted prices.
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+# Relative imports.
+from . import clean_data
+from . import inference_data
+
+# Fixed constants for the distances in km, with an equirectangular
+# projection, which is accurate enough over Singapore.
+KM_PER_DEGREE = 111.32
+# The differences which count as much as each other in the score: 500 m,
+# 6 months, 10 storeys, and 10% of the floor area.
+SCALES = {"distance_km": 0.5, "months_ago": 6, "storey_difference": 10,
+          "floor_area_difference": 0.1}
+OUTPUT_COLUMNS = ["address", "town", "flat_type", "storey_range", "floor_area_sqm",
+                  "year_month", "resale_price", "resale_price_adj", "price_per_sqm_adj"]
+
+def month_number(year_month):
+    """
+    Inputs
+        year_month: datetime or array of datetime
+    Outputs
+        n: int or array of int, the months since year 0
+    """
+    year_month = pd.DatetimeIndex(np.atleast_1d(year_month))
+    n = np.asarray(year_month.year * 12 + year_month.month - 1)
+    return n if n.shape[0] > 1 else int(n[0])
+
+def storey_midpoint(storey_range):
+    # The middle storey of e.g. "04 TO 06", i.e. 5.
+    return clean_data.storey_range_formatter(storey_range, max_storey = 1)
+
+class CompsEngine:
+    """
+    An index of past transactions for comparable sales queries.
+    """
+    def __init__(self, df, price_column = "resale_price_adj"):
+        """
+        Inputs
+            df: DataFrame, cleaned with clean_data.clean_data() and adjusted
+                with adjust_price, with the address, latitude, longitude,
+                flat_type, storey_range, year_month and price_column
+            price_column: string (optional)
+        """
+        self.price_column = price_column
+        columns = [c for c in OUTPUT_COLUMNS + [price_column] if c in df]
+        self.df = df[list(dict.fromkeys(columns))].reset_index(drop = True)
+
+        # 1. The blocks and their locations, in km from the first block.
+        blocks, self.addresses = pd.factorize(df["address"])
+        latitude = np.zeros(len(self.addresses))
+        longitude = np.zeros(len(self.addresses))
+        latitude[blocks] = df["latitude"].values
+        longitude[blocks] = df["longitude"].values
+        self.origin = (latitude[0], longitude[0], np.cos(np.radians(latitude[0])))
+        self.tree = cKDTree(self.to_km(latitude, longitude))
+        self.address_index = pd.Index(self.addresses)
+
+        # 2. The posting lists, as one key sorted by block, flat type and month.
+        flat_types, self.flat_types = pd.factorize(df["flat_type"].map(
+            clean_data.flat_type_formatter), sort = True)
+        months = np.atleast_1d(month_number(df["year_month"].values))
+        self.first_month = months.min()
+        self.n_months = months.max() - self.first_month + 1
+        keys = ((blocks.astype(np.int64) * len(self.flat_types) + flat_types) * self.n_months +
+                months - self.first_month)
+        order = np.argsort(keys, kind = "stable")
+        self.keys = keys[order]
+        self.rows = order
+        self.months = months[order]
+
+        # 3. The attributes used in the score, in the same order.
+        codes, ranges = pd.factorize(df["storey_range"])
+        self.storeys = np.array([storey_midpoint(x) for x in ranges])[codes][order]
+        if "floor_area_sqm" in df:
+            self.log_floor_areas = np.log(df["floor_area_sqm"].values.astype(float))[order]
+        else:
+            self.log_floor_areas = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def to_km(self, latitude, longitude):
+        """
+        Inputs
+            latitude, longitude: float or array
+        Outputs
+            xy: array (n, 2), in km
+        """
+        lat0, lon0, cos0 = self.origin
+        return np.column_stack([(np.atleast_1d(longitude) - lon0) * cos0 * KM_PER_DEGREE,
+                                (np.atleast_1d(latitude) - lat0) * KM_PER_DEGREE])
+
+    def locate(self, address):
+        """
+        The coordinates of an address, from the transactions or else from
+        the geocoded addresses.
+        Inputs
+            address: string
+        Outputs
+            latitude, longitude: float
+        """
+        i = self.address_index.get_indexer([address])[0]
+        if i < 0:
+            return inference_data.address_to_latlon(address)
+        xy = self.tree.data[i]
+        lat0, lon0, cos0 = self.origin
+        return lat0 + xy[1] / KM_PER_DEGREE, lon0 + xy[0] / (cos0 * KM_PER_DEGREE)
+
+    def _candidates(self, xy, flat_type, first_month, last_month, n_blocks, radius_km):
+        # The positions of the sales of the flat type within the time window
+        # in the n_blocks nearest blocks within radius_km, their distances,
+        # and the distance of the last block, or None if every block within
+        # radius_km was searched.
+        n_blocks = min(n_blocks, len(self.addresses))
+        distances, blocks = self.tree.query(xy, k = n_blocks, distance_upper_bound = radius_km)
+        distances, blocks = np.atleast_1d(distances), np.atleast_1d(blocks)
+        found = np.isfinite(distances)
+        last_distance = distances[-1] if found.all() and n_blocks < len(self.addresses) else None
+        distances, blocks = distances[found], blocks[found]
+
+        base = (blocks.astype(np.int64) * len(self.flat_types) + flat_type) * self.n_months
+        lo = np.searchsorted(self.keys, base + max(first_month - self.first_month, 0))
+        hi = np.searchsorted(self.keys, base + min(last_month - self.first_month,
+                                                   self.n_months - 1), side = "right")
+        counts = hi - lo
+        # The positions lo[i], ..., hi[i] - 1 of every block, in one array.
+        starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+        positions = starts + np.arange(counts.sum())
+        return positions, np.repeat(distances, counts), last_distance
+
+    def query(self, address = None, latitude = None, longitude = None, flat_type = None,
+              storey_range = None, floor_area_sqm = None, end_year_month = None, months = 12,
+              k = 10, radius_km = 2.0, n_blocks = 32, scales = SCALES):
+        """
+        The k sales most similar to a flat, within radius_km and within the
+        months before end_year_month.
+        Inputs
+            address: string (optional), or latitude and longitude
+            latitude, longitude: float (optional)
+            flat_type: string, e.g. "4 ROOM"
+            storey_range: string (optional), e.g. "04 TO 06"
+            floor_area_sqm: float (optional)
+            end_year_month: datetime (optional), the last month of the window,
+                            defaults to the last month of the transactions
+            months: int (optional), the length of the window
+            k: int (optional)
+            radius_km: float (optional)
+            n_blocks: int (optional), the number of nearest blocks searched
+                      first, doubled until the k best comps are found
+            scales: dict (optional), see SCALES
+        Outputs
+            comps: DataFrame, with the OUTPUT_COLUMNS, the distance_km,
+                   months_ago, storey_difference and score, best first
+        """
+        if address is not None:
+            latitude, longitude = self.locate(address)
+        xy = self.to_km(float(latitude), float(longitude))[0]
+        flat_type = self.flat_types.get_indexer([clean_data.flat_type_formatter(flat_type)])[0]
+        if end_year_month is None:
+            last_month = self.first_month + self.n_months - 1
+        else:
+            last_month = month_number(pd.Timestamp(end_year_month))
+        first_month = last_month - months + 1
+        if (flat_type < 0 or last_month < self.first_month or
+                first_month > self.first_month + self.n_months - 1):
+            return self._output(np.zeros(0, dtype = int), np.zeros(0), np.zeros(0),
+                                np.zeros(0), np.zeros(0))
+
+        # Search more blocks until the k-th best score is lower than the
+        # score of any sale in the blocks not searched, which is at least the
+        # score of their distance, or until all blocks within radius_km have
+        # been searched.
+        while True:
+            positions, distances, last_distance = self._candidates(
+                xy, flat_type, first_month, last_month, n_blocks, radius_km)
+            months_ago = last_month - self.months[positions]
+            score = distances / scales["distance_km"] + months_ago / scales["months_ago"]
+            storey_difference = np.zeros(len(positions))
+            if storey_range is not None:
+                storey_difference = np.abs(self.storeys[positions] - storey_midpoint(storey_range))
+                score = score + storey_difference / scales["storey_difference"]
+            if floor_area_sqm is not None and self.log_floor_areas is not None:
+                score = score + (np.abs(self.log_floor_areas[positions] - np.log(floor_area_sqm)) /
+                                 scales["floor_area_difference"])
+            if last_distance is None or (len(score) >= k and np.partition(score, k - 1)[k - 1] <=
+                                         last_distance / scales["distance_km"]):
+                break
+            n_blocks = 2 * n_blocks
+
+        # The k best, sorted, without sorting all the candidates.
+        if len(score) > k:
+            best = np.argpartition(score, k - 1)[:k]
+        else:
+            best = np.arange(len(score))
+        best = best[np.argsort(score[best], kind = "stable")]
+        return self._output(positions[best], distances[best], months_ago[best],
+                            storey_difference[best], score[best])
+
+    def _output(self, positions, distances, months_ago, storey_difference, score):
+        comps = self.df.iloc[self.rows[positions]].reset_index(drop = True)
+        comps["distance_km"] = distances
+        comps["months_ago"] = months_ago
+        comps["storey_difference"] = storey_difference
+        comps["score"] = score
+        return comps
+
+    def estimate(self, k = 10, **query):
+        """
+        The median adjusted price of the k comps of a flat.
+        Inputs
+            k: int (optional)
+            query: the arguments of query()
+        Outputs
+            price: float, NaN without comps
+            comps: DataFrame
+        """
+        comps = self.query(k = k, **query)
+        price = float(np.median(comps[self.price_column])) if len(comps) > 0 else np.nan
+        return price, comps
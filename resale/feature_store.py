@@ -0,0 +1,162 @@
+# Store the feature matrix and target as versioned, memory-mapped arrays.
+
+# model.make_Xy() rebuilds X and y from the cleaned DataFrame for every
+# training, tuning and evaluation run. Instead, X and y are materialized once
+# as contiguous float32 arrays, with the target transform applied to the whole
+# column at once, and saved as .npy files in a directory named after a hash of
+# the data, the features and the target transform. The arrays are memory-mapped
+# on load, so processes on the same machine share one physical copy through
+# the page cache instead of each holding their own. model.train_model() and
+# model.make_datasets() take the key of a stored version instead of X and y,
+# and keep the train and validation splits in float32.
+
+# float32 keeps about 7 significant digits, i.e. about 1 m for the longitudes
+# around 104 degrees, which is below the resolution of the LightGBM bins.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# Relative imports.
+from . import model
+from . import profiling
+
+# Fixed constants for the feature store on local disk.
+CURR_PATH = os.path.dirname(__file__)
+FEATURE_STORE_DIR = os.path.join(CURR_PATH, "../cache/features/")
+METADATA_FILE = "metadata.json"
+
+def feature_key(df, features = model.FEATURES, target = model.TARGET, scale_y = True,
+                base = 10, dtype = np.float32):
+    """
+    A hash of the columns used for X and y, and of the settings, which is the
+    version of the stored arrays.
+    Inputs
+        df: DataFrame
+        features: list (optional)
+        target: string (optional)
+        scale_y: bool (optional)
+        base: int (optional)
+        dtype: dtype (optional)
+    Outputs
+        key: string
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps({"features": list(features), "target": target, "scale_y": scale_y,
+                         "base": str(base), "dtype": np.dtype(dtype).str}).encode())
+    for column in list(features) + [target]:
+        h.update(pd.util.hash_pandas_object(df[column], index = False).values.tobytes())
+    return h.hexdigest()[:16]
+
+@profiling.profile
+def materialize(df, features = model.FEATURES, target = model.TARGET, scale_y = True,
+                base = 10, dtype = np.float32, store_dir = FEATURE_STORE_DIR):
+    """
+    Write X and y of a DataFrame to the feature store, unless that version is
+    already stored.
+    Inputs
+        df: DataFrame
+        features: list (optional)
+        target: string (optional)
+        scale_y: bool (optional), scale the target with model.y_scaler()
+        base: int (optional)
+        dtype: dtype (optional)
+        store_dir: string (optional)
+    Outputs
+        key: string
+    """
+    key = feature_key(df, features, target, scale_y, base, dtype)
+    path = os.path.join(store_dir, key)
+    if os.path.exists(os.path.join(path, METADATA_FILE)):
+        return key
+
+    X = np.empty([len(df), len(features)], dtype = dtype)
+    for i, feature in enumerate(features):
+        X[:, i] = df[feature].values
+    y = df[target].values.astype(float)
+    if scale_y == True:
+        y = model.y_scaler(y, base)
+
+    # Write to a temporary directory which is renamed when complete, so that
+    # other processes never see a partially written version.
+    os.makedirs(store_dir, exist_ok = True)
+    tmp_path = tempfile.mkdtemp(dir = store_dir)
+    np.save(os.path.join(tmp_path, "X.npy"), X)
+    np.save(os.path.join(tmp_path, "y.npy"), y.astype(dtype))
+    metadata = {"key": key, "features": list(features), "target": target,
+                "scale_y": scale_y, "base": base if base != np.exp(1) else "e",
+                "dtype": np.dtype(dtype).str, "n_rows": len(df),
+                "created": datetime.now().isoformat(timespec = "seconds")}
+    with open(os.path.join(tmp_path, METADATA_FILE), "w") as fp:
+        json.dump(metadata, fp)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process stored the same version first.
+        shutil.rmtree(tmp_path)
+    return key
+
+def load(key, store_dir = FEATURE_STORE_DIR, mmap_mode = "r"):
+    """
+    Load a stored version of X and y, memory-mapped by default.
+    Inputs
+        key: string, from materialize()
+        store_dir: string (optional)
+        mmap_mode: string (optional)
+    Outputs
+        X: array (n_rows, n_features)
+        y: array (n_rows,)
+        metadata: dict
+    """
+    path = os.path.join(store_dir, key)
+    if not os.path.exists(os.path.join(path, METADATA_FILE)):
+        raise FileNotFoundError("No stored features {} in {}.".format(key, store_dir))
+    with open(os.path.join(path, METADATA_FILE)) as fp:
+        metadata = json.load(fp)
+    X = np.load(os.path.join(path, "X.npy"), mmap_mode = mmap_mode)
+    y = np.load(os.path.join(path, "y.npy"), mmap_mode = mmap_mode)
+    return X, y, metadata
+
+def get_Xy(df = None, features = model.FEATURES, target = model.TARGET, scale_y = True,
+           base = 10, key = None, store_dir = FEATURE_STORE_DIR):
+    """
+    A drop-in replacement of model.make_Xy() backed by the feature store.
+    With a key from an earlier call, the DataFrame is not needed at all.
+    Inputs
+        df: DataFrame (optional if key is given)
+        features: list (optional)
+        target: string (optional)
+        scale_y: bool (optional)
+        base: int (optional)
+        key: string (optional)
+        store_dir: string (optional)
+    Outputs
+        X: array, memory-mapped float32
+        y: array, memory-mapped float32
+    """
+    if key is None:
+        key = materialize(df, features, target, scale_y, base, store_dir = store_dir)
+    X, y, _ = load(key, store_dir)
+    return X, y
+
+def list_versions(store_dir = FEATURE_STORE_DIR):
+    """
+    The metadata of every stored version.
+    Inputs
+        store_dir: string (optional)
+    Outputs
+        versions: DataFrame
+    """
+    versions = []
+    if os.path.exists(store_dir):
+        for key in sorted(os.listdir(store_dir)):
+            if os.path.exists(os.path.join(store_dir, key, METADATA_FILE)):
+                with open(os.path.join(store_dir, key, METADATA_FILE)) as fp:
+                    versions.append(json.load(fp))
+    return pd.DataFrame(versions)
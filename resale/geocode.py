@@ -1,13 +1,12 @@
 # Geocode the addresses to geographical coordinates.
 
 import json
-import geopy
 import numpy as np
 import os
 import time
 
 # Relative imports.
-from . import load_data, clean_data, onemapclient
+from . import load_data, clean_data, onemapclient, profiling
 
 # Fixed constants indicating the location of the geocoded address json file.
 CURR_PATH = os.path.dirname(__file__)
@@ -55,6 +54,7 @@ def get_unique_address(df):
     df = clean_data.make_address(df)
     return df["address"].unique()
 
+@profiling.profile
 def load_geocoded_addresses_json(dir = DIR, json_file = GEOCODED_ADDRESSES):
     """
     Load the json file containing the geocoded addresses.
@@ -175,6 +175,7 @@ def nominatim_geocode(address_to_geocode, address_dict, user_agent = "resale_fla
     Outputs
         address_dict: dict
     """
+    import geopy # Imported here as it is slow to import and only needed to geocode.
     nominatim_geocoder = geopy.Nominatim(user_agent = user_agent)
     try:
         gcd = nominatim_geocoder.geocode(address_to_geocode)
@@ -1,14 +1,18 @@
 # h3-py: Uber's H3 Hexagonal Hierarchical Geospatial Indexing System in Python
 # https://uber.github.io/h3-py/intro.html
 
+# IPython and folium are only needed for the maps, and are imported inside the
+# plotting functions as they are slow to import.
 import h3
-from IPython.display import display
-import folium
+
+# Relative imports.
+from . import profiling
 
 # Constants involving H3 cell resolution.
 # A resolution of 8 results in a hexagonal cell of roughly 1 km2 area and 0.5 km edge length.
 RESOLUTION = 8
 
+@profiling.profile
 def latlon_to_h3(df, resolution = RESOLUTION):
     """
     Converts latitude and longitude to a specified H3 resolution.
@@ -27,6 +31,7 @@ def plot_hexagons(hexagons):
     Inputs
         hexagons: list
     """
+    from IPython.display import display
     m = visualize_hexagons(hexagons)
     display(m)
 
@@ -39,6 +44,7 @@ def visualize_hexagons(hexagons, color = "red", folium_map = None):
     hexagons is a list of hexcluster. Each hexcluster is a list of hexagons.
     eg. [[hex1, hex2], [hex3, hex4]]
     """
+    import folium
     polylines = []
     lat = []
     lng = []
@@ -62,6 +68,7 @@ def visualize_hexagons(hexagons, color = "red", folium_map = None):
     return m
     
 def visualize_polygon(polyline, color):
+    import folium
     polyline.append(polyline[0])
     lat = [p[0] for p in polyline]
     lng = [p[1] for p in polyline]
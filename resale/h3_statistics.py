@@ -2,40 +2,71 @@
 # https://uber.github.io/h3-py/intro.html
 
 import h3
+import numpy as np
 import pandas as pd
 
+# Relative imports.
+from . import parallel
+from . import profiling
+from . import statistics
+
+@profiling.profile
 def get_all_k_ring_monthly_median_price(df, 
                                         date_column = "year_month", 
                                         price_column = "resale_price",
                                         k_ring_distance = 1, 
-                                        h3_column_name = "h3"):
+                                        h3_column_name = "h3",
+                                        n_jobs = 1):
     """
     Gets the k-ring median price for all unique H3 indices in the DataFrame.
+    The rows are sorted by cell once, so that the rows of the k-ring of a cell
+    are read from the ranges of its neighbours instead of filtering the whole
+    DataFrame for every cell. With n_jobs > 1 the cells are spread over a
+    process pool, which reads the sorted rows from shared memory. Rows with a
+    missing cell, e.g. from a failed geocode, are skipped.
     Inputs
         df: DataFrame
         date_column: string (optional)
         price_column: string (optional)
         k_ring_distance: int (optional)
         h3_column_name: string (optional)
+        n_jobs: int (optional), the number of processes, -1 uses all CPUs
     Outputs
         median_price: DataFrame
     """
-    h3_indices = df[h3_column_name].unique() # Get all unique H3 cell indices in df.
-    h3_median_prices = []
+    # Get all unique H3 cell indices in df. SharedFrame drops the missing cells.
+    h3_indices = df[h3_column_name].dropna().unique()
+    
+    with parallel.SharedFrame(df, h3_column_name, [date_column, price_column]) as frame:
+        results = parallel.map_groups(_k_ring_monthly_median_prices, frame, 
+                                      (frame.groups, date_column, price_column, 
+                                       k_ring_distance), 
+                                      n_jobs)
+        cells = frame.groups
     
-    for i in range(len(h3_indices)):
-        # For each unique h3 index in the data, calculate the median price.
-        h3_median_price = get_k_ring_monthly_median_price(df, 
-                                                          h3_indices[i], 
-                                                          date_column, 
-                                                          price_column,
-                                                          k_ring_distance, 
-                                                          h3_column_name)
-        h3_median_price[h3_column_name] = h3_indices[i]
-        h3_median_prices.append(h3_median_price)
-        
-    # This is the fast way of DataFrame concatenation.
-    return pd.concat(h3_median_prices, ignore_index = True) 
+    # Return the cells in the order they appear in df, as the per cell loop did.
+    results = dict(zip(cells, results))
+    results = [results[h3_index] for h3_index in h3_indices]
+    lengths = [len(months) for months, _, _ in results]
+    return pd.DataFrame({date_column: np.concatenate([months for months, _, _ in results]),
+                         price_column: np.concatenate([medians for _, medians, _ in results]),
+                         "N": np.repeat([n for _, _, n in results], lengths),
+                         h3_column_name: np.repeat(h3_indices, lengths)})
+
+def _k_ring_monthly_median_prices(columns, offsets, start, stop, cells, date_column, 
+                                  price_column, k_ring_distance):
+    # The k-ring monthly median prices of the cells [start, stop) of a
+    # parallel.SharedFrame sorted by cell, run by parallel.map_groups().
+    index = {cell: i for i, cell in enumerate(cells)}
+    results = []
+    for i in range(start, stop):
+        neighbours = [index[cell] for cell in h3.k_ring(cells[i], k = k_ring_distance) 
+                      if cell in index]
+        rows = np.concatenate([np.arange(offsets[j], offsets[j + 1]) for j in neighbours])
+        months, medians, _ = statistics.group_median(columns[date_column][rows], 
+                                                     columns[price_column][rows])
+        results.append((months, medians, len(rows)))
+    return results
 
 def get_k_ring_monthly_median_price(df, 
                                     h3_index, 
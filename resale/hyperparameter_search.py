@@ -0,0 +1,261 @@
+# Search for the best LightGBM parameters with successive halving and Hyperband.
+
+# Instead of training every candidate to completion on every fold like
+# model.grid_search_cv(), all candidates are first trained with a small number
+# of boosting rounds, and only the best 1 / eta of them are trained further
+# with eta times more rounds, until a single candidate remains. Hyperband runs
+# several such brackets, trading off the number of candidates against the
+# number of rounds each candidate is first trained with.
+
+# The trials reuse the binned datasets cached by model.make_datasets(), run in
+# a process pool with a fixed number of threads each, and are appended to a
+# history file as they finish, so that an interrupted search can be resumed.
+
+# The trials are ranked on a validation split carved out of the training rows,
+# with the bins of the cached training Dataset, and the test split is only
+# used to report the error of each trial, so that it is not optimistic.
+
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import math
+import os
+from time import perf_counter
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+
+# Relative imports.
+from . import model
+
+# Fixed constants for the default search space. Tuples are (low, high) ranges,
+# sampled log-uniformly for "learning_rate", and lists are sampled from directly.
+SEARCH_SPACE = {"num_leaves": (8, 256),
+                "max_depth": [-1, 4, 5, 6, 8, 10, 12],
+                "learning_rate": (0.01, 0.3),
+                "min_data_in_leaf": (5, 200),
+                "objective": ["huber", "regression", "regression_l1", "fair"]}
+LOG_UNIFORM = ["learning_rate", "num_leaves", "min_data_in_leaf"]
+# The fraction of the training rows used to rank the trials.
+VALIDATION_SIZE = model.VALIDATION_SIZE
+
+def sample_configs(n_configs, search_space = SEARCH_SPACE, random_state = None):
+    """
+    Randomly sample parameter configurations from the search space.
+    Inputs
+        n_configs: int
+        search_space: dict (optional)
+        random_state: int or np.random.Generator (optional)
+    Outputs
+        configs: list of dict
+    """
+    rng = np.random.default_rng(random_state)
+    configs = []
+    for i in range(n_configs):
+        config = {}
+        for name, values in search_space.items():
+            if isinstance(values, list):
+                config[name] = values[rng.integers(len(values))]
+            elif name in LOG_UNIFORM:
+                config[name] = float(np.exp(rng.uniform(np.log(values[0]), np.log(values[1]))))
+            else:
+                config[name] = float(rng.uniform(values[0], values[1]))
+            if isinstance(values, tuple) and isinstance(values[0], int):
+                config[name] = int(round(config[name]))
+        configs.append(config)
+    return configs
+
+def config_id(config):
+    """
+    A short, stable identifier of a parameter configuration.
+    Inputs
+        config: dict
+    Outputs
+        config_id: string
+    """
+    return hashlib.sha1(json.dumps(config, sort_keys = True).encode()).hexdigest()[:12]
+
+def search_datasets(dataset_key, cache_dir = model.DATASET_CACHE_DIR,
+                    validation_size = VALIDATION_SIZE):
+    """
+    Split the cached training Dataset into the rows the trials are trained
+    on and the validation rows they are ranked on, which is the same split
+    in every process.
+    Inputs
+        dataset_key: string, from model.make_datasets() or model.train_model()
+        cache_dir: string (optional)
+        validation_size: float (optional)
+    Outputs
+        datasets: dict, from model.make_datasets(), with the "search" Dataset
+                  and the X_valid and y_valid arrays
+    """
+    datasets = model.make_datasets(dataset_key = dataset_key, cache_dir = cache_dir)
+    datasets = model.split_validation(datasets, validation_size)
+    datasets["search"] = datasets["fit"]
+    return datasets
+
+# Trials, which run in the worker processes.
+_DATASETS = {} # The datasets loaded by each worker process, keyed by dataset_key.
+
+def _run_trial(args):
+    # Must be at the module level to be pickled.
+    config, rounds, dataset_key, cache_dir, threads, base = args
+    if dataset_key not in _DATASETS:
+        _DATASETS[dataset_key] = search_datasets(dataset_key, cache_dir)
+    datasets = _DATASETS[dataset_key]
+
+    def mae(X, y):
+        return float(np.mean(np.abs(model.y_descaler(y, base) -
+                                    model.y_descaler(booster.predict(X), base))))
+
+    start_time = perf_counter()
+    params, _ = model.to_booster_params(dict(config, n_jobs = threads))
+    booster = lgb.train(params, datasets["search"], rounds)
+    return {"config_id": config_id(config),
+            "params": config,
+            "rounds": rounds,
+            "score": mae(datasets["X_valid"], datasets["y_valid"]),
+            "test_score": mae(datasets["X_test"], datasets["y_test"]),
+            "time": perf_counter() - start_time}
+
+# History of the trials.
+def load_history(history_path):
+    """
+    Load the trials recorded in a json lines history file.
+    Inputs
+        history_path: string
+    Outputs
+        history: list of dict
+    """
+    if history_path is None or not os.path.exists(history_path):
+        return []
+    with open(history_path) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+def run_trials(configs, rounds, dataset_key,
+               n_jobs = 1, threads_per_trial = 1, base = 10,
+               history_path = None, cache_dir = model.DATASET_CACHE_DIR):
+    """
+    Train every configuration for the given number of boosting rounds, and
+    score it by the mean absolute error on the validation rows, along with
+    the test_score on the test split. Trials already in the history are not
+    run again.
+    Inputs
+        configs: list of dict
+        rounds: int
+        dataset_key: string, from model.make_datasets() or model.train_model()
+        n_jobs: int (optional), the number of processes
+        threads_per_trial: int (optional)
+        base: int (optional)
+        history_path: string (optional)
+        cache_dir: string (optional)
+    Outputs
+        trials: list of dict
+    """
+    done = {(t["config_id"], t["rounds"]): t for t in load_history(history_path)}
+    trials = [done[(config_id(c), rounds)] for c in configs if (config_id(c), rounds) in done]
+    todo = [(c, rounds, dataset_key, cache_dir, threads_per_trial, base)
+            for c in configs if (config_id(c), rounds) not in done]
+
+    def record(trial):
+        trials.append(trial)
+        if history_path is not None:
+            with open(history_path, "a") as fp:
+                fp.write(json.dumps(trial) + "\n")
+
+    if n_jobs is None or n_jobs <= 1:
+        for args in todo:
+            record(_run_trial(args))
+    else:
+        with ProcessPoolExecutor(max_workers = n_jobs) as executor:
+            for trial in executor.map(_run_trial, todo):
+                record(trial)
+    return trials
+
+# Search strategies.
+def successive_halving(configs, dataset_key,
+                       min_rounds = 25, max_rounds = 1000, eta = 3,
+                       n_jobs = 1, threads_per_trial = 1, base = 10,
+                       history_path = None, cache_dir = model.DATASET_CACHE_DIR,
+                       verbose = True):
+    """
+    Successive halving: train all configurations with min_rounds boosting
+    rounds, keep the best 1 / eta, and multiply the rounds by eta, until
+    max_rounds is reached or one configuration is left.
+    Inputs
+        configs: list of dict
+        dataset_key: string
+        min_rounds, max_rounds: int (optional)
+        eta: int (optional)
+        n_jobs, threads_per_trial: int (optional)
+        base: int (optional)
+        history_path, cache_dir: string (optional)
+        verbose: bool (optional)
+    Outputs
+        trials: list of dict, every trial of every rung
+    """
+    all_trials = []
+    rounds = min_rounds
+    while True:
+        trials = run_trials(configs, rounds, dataset_key, n_jobs, threads_per_trial, base,
+                            history_path, cache_dir)
+        all_trials.extend(trials)
+        trials = sorted(trials, key = lambda t: t["score"])
+        if verbose == True:
+            print("{} configs with {} rounds, best score: {:.2f}.".format(
+                len(configs), rounds, trials[0]["score"]))
+
+        if len(configs) <= 1 or rounds >= max_rounds:
+            return all_trials
+        configs = [t["params"] for t in trials[:max(1, len(configs) // eta)]]
+        rounds = min(rounds * eta, max_rounds)
+
+def hyperband(dataset_key,
+              search_space = SEARCH_SPACE,
+              min_rounds = 25, max_rounds = 1000, eta = 3,
+              n_jobs = 1, threads_per_trial = 1, base = 10,
+              history_path = None, cache_dir = model.DATASET_CACHE_DIR,
+              random_state = None, verbose = True):
+    """
+    Hyperband: run successive halving brackets which start from fewer
+    configurations with more rounds each. The same random_state gives the
+    same configurations, so a search resumed from its history_path only runs
+    the trials that are missing.
+    Inputs
+        dataset_key: string, from model.make_datasets() or model.train_model()
+        search_space: dict (optional)
+        min_rounds, max_rounds: int (optional)
+        eta: int (optional)
+        n_jobs, threads_per_trial: int (optional)
+        base: int (optional)
+        history_path, cache_dir: string (optional)
+        random_state: int (optional)
+        verbose: bool (optional)
+    Outputs
+        best_params: dict
+        history: DataFrame, every trial sorted by the validation score, with
+                 the unbiased test_score of each
+    """
+    rng = np.random.default_rng(random_state)
+    s_max = int(math.floor(math.log(max_rounds / min_rounds, eta) + 1e-9))
+
+    trials = []
+    for s in range(s_max, -1, -1):
+        n_configs = int(math.ceil((s_max + 1) / (s + 1) * eta ** s))
+        rounds = int(round(max_rounds * eta ** (-s)))
+        if verbose == True:
+            print("Bracket {}: {} configs starting with {} rounds.".format(s, n_configs, rounds))
+        configs = sample_configs(n_configs, search_space, rng)
+        trials.extend(successive_halving(configs, dataset_key, rounds, max_rounds, eta,
+                                         n_jobs, threads_per_trial, base, history_path,
+                                         cache_dir, verbose))
+
+    history = pd.DataFrame(trials).sort_values("score").reset_index(drop = True)
+    # Prefer configurations trained with the full number of rounds.
+    full = history[history["rounds"] == history["rounds"].max()]
+    best_params = dict(full.iloc[0]["params"], n_estimators = int(full.iloc[0]["rounds"]))
+    if verbose == True:
+        print("Best config: validation score {:.2f}, test score {:.2f}.".format(
+            full.iloc[0]["score"], full.iloc[0]["test_score"]))
+    return best_params, history
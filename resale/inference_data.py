@@ -1,17 +1,40 @@
 # Make data for inference.
 
+import threading
+
 import numpy as np
 
 from . import clean_data
 from . import geocode
 
-# Fixed constants.
-ADDRESS_DICT = geocode.load_geocoded_addresses_json()
+# The geocoded addresses are parsed on first use instead of at import, so that
+# importing this module stays fast. Use get_address_dict().
+_ADDRESS_DICT = None
+_ADDRESS_DICT_LOCK = threading.Lock()
+
+def get_address_dict():
+    """
+    The geocoded addresses, loaded once from the json file by the first caller.
+    Outputs
+        address_dict: dict
+    """
+    global _ADDRESS_DICT
+    if _ADDRESS_DICT is None:
+        with _ADDRESS_DICT_LOCK:
+            if _ADDRESS_DICT is None:
+                _ADDRESS_DICT = geocode.load_geocoded_addresses_json()
+    return _ADDRESS_DICT
+
+def __getattr__(name):
+    # Keep inference_data.ADDRESS_DICT working, loaded on first access.
+    if name == "ADDRESS_DICT":
+        return get_address_dict()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 # Functions to prepare inputs for inference.
 def make_inference_data(address = None, latitude = None, longitude = None, flat_type = None, storey_range = None, age = None):
     if address is not None:
-        latitude, longitude = address_to_latlon(address, ADDRESS_DICT)
+        latitude, longitude = address_to_latlon(address)
     flat_type = clean_data.flat_type_formatter(flat_type)
     storey_range = clean_data.storey_range_formatter(storey_range)
     
@@ -24,16 +47,21 @@ def make_inference_data(address = None, latitude = None, longitude = None, flat_
     
     return np.array([[latitude, longitude, flat_type, storey_range, age]])
     
-def address_to_latlon(address, address_dict = ADDRESS_DICT):
+def address_to_latlon(address, address_dict = None):
     """
     Using the pre-geocoded addresses stored in the json file, get the latitude and longitude
     of an address.
     Inputs
         address: string
+        address_dict: dict (optional), defaults to get_address_dict()
     Outputs
         latitude, longitude
     """
+    if address_dict is None:
+        address_dict = get_address_dict()
     latlon = address_dict.get(address, None)
+    if latlon is None:
+        raise KeyError("Address not geocoded: {}.".format(address))
     
     return latlon["latitude"], latlon["longitude"]
 
@@ -0,0 +1,486 @@
+# A local HTTP inference server which predicts concurrent requests in batches.
+
+# The Streamlit app predicts one flat per user interaction, so under load the
+# model gets many concurrent single row predictions, each paying the whole
+# overhead of a LightGBM call. Instead, this server collects the rows of
+# concurrent requests into micro-batches. A batch is predicted with one
+# vectorized call when it is full, or when its first row has waited for the
+# latency budget, and the results are fanned back out to the waiting requests.
+# While a batch is predicted in a background thread, the next one is collected.
+
+# When more rows are waiting than max_queue, new requests are rejected with
+# 503 at once instead of queueing without bound, so that the latency of the
+# accepted requests stays bounded and clients can back off. A request with
+# more rows than max_queue could never be accepted, and gets 413 instead.
+
+# HTTP/1.1 with keep-alive is served with asyncio streams from the standard
+# library, so the server and its load test run locally without extra packages:
+#     python -m resale serve --model model.txt --port 8000 --max-latency-ms 5
+#     curl -d '{"address": "...", "flat_type": "4 ROOM", "storey_range": "04 TO 06",
+#               "age": 30}' localhost:8000/predict
+#     curl localhost:8000/metrics
+#     python -m resale serve --model model.txt --load-test 10000 --concurrency 64
+
+import argparse
+import asyncio
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sys
+import time
+
+import numpy as np
+
+# Relative imports.
+from . import inference_data
+from . import model
+
+# Fixed constants for the default server settings.
+HOST = "127.0.0.1"
+PORT = 8000
+MAX_BATCH_SIZE = 256
+MAX_LATENCY = 0.005 # Seconds the first row of a batch may wait for more rows.
+MAX_QUEUE = 4096 # Rows waiting to be predicted before requests are rejected.
+MAX_BODY = 2 ** 20 # Bytes.
+METRICS_WINDOW = 10000 # The number of recent rows and batches in the metrics.
+# The fields of a request, which are the arguments of inference_data.make_inference_data().
+FIELDS = ["address", "latitude", "longitude", "flat_type", "storey_range", "age"]
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large",
+           500: "Internal Server Error", 503: "Service Unavailable"}
+
+class Overloaded(Exception):
+    """
+    Raised when the queue of a MicroBatcher is full.
+    """
+    pass
+
+class MicroBatcher:
+    """
+    Collects rows predicted concurrently into batches for one vectorized call.
+    """
+    def __init__(self, predict, max_batch_size = MAX_BATCH_SIZE, max_latency = MAX_LATENCY,
+                 max_queue = MAX_QUEUE):
+        """
+        Inputs
+            predict: function, mapping an array (n_samples, n_features) to
+                     an array (n_samples,), called in a background thread
+            max_batch_size: int (optional)
+            max_latency: float (optional), seconds
+            max_queue: int (optional)
+        """
+        self.predict_fn = predict
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.max_queue = max_queue
+        self.queue = deque()
+        self.event = None
+        self.task = None
+        # One thread, so that the batches are predicted one after another.
+        self.executor = ThreadPoolExecutor(max_workers = 1)
+        self.metrics = {"rows": 0, "batches": 0, "rejected": 0, "errors": 0}
+        self.latencies = deque(maxlen = METRICS_WINDOW)
+        self.predict_times = deque(maxlen = METRICS_WINDOW)
+        self.batch_sizes = deque(maxlen = METRICS_WINDOW)
+        self.start_time = time.perf_counter()
+
+    def start(self):
+        """
+        Start collecting batches, from within the running event loop.
+        """
+        self.event = asyncio.Event()
+        self.start_time = time.perf_counter()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self.executor.shutdown(wait = True)
+
+    async def predict(self, X):
+        """
+        Predict rows together with the rows of other concurrent calls.
+        Inputs
+            X: array (n_samples, n_features)
+        Outputs
+            y: array (n_samples,)
+        """
+        if len(X) > self.max_queue:
+            # Would be rejected however empty the queue is.
+            raise ValueError("{} rows are more than the {} rows which can be queued.".format(
+                len(X), self.max_queue))
+        if len(self.queue) + len(X) > self.max_queue:
+            self.metrics["rejected"] += len(X)
+            raise Overloaded("{} rows are waiting to be predicted.".format(len(self.queue)))
+        loop = asyncio.get_running_loop()
+        now = time.perf_counter()
+        futures = []
+        for x in X:
+            futures.append(loop.create_future())
+            self.queue.append((x, futures[-1], now))
+        # Only wake the collector for a new batch, or for a full one.
+        if len(self.queue) == len(X) or len(self.queue) >= self.max_batch_size:
+            self.event.set()
+        # gather() also retrieves the exceptions of the rows of a failed batch.
+        return np.array(await asyncio.gather(*futures))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while len(self.queue) == 0:
+                self.event.clear()
+                await self.event.wait()
+            # Wait for more rows until the batch is full, or until the first
+            # row has waited for the latency budget. Rows which arrived while
+            # the previous batch was predicted are usually already due.
+            deadline = self.queue[0][2] + self.max_latency
+            while len(self.queue) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                self.event.clear()
+                try:
+                    await asyncio.wait_for(self.event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            batch = [self.queue.popleft()
+                     for _ in range(min(len(self.queue), self.max_batch_size))]
+            X = np.vstack([x for x, _, _ in batch])
+            start = time.perf_counter()
+            try:
+                y = await loop.run_in_executor(self.executor, self.predict_fn, X)
+            except Exception as e:
+                self.metrics["errors"] += len(batch)
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            end = time.perf_counter()
+
+            for (_, future, queued), value in zip(batch, y):
+                # The future is cancelled if its client has gone away.
+                if not future.done():
+                    future.set_result(float(value))
+                self.latencies.append(end - queued)
+            self.metrics["rows"] += len(batch)
+            self.metrics["batches"] += 1
+            self.batch_sizes.append(len(batch))
+            self.predict_times.append(end - start)
+
+    def stats(self):
+        """
+        The counters, and the latency and batch size percentiles of the most
+        recent rows and batches.
+        Outputs
+            stats: dict
+        """
+        uptime = time.perf_counter() - self.start_time
+        stats = dict(self.metrics, queue = len(self.queue), uptime = uptime,
+                     rows_per_second = self.metrics["rows"] / uptime if uptime > 0 else 0.0)
+        for name, values, scale in [("latency_ms", self.latencies, 1000),
+                                    ("predict_ms", self.predict_times, 1000),
+                                    ("batch_size", self.batch_sizes, 1)]:
+            if len(values) > 0:
+                values = np.array(values) * scale
+                stats[name] = {"mean": float(values.mean()),
+                               "p50": float(np.percentile(values, 50)),
+                               "p95": float(np.percentile(values, 95)),
+                               "p99": float(np.percentile(values, 99)),
+                               "max": float(values.max())}
+        return stats
+
+# A minimal HTTP/1.1 implementation, enough for JSON requests with keep-alive.
+async def read_message(reader):
+    """
+    Read an HTTP request or response.
+    Inputs
+        reader: asyncio.StreamReader
+    Outputs
+        start_line: list of string, e.g. ["POST", "/predict", "HTTP/1.1"],
+                    or None if the connection was closed
+        headers: dict, with lower case names
+        body: bytes
+    """
+    line = await reader.readline()
+    if len(line) == 0:
+        return None, {}, b""
+    start_line = line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in [b"\r\n", b"\n", b""]:
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > MAX_BODY:
+        raise ValueError("The body is larger than {} bytes.".format(MAX_BODY))
+    body = await reader.readexactly(length) if length > 0 else b""
+    return start_line, headers, body
+
+def format_response(status, payload, keep_alive = True):
+    """
+    Inputs
+        status: int
+        payload: dict, sent as JSON
+        keep_alive: bool (optional)
+    Outputs
+        response: bytes
+    """
+    body = json.dumps(payload).encode()
+    head = ("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+            "Connection: {}\r\n\r\n").format(status, REASONS[status], len(body),
+                                             "keep-alive" if keep_alive else "close")
+    return head.encode() + body
+
+def parse_rows(body):
+    """
+    Turn the JSON body of a request, one flat or a list of flats with the
+    FIELDS, into feature rows.
+    Inputs
+        body: bytes
+    Outputs
+        X: array (n_samples, n_features)
+        single: bool, whether the body was one flat rather than a list
+    """
+    flats = json.loads(body)
+    single = isinstance(flats, dict)
+    if single == True:
+        flats = [flats]
+    if not isinstance(flats, list) or len(flats) == 0:
+        raise ValueError("Expected a flat or a list of flats.")
+    rows = []
+    for flat in flats:
+        unknown = set(flat) - set(FIELDS)
+        if len(unknown) > 0:
+            raise ValueError("Unknown fields: {}.".format(", ".join(sorted(unknown))))
+        row = inference_data.make_inference_data(**flat)
+        if row[0, 2] < 0: # The error value of unknown flat types.
+            raise ValueError("Unknown flat_type: {}.".format(flat.get("flat_type")))
+        rows.append(row)
+    return np.vstack(rows), single
+
+class InferenceServer:
+    """
+    Serves POST /predict, GET /metrics and GET /health.
+    """
+    def __init__(self, m, base = 10, host = HOST, port = PORT, max_batch_size = MAX_BATCH_SIZE,
+                 max_latency = MAX_LATENCY, max_queue = MAX_QUEUE):
+        """
+        Inputs
+            m: lgb.Booster, LGBMRegressor or tree_predictor.TreePredictor
+            base: int (optional), the base of model.y_scaler() used for the target
+            host: string (optional)
+            port: int (optional), 0 for any free port
+            max_batch_size, max_latency, max_queue: see MicroBatcher
+        """
+        self.model = m
+        self.base = base
+        self.host = host
+        self.port = port
+        self.batcher = MicroBatcher(self._predict, max_batch_size, max_latency, max_queue)
+        self.status_counts = Counter()
+        self.server = None
+
+    def _predict(self, X):
+        return model.y_descaler(self.model.predict(X), self.base)
+
+    async def start(self):
+        # Load the geocoded addresses now rather than in the first request.
+        inference_data.get_address_dict()
+        self.batcher.start()
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+
+    async def serve_forever(self):
+        await self.start()
+        print("Serving on http://{}:{}.".format(self.host, self.port))
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+
+    def stats(self):
+        """
+        Outputs
+            stats: dict, the batcher stats and the responses by status
+        """
+        return dict(self.batcher.stats(), requests = sum(self.status_counts.values()),
+                    responses = {str(k): v for k, v in sorted(self.status_counts.items())})
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    start_line, headers, body = await read_message(reader)
+                except ValueError as e:
+                    writer.write(format_response(400, {"error": str(e)}, keep_alive = False))
+                    break
+                if start_line is None or len(start_line) < 2:
+                    break
+                status, payload = await self._route(start_line[0], start_line[1], body)
+                self.status_counts[status] += 1
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(format_response(status, payload, keep_alive))
+                await writer.drain()
+                if keep_alive == False:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, body):
+        path = path.split("?")[0]
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        if method == "GET" and path == "/metrics":
+            return 200, self.stats()
+        if method != "POST" or path != "/predict":
+            return 404, {"error": "Not found: {} {}.".format(method, path)}
+        try:
+            X, single = parse_rows(body)
+        except (ValueError, TypeError, KeyError) as e:
+            return 400, {"error": str(e.args[0]) if len(e.args) > 0 else str(e)}
+        if len(X) > self.batcher.max_queue:
+            return 413, {"error": "At most {} flats can be predicted per request.".format(
+                self.batcher.max_queue)}
+        try:
+            prices = await self.batcher.predict(X)
+        except Overloaded as e:
+            return 503, {"error": str(e)}
+        except Exception as e:
+            return 500, {"error": str(e)}
+        if single == True:
+            return 200, {"price": float(prices[0])}
+        return 200, {"prices": prices.tolist()}
+
+# Load testing.
+def make_payloads(n = 1000, random_state = None):
+    """
+    Random requests for geocoded addresses.
+    Inputs
+        n: int (optional)
+        random_state: int (optional)
+    Outputs
+        payloads: list of dict
+    """
+    rng = np.random.default_rng(random_state)
+    addresses = list(inference_data.get_address_dict().keys())
+    flat_types = ["2 ROOM", "3 ROOM", "4 ROOM", "5 ROOM", "EXECUTIVE"]
+    storey_ranges = ["01 TO 03", "04 TO 06", "07 TO 09", "10 TO 12", "13 TO 15"]
+    payloads = []
+    for _ in range(n):
+        payload = {"flat_type": flat_types[rng.integers(len(flat_types))],
+                   "storey_range": storey_ranges[rng.integers(len(storey_ranges))],
+                   "age": int(rng.integers(0, 55))}
+        if len(addresses) > 0:
+            payload["address"] = addresses[rng.integers(len(addresses))]
+        else:
+            payload["latitude"] = float(rng.uniform(1.28, 1.45))
+            payload["longitude"] = float(rng.uniform(103.7, 103.95))
+        payloads.append(payload)
+    return payloads
+
+async def load_test(host, port, payloads, n_requests = 10000, concurrency = 64):
+    """
+    Send single flat requests from concurrent keep-alive connections.
+    Inputs
+        host: string
+        port: int
+        payloads: list of dict, sent in turn
+        n_requests: int (optional)
+        concurrency: int (optional), the number of connections
+    Outputs
+        results: dict, with the requests per second and the latencies seen by
+                 the clients
+    """
+    requests = []
+    for payload in payloads:
+        body = json.dumps(payload).encode()
+        requests.append(("POST /predict HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\n"
+                         "Content-Length: {}\r\n\r\n").format(host, len(body)).encode() + body)
+    latencies = []
+    statuses = Counter()
+
+    async def client(i, n):
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for j in range(n):
+                start = time.perf_counter()
+                writer.write(requests[(i + j * concurrency) % len(requests)])
+                await writer.drain()
+                start_line, _, _ = await read_message(reader)
+                latencies.append(time.perf_counter() - start)
+                statuses[int(start_line[1])] += 1
+        finally:
+            writer.close()
+
+    counts = [n_requests // concurrency + (i < n_requests % concurrency)
+              for i in range(concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(*[client(i, n) for i, n in enumerate(counts) if n > 0])
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {"requests": n_requests, "time": elapsed, "requests_per_second": n_requests / elapsed,
+            "latency_ms": {"p50": float(np.percentile(latencies, 50)),
+                           "p95": float(np.percentile(latencies, 95)),
+                           "p99": float(np.percentile(latencies, 99)),
+                           "max": float(latencies.max())},
+            "responses": {str(k): v for k, v in sorted(statuses.items())}}
+
+async def _serve_and_load_test(server, n_requests, concurrency):
+    await server.start()
+    try:
+        results = await load_test(server.host, server.port, make_payloads(random_state = 0),
+                                  n_requests, concurrency)
+    finally:
+        await server.stop()
+    return results, server.stats()
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "python -m resale serve",
+                                     description = "Serve predictions over HTTP in micro-batches.")
+    parser.add_argument("--model", default = None,
+                        help = "a LightGBM model file, a TreePredictor .npz file or a model "
+                               "registry directory, defaults to the current registry model")
+    parser.add_argument("--base", default = "10", choices = ["10", "e"])
+    parser.add_argument("--host", default = HOST)
+    parser.add_argument("--port", type = int, default = PORT)
+    parser.add_argument("--max-batch-size", type = int, default = MAX_BATCH_SIZE)
+    parser.add_argument("--max-latency-ms", type = float, default = MAX_LATENCY * 1000)
+    parser.add_argument("--max-queue", type = int, default = MAX_QUEUE)
+    parser.add_argument("--load-test", type = int, default = None, metavar = "N_REQUESTS",
+                        help = "serve on a free port, send N_REQUESTS requests and exit")
+    parser.add_argument("--concurrency", type = int, default = 64)
+    args = parser.parse_args(argv)
+
+    # Imported here, as batch_scoring is only needed to load the model.
+    from . import batch_scoring
+    server = InferenceServer(batch_scoring.load_model(args.model), 10 if args.base == "10" else "e",
+                             args.host, 0 if args.load_test is not None else args.port,
+                             args.max_batch_size, args.max_latency_ms / 1000, args.max_queue)
+    if args.load_test is None:
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    results, stats = asyncio.run(_serve_and_load_test(server, args.load_test, args.concurrency))
+    print("Client: {}".format(json.dumps(results, indent = 2)))
+    print("Server: {}".format(json.dumps(stats, indent = 2)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
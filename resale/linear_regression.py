@@ -1,8 +1,16 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from scipy.optimize import linprog
 from sklearn.metrics import r2_score
 
+# Fixed constants. Normal matrices with a larger condition number are treated
+# as singular by the recursive least squares updates.
+RLS_MAX_CONDITION = 1e8
+
 # Helper functions.
 def diff_month(d1, d2):
     """
@@ -32,6 +40,20 @@ def month_to_G(year_month, start_year_month):
     # Don't forget the "+1". We count from 1.
     return diff_month(year_month, start_year_month) + 1
 
+def months_to_G(year_month, start_year_month):
+    """
+    Vectorized version of month_to_G() for a whole column of dates.
+    Inputs
+        year_month: Series of datetime
+        start_year_month: datetime
+    Outputs
+        months: array of int
+    """
+    year_month = pd.DatetimeIndex(year_month)
+    months = (year_month.year - start_year_month.year) * 12 
+    months = months + (year_month.month - start_year_month.month) + 1
+    return np.asarray(months, dtype = int)
+
 def G_to_month(x, start_year = 2015):
     """
     Convert data from the linear inversion format back to the month format.
@@ -58,11 +80,95 @@ def least_squares(G, d):
     m = np.dot(m, d)
     return m
 
-def l1_norm_inversion(G, d, sd = None):
+def l1_norm_inversion(G, d, sd = None, formulation = "dual"):
     """
     Linear inversion using L1 norm error instead of mean squared error for
     over determined problems.
     The inversion problem is transformed into a linear programming problem
+    and solved with HiGHS using the linprog() function from scipy.optimize.
+    
+    The default "dual" formulation maximizes d'u subject to G'u = 0 and 
+    |u| <= 1 / sd, which has only M equality constraints and native bounds.
+    The model parameters are the marginals of the equality constraints.
+    The "primal" formulation minimizes the sum of the errors e subject to
+    -e <= (d - Gm) <= e with sparse constraint matrices. Both give the same
+    solution as dense_l1_norm_inversion(), at a fraction of the cost.
+    
+    Inputs
+        G: np.array
+        d: np.array
+        sd: np.array
+        formulation: string (optional)
+        
+    Returns
+        mest_l1: np.array
+    """
+    # If the std of the measurement d was not provided,
+    # set it to 1.
+    if sd is None:
+        sd = np.ones(len(d))
+    
+    N, M = np.shape(G)
+    
+    if formulation == "dual" and N >= M:
+        res = linprog(-d, A_eq = G.T, b_eq = np.zeros(M), 
+                      bounds = np.column_stack([-1 / sd, 1 / sd]), method = "highs")
+        return -res.eqlin.marginals
+    
+    # Primal formulation with x = [m, e].
+    f = np.concatenate([np.zeros(M), 1 / sd])
+    G = sparse.csr_matrix(G)
+    I = sparse.identity(N, format = "csr")
+    A = sparse.vstack([sparse.hstack([G, -I]), sparse.hstack([-G, -I])], format = "csr")
+    b = np.concatenate([d, -d])
+    
+    # As before we use the least squares solution for the bounds of the 
+    # model parameters.
+    mls = np.linalg.lstsq(G.toarray(), d, rcond = None)[0]
+    mupperbound = 10 * np.max(np.abs(mls))
+    bounds = [(-mupperbound, mupperbound)] * M + [(0, None)] * N
+    
+    res = linprog(f, A, b, bounds = bounds, method = "highs")
+    return res["x"][:M]
+
+def _l1_norm_inversion_rows(args):
+    # Worker for batch_l1_norm_inversion(). Must be at the module level to be pickled.
+    G, D, mask = args
+    return np.vstack([l1_norm_inversion(G[mask[i]], D[i, mask[i]]) for i in range(len(D))])
+
+def batch_l1_norm_inversion(G, D, mask = None, n_jobs = 1, chunk_size = 16):
+    """
+    L1 norm inversion of every row of D, with a process pool of n_jobs workers.
+    Inputs
+        G: array (n_months, n_params)
+        D: array (n_groups, n_months)
+        mask: array of bool (n_groups, n_months) (optional)
+        n_jobs: int (optional), -1 uses all CPUs
+        chunk_size: int (optional), rows of D sent to a worker at a time
+    Outputs
+        M: array (n_groups, n_params)
+    """
+    D = np.asarray(D, dtype = float)
+    if mask is None:
+        mask = np.isfinite(D)
+    
+    chunks = [(G, D[i:i+chunk_size], mask[i:i+chunk_size]) 
+              for i in range(0, len(D), chunk_size)]
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+        
+    if n_jobs is None or n_jobs <= 1 or len(chunks) <= 1:
+        results = [_l1_norm_inversion_rows(c) for c in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers = n_jobs) as executor:
+            results = list(executor.map(_l1_norm_inversion_rows, chunks))
+    return np.vstack(results)
+
+def dense_l1_norm_inversion(G, d, sd = None):
+    """
+    The original dense formulation of l1_norm_inversion(), which is kept as 
+    a reference for the benchmarks.
+    The inversion problem is transformed into a linear programming problem
     and solved using the linprog() function from scipy.optimize.
     See Geophysical Data Analysis: Discrete Inverse Theory MATLAB Edition
     Third Edition by William Menke pages 153-157 for more details.
@@ -123,6 +229,416 @@ def l1_norm_inversion(G, d, sd = None):
     mest_l1 = res['x'][:M] - res['x'][M:2*M]
     return mest_l1
 
+# Polynomial kernels for the batched linear regression models.
+# "vander" is the raw np.vander() kernel of month counts. It becomes very ill
+# conditioned at high orders as the columns grow like months ** (order - 1).
+# "scaled" maps the months onto [-1, 1] before taking powers, and "legendre"
+# uses Legendre polynomials on [-1, 1], whose columns are nearly orthogonal.
+BASES = ["vander", "scaled", "legendre"]
+
+def make_basis(months, vander_order = 4, basis = "legendre", domain = None):
+    """
+    Build the polynomial kernel G for an array of month counts.
+    For "vander" and "scaled" the columns are in decreasing powers like 
+    np.vander(), while for "legendre" they are in increasing degree.
+    Inputs
+        months: array
+        vander_order: int (optional)
+        basis: string (optional)
+        domain: tuple (optional)
+    Outputs
+        G: array
+    """
+    months = np.asarray(months, dtype = float)
+    if basis == "vander":
+        return np.vander(months, vander_order)
+    
+    # Map the months linearly onto [-1, 1]. The domain must be stored with the
+    # model coefficients, or the kernel cannot be rebuilt later.
+    if domain is None:
+        domain = (months.min(), months.max())
+    lo, hi = domain
+    x = (2 * months - (lo + hi)) / max(hi - lo, 1)
+    
+    if basis == "scaled":
+        return np.vander(x, vander_order)
+    elif basis == "legendre":
+        return np.polynomial.legendre.legvander(x, vander_order - 1)
+    else:
+        raise ValueError("Unknown basis {}, use one of {}.".format(basis, BASES))
+
+def batch_least_squares(G, D, mask = None, chunk_size = 1024):
+    """
+    Linear least squares inversion of many data vectors sharing one kernel G,
+    for example the monthly median prices of every location at once.
+    Rows of D with no missing months are solved together with a single
+    multiple right hand side lstsq() call. The remaining rows are solved with
+    a stacked QR decomposition of the masked kernels, where missing months 
+    become zero rows which do not contribute to the solution. Rows with fewer
+    months than model parameters fall back to the minimum norm solution.
+    Inputs
+        G: array (n_months, n_params)
+        D: array (n_groups, n_months)
+        mask: array of bool (n_groups, n_months) (optional)
+        chunk_size: int (optional)
+    Outputs
+        M: array (n_groups, n_params)
+    """
+    D = np.asarray(D, dtype = float)
+    if mask is None:
+        mask = np.isfinite(D)
+    mask = np.asarray(mask, dtype = bool)
+    D = np.where(mask, D, 0.0)
+    
+    n_groups, n_months = D.shape
+    n_params = G.shape[1]
+    M = np.zeros([n_groups, n_params])
+    
+    n_valid = mask.sum(axis = 1)
+    full = n_valid == n_months
+    if full.any():
+        M[full] = np.linalg.lstsq(G, D[full].T, rcond = None)[0].T
+    
+    partial = np.flatnonzero(~full & (n_valid >= n_params))
+    for i in range(0, len(partial), chunk_size):
+        # Chunk the stacked kernels to bound the memory used.
+        idx = partial[i:i+chunk_size]
+        Gs = mask[idx, :, None] * G[None, :, :]
+        Q, R = np.linalg.qr(Gs)
+        QTd = np.einsum("gnp,gn->gp", Q, D[idx])
+        M[idx] = np.linalg.solve(R, QTd[:, :, None])[:, :, 0]
+    
+    for i in np.flatnonzero(~full & (n_valid < n_params)):
+        M[i] = np.linalg.lstsq(G[mask[i]], D[i, mask[i]], rcond = None)[0]
+        
+    return M
+
+def batch_weighted_least_squares(G, D, W, chunk_size = 1024):
+    """
+    Weighted linear least squares inversion of every row of D, with the 
+    weights in the matching row of W. Each row is solved with a stacked QR
+    decomposition of sqrt(W) * G. Zero weights act like missing months.
+    Inputs
+        G: array (n_months, n_params)
+        D: array (n_groups, n_months)
+        W: array (n_groups, n_months)
+        chunk_size: int (optional)
+    Outputs
+        M: array (n_groups, n_params)
+    """
+    sqrt_W = np.sqrt(W)
+    D = np.where(W > 0, D, 0.0) * sqrt_W
+    n_groups, n_params = len(D), G.shape[1]
+    M = np.zeros([n_groups, n_params])
+    
+    n_valid = (W > 0).sum(axis = 1)
+    solvable = np.flatnonzero(n_valid >= n_params)
+    for i in range(0, len(solvable), chunk_size):
+        idx = solvable[i:i+chunk_size]
+        Q, R = np.linalg.qr(sqrt_W[idx, :, None] * G[None, :, :])
+        QTd = np.einsum("gnp,gn->gp", Q, D[idx])
+        M[idx] = np.linalg.solve(R, QTd[:, :, None])[:, :, 0]
+    
+    for i in np.flatnonzero(n_valid < n_params):
+        M[i] = np.linalg.lstsq(sqrt_W[i, :, None] * G, D[i], rcond = None)[0]
+    return M
+
+# Selection of the polynomial order with closed form cross validation.
+ORDER_CRITERIA = ["loo", "gcv"]
+# The lowest order considered, a constant and a slope, shared by adjust_price.
+MIN_ORDER = 2
+
+def batch_order_selection(G, D, mask = None, min_order = MIN_ORDER, criterion = "loo", 
+                          increasing = True, chunk_size = 256):
+    """
+    Choose the polynomial order of the least squares model of every row of D,
+    among the orders min_order to n_params of the kernel G, without refitting.
+    The kernels of lower orders are the leading columns of G (with columns in
+    increasing degree), so a single QR decomposition of each masked kernel 
+    gives the nested orthonormal bases of all orders. The fitted values and 
+    the diagonal h of the hat matrix of order p are then cumulative sums over 
+    the first p columns of Q, and the scores are either the leave-one-out 
+    error mean((r / (1 - h)) ** 2) or the generalized cross validation error
+    mean(r ** 2) / (1 - p / n) ** 2.
+    Inputs
+        G: array (n_months, n_params)
+        D: array (n_groups, n_months)
+        mask: array of bool (n_groups, n_months) (optional)
+        min_order: int (optional)
+        criterion: string (optional)
+        increasing: bool (optional), False if the columns of G are in decreasing
+                    powers, like np.vander()
+        chunk_size: int (optional)
+    Outputs
+        M: array (n_groups, n_params), zero for the unused columns
+        order: array of int (n_groups,)
+        scores: array (n_groups, n_params), inf for orders that were not scored
+    """
+    if criterion not in ORDER_CRITERIA:
+        raise ValueError("Unknown criterion {}, use one of {}.".format(criterion, ORDER_CRITERIA))
+    if increasing == False:
+        G = G[:, ::-1]
+        
+    D = np.asarray(D, dtype = float)
+    if mask is None:
+        mask = np.isfinite(D)
+    mask = np.asarray(mask, dtype = bool)
+    D = np.where(mask, D, 0.0)
+    
+    n_groups, n_params = len(D), G.shape[1]
+    n_valid = mask.sum(axis = 1)
+    M = np.zeros([n_groups, n_params])
+    scores = np.full([n_groups, n_params], np.inf)
+    order = np.zeros(n_groups, dtype = int)
+    
+    for i in range(0, n_groups, chunk_size):
+        idx = np.arange(i, min(i + chunk_size, n_groups))
+        Q, R = np.linalg.qr(mask[idx, :, None] * G[None, :, :])
+        c = np.einsum("gnp,gn->gp", Q, D[idx])
+        
+        # Fitted values and hat matrix diagonals of every order, (groups, months, orders).
+        fitted = np.cumsum(Q * c[:, None, :], axis = 2)
+        h = np.cumsum(Q ** 2, axis = 2)
+        residuals = np.where(mask[idx, :, None], D[idx, :, None] - fitted, 0.0)
+        n = np.maximum(n_valid[idx], 1)[:, None]
+        p = np.arange(1, n_params + 1)[None, :]
+        
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            if criterion == "loo":
+                loo = np.where(mask[idx, :, None], residuals / (1 - h), 0.0)
+                chunk_scores = np.sum(loo ** 2, axis = 1) / n
+            else:
+                chunk_scores = np.sum(residuals ** 2, axis = 1) / n / (1 - p / n) ** 2
+        # Orders with too few months for cross validation are not scored.
+        chunk_scores = np.where((p >= min_order) & (p < n) & np.isfinite(chunk_scores), 
+                                chunk_scores, np.inf)
+        scores[idx] = chunk_scores
+        
+        # Groups without any scored order fall back to the largest order they can fit.
+        chunk_order = np.argmin(chunk_scores, axis = 1) + 1
+        unscored = ~np.isfinite(chunk_scores).any(axis = 1)
+        chunk_order[unscored] = np.clip(n_valid[idx][unscored], 1, n_params)
+        order[idx] = chunk_order
+        
+        # The coefficients of order p only need the leading p x p block of R.
+        for p_ in np.unique(chunk_order):
+            sel = np.flatnonzero((chunk_order == p_) & (n_valid[idx] > 0))
+            M[idx[sel], :p_] = np.linalg.solve(R[sel, :p_, :p_], c[sel, :p_, None])[:, :, 0]
+    
+    if increasing == False:
+        M = M[:, ::-1]
+    return M, order, scores
+
+# Robust losses for iteratively reweighted least squares.
+IRLS_LOSSES = ["huber", "l1"]
+
+def batch_irls(G, D, mask = None, loss = "huber", delta = 1.345, max_iter = 100, 
+               tol = 1e-4, verbose = False):
+    """
+    Iteratively reweighted least squares for every row of D at once, with
+    a Huber or L1 loss. Starting from the least squares solution, the months
+    with large residuals are down weighted and the weighted least squares 
+    problems of all groups are solved together, until the models of every
+    group stop changing. Converged groups are not solved again.
+    For the Huber loss, residuals beyond delta robust standard deviations 
+    (1.4826 x the median absolute deviation) are down weighted.
+    Inputs
+        G: array (n_months, n_params)
+        D: array (n_groups, n_months)
+        mask: array of bool (n_groups, n_months) (optional)
+        loss: string (optional)
+        delta: float (optional)
+        max_iter: int (optional)
+        tol: float (optional), relative change of the model to stop at
+        verbose: bool (optional)
+    Outputs
+        M: array (n_groups, n_params)
+        info: dict, with the "n_iter" and "converged" of each group
+    """
+    if loss not in IRLS_LOSSES:
+        raise ValueError("Unknown loss {}, use one of {}.".format(loss, IRLS_LOSSES))
+    
+    D = np.asarray(D, dtype = float)
+    if mask is None:
+        mask = np.isfinite(D)
+    mask = np.asarray(mask, dtype = bool)
+    D = np.where(mask, D, 0.0)
+    
+    M = batch_least_squares(G, D, mask)
+    n_iter = np.zeros(len(D), dtype = int)
+    converged = np.zeros(len(D), dtype = bool)
+    active = np.arange(len(D))
+    
+    for i in range(max_iter):
+        residuals = np.where(mask[active], D[active] - np.dot(M[active], G.T), np.nan)
+        abs_residuals = np.abs(residuals)
+        scale = 1.4826 * np.nanmedian(np.abs(residuals - np.nanmedian(residuals, axis = 1)[:, None]), 
+                                      axis = 1)
+        # Guard against perfect fits, where the scale is zero.
+        scale = np.maximum(scale, 1e-9 * np.maximum(np.nanmax(np.abs(D[active]), axis = 1), 1))
+        
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            if loss == "huber":
+                W = np.minimum(1, delta * scale[:, None] / abs_residuals)
+            else:
+                W = 1 / np.maximum(abs_residuals, 1e-3 * scale[:, None])
+        W = np.where(mask[active], W, 0.0)
+        
+        M_new = batch_weighted_least_squares(G, D[active], W)
+        change = np.max(np.abs(M_new - M[active]), axis = 1)
+        change = change / np.maximum(np.max(np.abs(M_new), axis = 1), 1e-12)
+        M[active] = M_new
+        n_iter[active] += 1
+        
+        done = change < tol
+        converged[active[done]] = True
+        active = active[~done]
+        if verbose == True:
+            print("IRLS iteration {}: {} groups not converged.".format(i + 1, len(active)))
+        if len(active) == 0:
+            break
+    
+    return M, {"n_iter": n_iter, "converged": converged}
+
+def huber_regression(G, d):
+    """
+    Linear inversion with the Huber loss, using iteratively reweighted least squares.
+    Inputs
+        G: array
+        d: array
+    Outputs
+        m: array
+    """
+    return batch_irls(G, d[None, :], loss = "huber")[0][0]
+
+def l1_irls(G, d):
+    """
+    Linear inversion with the L1 norm loss, using iteratively reweighted least squares.
+    An approximation of l1_norm_inversion() at close to least squares cost.
+    Inputs
+        G: array
+        d: array
+    Outputs
+        m: array
+    """
+    return batch_irls(G, d[None, :], loss = "l1")[0][0]
+
+# Recursive least squares, for updating batched models with new months of data.
+def batch_normal_equations(G, D, mask = None):
+    """
+    Sufficient statistics of the least squares problem for every row of D:
+    the normal matrix A = G'G, b = G'd and its inverse P, along with the sum
+    of squares dd, sum sd and number sw of the data, used for the R2.
+    Inputs
+        G: array (n_months, n_params)
+        D: array (n_groups, n_months)
+        mask: array of bool (n_groups, n_months) (optional)
+    Outputs
+        statistics: dict
+    """
+    D = np.asarray(D, dtype = float)
+    if mask is None:
+        mask = np.isfinite(D)
+    D = np.where(mask, D, 0.0)
+    
+    A = np.einsum("gn,np,nq->gpq", mask.astype(float), G, G)
+    statistics = {"A": A,
+                  "b": np.dot(D, G),
+                  # Groups with too few months have singular normal matrices,
+                  # whose pseudo-inverse is not used by batch_rls_update().
+                  "P": np.linalg.pinv(A, hermitian = True),
+                  "dd": np.sum(D ** 2, axis = 1),
+                  "sd": np.sum(D, axis = 1),
+                  "sw": mask.sum(axis = 1).astype(float)}
+    return statistics
+
+def batch_rls_update(M, statistics, codes, g, d, forgetting = 1.0):
+    """
+    Recursive least squares update of the models M with one new data point 
+    per group, in O(n_params ** 2) per group. With a forgetting factor < 1 the
+    weight of the existing data of every group decays by that factor first, 
+    so that each call corresponds to one step forward in time. M and the
+    statistics are updated in place.
+    The recursion needs P to be an accurate inverse of A, so groups whose 
+    normal matrix was singular or nearly so before the new data, e.g. with 
+    fewer months than parameters, are re-solved from A and b instead.
+    Inputs
+        M: array (n_groups, n_params)
+        statistics: dict, from batch_normal_equations()
+        codes: array of int (k,), the groups with new data
+        g: array (k, n_params), the kernel rows of the new data
+        d: array (k,), the new data
+        forgetting: float (optional)
+    """
+    if forgetting != 1.0:
+        for key in ["A", "b", "dd", "sd", "sw"]:
+            statistics[key] *= forgetting
+        statistics["P"] /= forgetting
+    
+    full_rank = np.linalg.cond(statistics["A"][codes]) < RLS_MAX_CONDITION
+    rls, solve = codes[full_rank], codes[~full_rank]
+    
+    P = statistics["P"][rls]
+    Pg = np.einsum("kpq,kq->kp", P, g[full_rank])
+    K = Pg / (1 + np.einsum("kp,kp->k", g[full_rank], Pg))[:, None]
+    residuals = d[full_rank] - np.einsum("kp,kp->k", g[full_rank], M[rls])
+    
+    M[rls] += K * residuals[:, None]
+    statistics["P"][rls] = P - K[:, :, None] * Pg[:, None, :]
+    statistics["A"][codes] += g[:, :, None] * g[:, None, :]
+    statistics["b"][codes] += g * d[:, None]
+    statistics["dd"][codes] += d ** 2
+    statistics["sd"][codes] += d
+    statistics["sw"][codes] += 1
+    
+    if len(solve) > 0:
+        P = np.linalg.pinv(statistics["A"][solve], hermitian = True)
+        statistics["P"][solve] = P
+        M[solve] = np.einsum("kpq,kq->kp", P, statistics["b"][solve])
+
+def r2_from_statistics(M, statistics):
+    """
+    The R2 of the models M over all data summarized in the statistics.
+    Inputs
+        M: array (n_groups, n_params)
+        statistics: dict
+    Outputs
+        r2: array (n_groups,)
+    """
+    ss_res = (statistics["dd"] - 2 * np.einsum("gp,gp->g", M, statistics["b"]) + 
+              np.einsum("gp,gpq,gq->g", M, statistics["A"], M))
+    ss_tot = statistics["dd"] - statistics["sd"] ** 2 / np.maximum(statistics["sw"], 1e-12)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        r2 = np.where(ss_tot > 0, 1 - ss_res / ss_tot, 1.0)
+    return r2
+
 # Metrics
 def r2(d, G, m):
     return r2_score(d, np.dot(G, m))
+
+def batch_r2(G, D, M, mask = None):
+    """
+    The coefficient of determination for every row of D at once. Rows with
+    no variance get 1 for a perfect fit and 0 otherwise, like r2_score().
+    Inputs
+        G: array (n_months, n_params)
+        D: array (n_groups, n_months)
+        M: array (n_groups, n_params)
+        mask: array of bool (n_groups, n_months) (optional)
+    Outputs
+        r2: array (n_groups,)
+    """
+    D = np.asarray(D, dtype = float)
+    if mask is None:
+        mask = np.isfinite(D)
+    D = np.where(mask, D, 0.0)
+    n = np.maximum(mask.sum(axis = 1), 1)
+    
+    residuals = np.where(mask, D - np.dot(M, G.T), 0.0)
+    ss_res = np.sum(residuals ** 2, axis = 1)
+    mean = D.sum(axis = 1) / n
+    ss_tot = np.sum(np.where(mask, D - mean[:, None], 0.0) ** 2, axis = 1)
+    
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        r2 = np.where(ss_tot > 0, 1 - ss_res / ss_tot, np.where(ss_res > 0, 0.0, 1.0))
+    return r2
@@ -1,7 +1,12 @@
 # Load processed resale flat price data.
 
 import os
-import pandas as pd
+
+# Relative imports.
+from . import profiling
+
+# pandas is imported inside the loading functions, so that modules which only
+# need the constants and the formatters below import quickly.
 
 # Fixed constants indicating the raw data stored on GitHub.
 DATA_DIR = "https://github.com/natsunoyuki/resale-flat-prices/blob/main/processed%20data/"
@@ -13,6 +18,7 @@ CURR_PATH = os.path.dirname(__file__)
 LOCAL_DATA_DIR = os.path.join(CURR_PATH, "../processed data/")
 
 # Functions for loading resale price data.
+@profiling.profile
 def load_data(online = True, data_dir = DATA_DIR, data_file = DATA_FILE, suffix = SUFFIX,
               local_data_dir = LOCAL_DATA_DIR):
     """
@@ -22,6 +28,7 @@ def load_data(online = True, data_dir = DATA_DIR, data_file = DATA_FILE, suffix
     Outputs
         data: DataFrame
     """
+    import pandas as pd
     if online == True:
         try:
             # Try to load from GitHub.
@@ -63,6 +70,7 @@ def load_local_data(data_dir = LOCAL_DATA_DIR + DATA_FILE, compression = "zip"):
     Outputs
         df: DataFrame
     """
+    import pandas as pd
     print("Loading data from disk...")
     return pd.read_csv(data_dir, compression = compression)
 
@@ -79,9 +87,11 @@ def mth_from_month(x):
     return int(x[5:])
 
 # Functions for loading misc. data such as the resale price index.
+@profiling.profile
 def load_resale_price_index(online = True, data_dir = DATA_DIR, 
                             data_file = "resale_price_index.csv.zip",
                             suffix = SUFFIX, local_data_dir = LOCAL_DATA_DIR):
+    import pandas as pd
     if online == True:
         try:
             # Try to load from GitHub.
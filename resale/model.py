@@ -1,15 +1,40 @@
 # Use Abominable Intelligence to predict resale flat prices.
 
-from lightgbm import LGBMRegressor
+import hashlib
+import json
+import os
+from time import perf_counter
+
+# lightgbm and sklearn are imported inside the functions which use them, as
+# they are slow to import and not needed to scale targets or build X and y.
 import numpy as np
-from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
-from sklearn.model_selection import train_test_split, GridSearchCV
+
+# Relative imports.
+from . import tree_predictor
+from . import profiling
 
 # Fixed constants for the training features and target to use.
 #FEATURES = ["lat", "lon", "flat_type_num", "storey_range_num", "age"]
 FEATURES = ["latitude", "longitude", "flat_type_num", "storey_range_num", "age"]
 TARGET = "price_per_sqm_adj"
 
+# Fixed constants for the default model parameters. n_estimators is the maximum 
+# number of boosting rounds, as training stops early on the validation set.
+MODEL_PARAMS = {"n_estimators": 1000, "num_leaves": 2 ** 5, "max_depth": 5, 
+                "objective": "huber"}
+# Parameters which change the binning of the LightGBM Dataset. Pre-filtering 
+# is disabled so that one Dataset can be reused with any min_data_in_leaf.
+DATASET_PARAMS = {"max_bin": 255, "min_data_in_bin": 3, "feature_pre_filter": False}
+# The fraction of the training rows held out to stop boosting early, so that
+# the test rows are not used to choose the number of boosting rounds.
+VALIDATION_SIZE = 0.2
+# LGBMRegressor parameters which lgb.train() does not know.
+SKLEARN_ONLY_PARAMS = ["importance_type", "class_weight"]
+
+# Fixed constants for the cached LightGBM binary datasets on local disk.
+CURR_PATH = os.path.dirname(__file__)
+DATASET_CACHE_DIR = os.path.join(CURR_PATH, "../cache/datasets/")
+
 # Functions to scale the target variable.
 def y_scaler(x, base = 10):
     """
@@ -32,6 +57,7 @@ def y_descaler(y, base = 10):
     return y
 
 # Functions to create X and y.
+@profiling.profile
 def make_Xy(df, features = FEATURES, target = TARGET, scale_y = False, base = 10):
     """
     Inputs
@@ -46,41 +72,358 @@ def make_Xy(df, features = FEATURES, target = TARGET, scale_y = False, base = 10
     """
     X = df[features]
     
+    # Scale the whole column at once rather than row by row.
+    y = df[target].values
     if scale_y == True:
-        y = df[target].apply(y_scaler, args = (base,))
-    else:
-        y = df[target]
+        y = y_scaler(y.astype(float), base)
         
-    return X.values, y.values
+    return X.values, y
+
+# Functions to cache the binned LightGBM datasets.
+def fingerprint(X, y, **kwargs):
+    """
+    A hash of the feature matrix, the target and any other settings, used to 
+    key the cached datasets.
+    Inputs
+        X: array, or None if the data is identified by a setting instead
+        y: array, or None
+        kwargs: settings which change the datasets, e.g. test_size
+    Outputs
+        key: string
+    """
+    h = hashlib.sha1()
+    for a in [X, y]:
+        if a is None:
+            continue
+        a = np.ascontiguousarray(a)
+        h.update(str((a.shape, a.dtype.str)).encode())
+        h.update(a.view(np.uint8).ravel() if a.dtype != object else a.astype(float).tobytes())
+    h.update(json.dumps(kwargs, sort_keys = True, default = str).encode())
+    return h.hexdigest()[:16]
+
+@profiling.profile
+def make_datasets(X = None, y = None, 
+                  test_size = 0.25, 
+                  random_state = None,
+                  dataset_params = DATASET_PARAMS,
+                  dataset_key = None, 
+                  cache_dir = DATASET_CACHE_DIR,
+                  feature_key = None,
+                  store_dir = None):
+    """
+    Split X and y into train and test sets, and bin them into LightGBM
+    Datasets. The datasets are saved in binary form under cache_dir, keyed
+    by the fingerprint of X, y and the settings, and are loaded from there
+    when they exist. With a dataset_key from an earlier call, X and y are not
+    needed at all. With a feature_key, X and y are read from the float32
+    feature store (see feature_store.materialize()), and the split arrays are
+    kept in float32.
+    The split arrays are saved with the datasets in the dtype of X and always
+    returned memory-mapped, so that the trainers of the same data on one
+    machine share one copy through the page cache.
+    Inputs
+        X: array (optional)
+        y: array (optional)
+        test_size: float (optional)
+        random_state: int (optional)
+        dataset_params: dict (optional)
+        dataset_key: string (optional)
+        cache_dir: string (optional)
+        feature_key: string (optional), instead of X and y
+        store_dir: string (optional), the feature store directory
+    Outputs
+        datasets: dict, with the key, the "train" and "valid" (test) Datasets, 
+                  and the memory-mapped X_train, X_test, y_train, y_test arrays
+    """
+    import lightgbm as lgb
+    from sklearn.model_selection import train_test_split
+    if dataset_key is None and feature_key is not None:
+        # The feature key is already a hash of the data.
+        dataset_key = fingerprint(None, None, feature_key = feature_key, test_size = test_size,
+                                  random_state = random_state, dataset_params = dataset_params)
+    elif dataset_key is None:
+        dataset_key = fingerprint(X, y, test_size = test_size, random_state = random_state,
+                                  dataset_params = dataset_params)
+    path = os.path.join(cache_dir, dataset_key)
+    params = dict(dataset_params, verbose = -1)
+    
+    if not os.path.exists(os.path.join(path, "valid.bin")):
+        if X is None and feature_key is not None:
+            from . import feature_store
+            X, y, _ = feature_store.load(feature_key, store_dir or feature_store.FEATURE_STORE_DIR)
+        elif X is None:
+            raise FileNotFoundError("No cached datasets {} in {}.".format(dataset_key, cache_dir))
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size = test_size, 
+                                                            random_state = random_state)
+        train_set = lgb.Dataset(X_train, y_train, params = params)
+        valid_set = lgb.Dataset(X_test, y_test, params = params, reference = train_set)
+        train_set.construct()
+        valid_set.construct()
+        
+        os.makedirs(path, exist_ok = True)
+        arrays = {"X_train": X_train, "X_test": X_test, "y_train": y_train, "y_test": y_test}
+        for name, a in arrays.items():
+            a = np.asarray(a)
+            np.save(os.path.join(path, name + ".npy"), a if a.dtype != object else a.astype(float))
+        train_set.save_binary(os.path.join(path, "train.bin"))
+        # Written last, as its existence marks a complete cache entry.
+        valid_set.save_binary(os.path.join(path, "valid.bin"))
+    
+    # Load the binned datasets and the memory-mapped arrays from disk.
+    train_set = lgb.Dataset(os.path.join(path, "train.bin"), params = params)
+    valid_set = lgb.Dataset(os.path.join(path, "valid.bin"), params = params,
+                            reference = train_set)
+    datasets = {"key": dataset_key, "train": train_set, "valid": valid_set}
+    for name in ["X_train", "X_test", "y_train", "y_test"]:
+        datasets[name] = np.load(os.path.join(path, name + ".npy"), mmap_mode = "r")
+    return datasets
+
+def split_validation(datasets, validation_size = VALIDATION_SIZE):
+    """
+    Split the training Dataset into the rows boosting is fitted on and the 
+    validation rows, which is the same split in every process.
+    Inputs
+        datasets: dict, from make_datasets()
+        validation_size: float (optional)
+    Outputs
+        datasets: dict, with the "fit" and "early_stopping" Datasets and the
+                  X_valid and y_valid arrays
+    """
+    n = len(datasets["y_train"])
+    valid = np.zeros(n, dtype = bool)
+    valid[np.random.default_rng(0).permutation(n)[:int(round(n * validation_size))]] = True
+    # Subsets keep the bins of the cached Dataset, without binning again.
+    train_set = datasets["train"].construct()
+    datasets["fit"] = train_set.subset(np.flatnonzero(~valid))
+    datasets["early_stopping"] = train_set.subset(np.flatnonzero(valid))
+    datasets["X_valid"] = datasets["X_train"][valid]
+    datasets["y_valid"] = datasets["y_train"][valid]
+    return datasets
+
+def to_booster_params(model_params):
+    """
+    Convert LGBMRegressor parameters to lgb.train() parameters.
+    Inputs
+        model_params: dict
+    Outputs
+        params: dict
+        num_boost_round: int
+    """
+    params = {k: v for k, v in model_params.items() if k not in SKLEARN_ONLY_PARAMS}
+    num_boost_round = params.pop("n_estimators", 100)
+    if params.get("random_state", None) is not None:
+        params["seed"] = params.pop("random_state")
+    if "n_jobs" in params:
+        params["num_threads"] = params.pop("n_jobs")
+    params = {k: v for k, v in params.items() if v is not None}
+    params.setdefault("verbose", -1)
+    return params, num_boost_round
 
 # Functions to train the model and perform grid search cross validation if needed.
-def train_model(X, y,
+@profiling.profile
+def train_model(X = None, y = None,
                 grid_search = False,
                 grid_search_params = {"n_estimators" : [100, 200, 300, 400, 500]},
                 model = None, model_params = None,
-                random_state = None):
+                random_state = None,
+                test_size = 0.25,
+                early_stopping_rounds = 50,
+                n_jobs = None,
+                base = 10,
+                dataset_key = None,
+                cache_dir = DATASET_CACHE_DIR,
+                feature_key = None,
+                store_dir = None,
+                verbose = True):
     """
     Train a machine learning model to predict resale flat prices.
     Optional choice of performing a grid search to find the best performing model.
+    The data is split into train and test sets, binned once into cached
+    LightGBM binary datasets (see make_datasets()), and boosting stops early
+    when the error on a validation split of the training rows stops improving
+    (see split_validation()), so that the test metrics stay unbiased. 
+    Retraining with the returned 
+    dataset_key skips building X and y and the binning. With a feature_key
+    from feature_store.materialize(), X and y are read from the float32
+    feature store instead.
     
     Inputs
+        X: array (optional if dataset_key is given)
+        y: array (optional if dataset_key is given), scaled with y_scaler() 
+           using base, or unscaled with base = None
+        grid_search: bool (optional)
+        grid_search_params: dict (optional)
+        model: LGBMRegressor (optional), whose parameters are used
+        model_params: dict (optional), LGBMRegressor parameters
+        random_state: int (optional)
+        test_size: float (optional)
+        early_stopping_rounds: int (optional)
+        n_jobs: int (optional), the number of threads
+        base: int (optional)
+        dataset_key: string (optional)
+        cache_dir: string (optional)
+        feature_key: string (optional), instead of X and y
+        store_dir: string (optional), the feature store directory
+        verbose: bool (optional)
     Outputs
+        result: dict, with the trained "model" (a lgb.Booster), its "metrics"
+                from evaluate_model(), "best_iteration", "params", "dataset_key"
+                and "train_time"
     """
-    # Split into train and test sets.
-    X_train, X_test, y_train, y_test = train_test_split(X, y, random_state = random_state)
+    import lightgbm as lgb
+    start_time = perf_counter()
+    datasets = make_datasets(X, y, test_size, random_state, dataset_key = dataset_key, 
+                             cache_dir = cache_dir, feature_key = feature_key, 
+                             store_dir = store_dir)
+    datasets = split_validation(datasets)
+    
+    params = dict(MODEL_PARAMS, random_state = random_state)
+    if model is not None:
+        # Only the parameters set on the model, i.e. which differ from the 
+        # defaults, so that they do not reset MODEL_PARAMS.
+        defaults = type(model)().get_params()
+        params.update({k: v for k, v in model.get_params().items() 
+                       if k not in defaults or v != defaults[k]})
+    if model_params is not None:
+        params.update(model_params)
+    if random_state is not None:
+        params["random_state"] = random_state
+    if n_jobs is not None:
+        params["n_jobs"] = n_jobs
     
     if grid_search == True:
-        grid_search = grid_search_cv(X_train, y_train, grid_search_params, 5, random_state, True)
-        
-        # Use the best_estimator_ as the prediction model.
-        model = grid_search.best_estimator_
+        grid_search = grid_search_cv(datasets["X_train"], datasets["y_train"], 
+                                     grid_search_params, 5, random_state, verbose)
+        # Use the best parameters for the prediction model.
+        params.update(grid_search.best_params_)
+    
+    booster_params, num_boost_round = to_booster_params(params)
+    callbacks = [lgb.early_stopping(early_stopping_rounds, verbose = False)]
+    booster = lgb.train(booster_params, datasets["fit"], num_boost_round,
+                        valid_sets = [datasets["early_stopping"]], callbacks = callbacks)
+    train_time = perf_counter() - start_time
+    
+    metrics = evaluate_model(booster, datasets["X_train"], datasets["X_test"], 
+                             datasets["y_train"], datasets["y_test"], base, verbose)
+    if verbose == True:
+        print("Time elapsed for training: {:.2f} s, best iteration: {}.".format(
+            train_time, booster.best_iteration))
+    
+    result = {"model": booster,
+              "metrics": metrics,
+              "best_iteration": booster.best_iteration,
+              "params": params,
+              "dataset_key": datasets["key"],
+              "train_time": train_time}
+    return result
+
+@profiling.profile
+def update_model(booster, X_new, y_new,
+                 X_recent = None, y_recent = None,
+                 X = None, y = None,
+                 num_boost_round = 50,
+                 model_params = None,
+                 holdout = 0.25,
+                 tolerance = 0.02,
+                 random_state = None,
+                 base = 10,
+                 registry = None,
+                 verbose = True):
+    """
+    Update a trained model with new months of data by continuing boosting 
+    from it (init_model) on the new rows only, instead of retraining on the
+    whole history.
+    
+    A drift guard compares the mean absolute error of the previous and the
+    updated models on a recent window which is held out from the update. If 
+    the update is worse than the previous model by more than the tolerance,
+    the model is retrained from scratch with train_model() on the full history
+    X and y if they are given, and otherwise the previous model is kept.
+    
+    Inputs
+        booster: lgb.Booster or LGBMRegressor
+        X_new: array, the new rows
+        y_new: array, the new targets, adjusted to the latest month and scaled
+               with y_scaler() using base
+        X_recent, y_recent: array (optional), the recent window for the drift
+                            guard, defaults to a holdout fraction of the new rows
+        X, y: array (optional), the full history for the fallback retrain
+        num_boost_round: int (optional), the number of boosting rounds added
+        model_params: dict (optional), LGBMRegressor parameters, defaults to 
+                      those stored with the current version of the registry.
+                      Without either, the update continues with the native 
+                      parameters of the booster and a retrain uses MODEL_PARAMS
+        holdout: float (optional)
+        tolerance: float (optional), the relative increase of the error allowed
+        random_state: int (optional)
+        base: int (optional)
+        registry: ModelRegistry (optional), save the resulting model as a new 
+                  version, with its model_params
+        verbose: bool (optional)
+    Outputs
+        result: dict, with the "model" (a lgb.Booster), the "mode" ("update",
+                "retrain" or "keep"), the recent window "metrics", the 
+                "train_time", and the registry "version"
+    """
+    import lightgbm as lgb
+    from lightgbm import LGBMRegressor
+    from sklearn.model_selection import train_test_split
+    start_time = perf_counter()
+    booster = booster.booster_ if isinstance(booster, LGBMRegressor) else booster
+    # Continue from the best iteration, dropping the trees after it.
+    if 0 < booster.best_iteration < booster.current_iteration():
+        booster = lgb.Booster(model_str = booster.model_to_string(
+            num_iteration = booster.best_iteration))
+    
+    if X_recent is None:
+        X_new, X_recent, y_new, y_recent = train_test_split(X_new, y_new, test_size = holdout,
+                                                            random_state = random_state)
+    
+    if model_params is None and registry is not None and registry.current is not None:
+        model_params = registry.metadata().get("model_params", None)
+    if model_params is None:
+        # The booster's own parameters are lgb.train() keys, which only suit
+        # continuing it, not train_model().
+        update_params = {k: v for k, v in booster.params.items() 
+                         if k not in ["num_iterations", "max_bin", "min_data_in_bin", 
+                                      "feature_pre_filter"]} or MODEL_PARAMS
     else:
-        if model is None:
-            model = LGBMRegressor(**model_params)
-        
+        update_params = model_params
+    params, _ = to_booster_params(dict(update_params, random_state = random_state))
+    train_set = lgb.Dataset(X_new, y_new, params = dict(DATASET_PARAMS, verbose = -1))
+    updated = lgb.train(params, train_set, num_boost_round, init_model = booster)
+    
+    def recent_mae(m):
+        return float(np.mean(np.abs(y_descaler(y_recent, base) - 
+                                    y_descaler(m.predict(X_recent), base))))
+    
+    metrics = {"previous_mae": recent_mae(booster), "update_mae": recent_mae(updated)}
+    if metrics["update_mae"] <= metrics["previous_mae"] * (1 + tolerance):
+        mode, new_booster = "update", updated
+    elif X is not None:
+        mode = "retrain"
+        retrain = train_model(X, y, model_params = model_params, random_state = random_state, 
+                              base = base, verbose = False)
+        new_booster, model_params = retrain["model"], retrain["params"]
+        metrics["retrain_mae"] = recent_mae(new_booster)
+    else:
+        mode, new_booster = "keep", booster
+    train_time = perf_counter() - start_time
     
+    if verbose == True:
+        print("Recent window mae, previous: {}, update: {}. Mode: {}, {:.2f} s.".format(
+            int(metrics["previous_mae"]), int(metrics["update_mae"]), mode, train_time))
     
-    return
+    result = {"model": new_booster,
+              "mode": mode,
+              "metrics": metrics,
+              "train_time": train_time,
+              "version": None}
+    if registry is not None and mode != "keep":
+        result["version"] = registry.save(new_booster, {"mode": mode, "metrics": metrics,
+                                                        "n_new_rows": len(X_new),
+                                                        "model_params": model_params})
+    return result
 
 def grid_search_cv(X, y, grid_search_params = {"n_estimators" : [100, 200, 300, 400, 500]},
                    cv = 5, random_state = None, time = True):
@@ -99,37 +442,107 @@ def grid_search_cv(X, y, grid_search_params = {"n_estimators" : [100, 200, 300,
     Outputs
         grid_search: GridSearchCV
     """
+    from lightgbm import LGBMRegressor
+    from sklearn.model_selection import GridSearchCV
     model = LGBMRegressor(num_leaves = 2 ** 5, max_depth = 5, objective = "huber", 
                           random_state = random_state)
     grid_search = GridSearchCV(model, param_grid = grid_search_params, cv = cv)
     
-    if time == True:
-        start_time = time.time()
+    # Note that the time argument shadows the name of the time module.
+    start_time = perf_counter()
     
     grid_search.fit(X, y)
     
     if time == True:
-        print("Time elapsed for grid search cv: {:.2f} s.".format(time.time() - start_time))
+        print("Time elapsed for grid search cv: {:.2f} s.".format(perf_counter() - start_time))
         
     return grid_search
 
 # Functions to evaluate the model.
-def evaluate_model(model, X_train, X_test, y_train, y_test, base = 10):
+@profiling.profile
+def evaluate_model(model, X_train, X_test, y_train, y_test, base = 10, verbose = True):
+    """
+    Inputs
+        model: LGBMRegressor or lgb.Booster
+        X_train, X_test: array
+        y_train, y_test: array, scaled with y_scaler() using base
+        base: int (optional)
+        verbose: bool (optional)
+    Outputs
+        metrics: dict
+    """
+    from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
     y_train_pred = model.predict(X_train)
     y_test_pred = model.predict(X_test)
     
-    train_mae = mean_absolute_error(y_descaler(y_train, base), 
-                                    y_descaler(y_train_pred, base))
-    test_mae = mean_absolute_error(y_descaler(y_test, base), 
-                                   y_descaler(y_test_pred, base))
-    print("Train mae: {}, test mae: {}.".format(int(train_mae), int(test_mae)))
-
-    train_mse = np.sqrt(mean_squared_error(y_descaler(y_train, base), 
-                                           y_descaler(y_train_pred, base)))
-    test_mse = np.sqrt(mean_squared_error(y_descaler(y_test, base), 
-                                          y_descaler(y_test_pred, base)))
-    print("Train rmse: {}, test rmse: {}.".format(int(train_mse), int(test_mse)))
-
-    train_r2 = r2_score(y_train, y_train_pred)
-    test_r2 = r2_score(y_test, y_test_pred)
-    print("Test R2: {:.3f}, test R2: {:.3f}.".format(train_r2, test_r2))
+    # De-scale each array once.
+    p_train, p_train_pred = y_descaler(y_train, base), y_descaler(y_train_pred, base)
+    p_test, p_test_pred = y_descaler(y_test, base), y_descaler(y_test_pred, base)
+    
+    metrics = {"train_mae": mean_absolute_error(p_train, p_train_pred),
+               "test_mae": mean_absolute_error(p_test, p_test_pred),
+               "train_rmse": np.sqrt(mean_squared_error(p_train, p_train_pred)),
+               "test_rmse": np.sqrt(mean_squared_error(p_test, p_test_pred)),
+               "train_r2": r2_score(y_train, y_train_pred),
+               "test_r2": r2_score(y_test, y_test_pred)}
+    
+    if verbose == True:
+        print("Train mae: {}, test mae: {}.".format(int(metrics["train_mae"]), 
+                                                   int(metrics["test_mae"])))
+        print("Train rmse: {}, test rmse: {}.".format(int(metrics["train_rmse"]), 
+                                                     int(metrics["test_rmse"])))
+        print("Train R2: {:.3f}, test R2: {:.3f}.".format(metrics["train_r2"], 
+                                                         metrics["test_r2"]))
+    return metrics
+
+# Functions to export the model for low latency inference.
+def export_tree_predictor(model, num_iteration = None, path = None):
+    """
+    Convert a trained model into a tree_predictor.TreePredictor, which predicts
+    with NumPy only and has a much lower latency for small batches.
+    Inputs
+        model: LGBMRegressor or lgb.Booster
+        num_iteration: int (optional), defaults to the best iteration if any
+        path: string (optional), save the predictor as a .npz file
+    Outputs
+        predictor: TreePredictor
+    """
+    from lightgbm import LGBMRegressor
+    booster = model.booster_ if isinstance(model, LGBMRegressor) else model
+    dump = booster.dump_model(num_iteration = num_iteration)
+    if dump["num_class"] != 1:
+        raise ValueError("Only models with a single output can be exported.")
+
+    nodes = {"split_feature": [], "threshold": [], "default_left": [], "missing_type": [],
+             "children": [], "value": []}
+
+    def flatten(tree):
+        # Adds the node and its subtree, and returns the index of the node.
+        i = len(nodes["value"])
+        if "leaf_value" in tree:
+            # Leaves never split (the threshold is inf) and point to themselves.
+            for name, x in [("split_feature", 0), ("threshold", np.inf), ("default_left", True),
+                            ("missing_type", 0), ("value", tree["leaf_value"])]:
+                nodes[name].append(x)
+            nodes["children"].extend([i, i])
+            return i
+        if tree["decision_type"] != "<=":
+            raise ValueError("Categorical splits are not supported.")
+        nodes["split_feature"].append(tree["split_feature"])
+        nodes["threshold"].append(tree["threshold"])
+        nodes["default_left"].append(tree["default_left"])
+        nodes["missing_type"].append(tree_predictor.MISSING_TYPES.index(tree["missing_type"]))
+        nodes["value"].append(0.0)
+        nodes["children"].extend([0, 0])
+        nodes["children"][2 * i] = flatten(tree["left_child"])
+        nodes["children"][2 * i + 1] = flatten(tree["right_child"])
+        return i
+
+    roots = [flatten(tree["tree_structure"]) for tree in dump["tree_info"]]
+    predictor = tree_predictor.TreePredictor(roots, n_features = dump["max_feature_idx"] + 1,
+                                             objective = dump["objective"],
+                                             average_output = dump["average_output"],
+                                             **nodes)
+    if path is not None:
+        predictor.save(path)
+    return predictor
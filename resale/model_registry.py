@@ -0,0 +1,128 @@
+# Versioned storage of the trained LightGBM models.
+
+# Every trained or updated model is saved as a new version, a directory with
+# the LightGBM model text file and a json metadata file, and a CURRENT file
+# points to the version in use. Rolling back only rewrites CURRENT, so a bad
+# monthly update can be undone without retraining.
+
+import hashlib
+import json
+import os
+from datetime import datetime
+
+import lightgbm as lgb
+
+# Fixed constants for the files in the registry directory.
+CURR_PATH = os.path.dirname(__file__)
+MODEL_REGISTRY_DIR = os.path.join(CURR_PATH, "../cache/models/")
+MODEL_FILE = "model.txt"
+METADATA_FILE = "metadata.json"
+CURRENT_FILE = "CURRENT"
+
+class ModelRegistry:
+    """
+    A directory of model versions, ordered by the time they were saved.
+    """
+    def __init__(self, path = MODEL_REGISTRY_DIR):
+        """
+        Inputs
+            path: string (optional)
+        """
+        self.path = path
+        os.makedirs(path, exist_ok = True)
+
+    def versions(self):
+        """
+        The saved versions, oldest first.
+        Outputs
+            versions: list of string
+        """
+        return sorted(v for v in os.listdir(self.path)
+                      if os.path.exists(os.path.join(self.path, v, METADATA_FILE)))
+
+    @property
+    def current(self):
+        """
+        The version in use, or None for an empty registry.
+        """
+        path = os.path.join(self.path, CURRENT_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as fp:
+            return fp.read().strip()
+
+    def _set_current(self, version):
+        # Replacing the file is atomic, so readers never see a partial version.
+        tmp_path = os.path.join(self.path, CURRENT_FILE + ".tmp")
+        with open(tmp_path, "w") as fp:
+            fp.write(version)
+        os.replace(tmp_path, os.path.join(self.path, CURRENT_FILE))
+
+    def save(self, booster, metadata = {}, make_current = True):
+        """
+        Save a model as a new version.
+        Inputs
+            booster: lgb.Booster
+            metadata: dict (optional), e.g. the metrics and how it was trained
+            make_current: bool (optional)
+        Outputs
+            version: string, the time it was saved and a hash of the model
+        """
+        model_string = booster.model_to_string()
+        version = "{}-{}".format(datetime.now().strftime("%Y%m%d%H%M%S%f"),
+                                 hashlib.sha1(model_string.encode()).hexdigest()[:8])
+        path = os.path.join(self.path, version)
+        os.makedirs(path)
+        with open(os.path.join(path, MODEL_FILE), "w") as fp:
+            fp.write(model_string)
+        metadata = dict(metadata, version = version, parent = self.current,
+                        created = datetime.now().isoformat(timespec = "seconds"))
+        # The metadata is written last, as its existence marks a complete version.
+        with open(os.path.join(path, METADATA_FILE), "w") as fp:
+            json.dump(metadata, fp, default = str)
+        if make_current == True:
+            self._set_current(version)
+        return version
+
+    def load(self, version = None):
+        """
+        Load a model version.
+        Inputs
+            version: string (optional), defaults to the current version
+        Outputs
+            booster: lgb.Booster
+        """
+        if version is None:
+            version = self.current
+        if version is None:
+            raise FileNotFoundError("No models in {}.".format(self.path))
+        return lgb.Booster(model_file = os.path.join(self.path, version, MODEL_FILE))
+
+    def metadata(self, version = None):
+        """
+        Inputs
+            version: string (optional), defaults to the current version
+        Outputs
+            metadata: dict
+        """
+        if version is None:
+            version = self.current
+        with open(os.path.join(self.path, version, METADATA_FILE)) as fp:
+            return json.load(fp)
+
+    def rollback(self, version = None):
+        """
+        Make an earlier version the current one.
+        Inputs
+            version: string (optional), defaults to the parent of the current version
+        Outputs
+            version: string, the new current version
+        """
+        if version is None:
+            version = self.metadata().get("parent", None)
+            if version is None:
+                raise ValueError("The current version {} has no parent.".format(self.current))
+        if version not in self.versions():
+            raise KeyError(version)
+        self._set_current(version)
+        return version
@@ -15,32 +15,60 @@
 
 import os
 import json
-
-try:
-    from onemapsg import OneMapClient
-except:
-    print("onemapsg not found... Geocoding using OneMapClient will not run!")
-    print("https://pypi.org/project/onemapsg/")
+import threading
 
 # Fixed constants indicating the location of the credentials.
 CURR_PATH = os.path.dirname(__file__)
 PATH = os.path.join(CURR_PATH, "../OneMap2-Authentication-Module_for_MacOS/authentication_module/")
 FILE_NAME = "credentials.txt"
 
-with open(PATH + FILE_NAME) as f:
-    credentials = json.load(f)
-    
-USER_NAME = credentials["email"]
-PASSWORD = credentials["password"]
+# The credentials are only read when a client is first requested, so that
+# importing this module, and the modules importing it, needs neither the
+# credentials file nor onemapsg.
+_CREDENTIALS = None
+_CREDENTIALS_LOCK = threading.Lock()
 
-def get_onemapclient(user_name = USER_NAME, password = PASSWORD):
+def load_credentials(path = PATH, file_name = FILE_NAME):
+    """
+    Read the OneMap credentials once, and return the same dict afterwards.
+    Inputs
+        path, file_name: string (optional)
+    Outputs
+        credentials: dict, with the keys "email" and "password"
+    """
+    global _CREDENTIALS
+    with _CREDENTIALS_LOCK:
+        if _CREDENTIALS is None:
+            with open(os.path.join(path, file_name)) as f:
+                credentials = json.load(f)
+            for key in ["email", "password"]:
+                if key not in credentials:
+                    raise KeyError("{} missing from the OneMap credentials {}.".format(
+                        key, os.path.join(path, file_name)))
+            _CREDENTIALS = credentials
+        return _CREDENTIALS
+
+def get_onemapclient(user_name = None, password = None):
     """
     Creates a OneMapSg Client.
     Inputs
-        user_name, password: string
+        user_name, password: string (optional), read from the credentials
+                             file if not given
     Outputs
         Client: OneMapClient
     """
+    try:
+        from onemapsg import OneMapClient
+    except ImportError:
+        print("onemapsg not found... Geocoding using OneMapClient will not run!")
+        print("https://pypi.org/project/onemapsg/")
+        return None
+
+    if user_name is None or password is None:
+        credentials = load_credentials()
+        user_name = credentials["email"] if user_name is None else user_name
+        password = credentials["password"] if password is None else password
+
     try:
         Client = OneMapClient(user_name, password)
     except:
@@ -0,0 +1,159 @@
+# A shared memory backend for parallel per-group computations.
+
+# statistics, h3_statistics and adjust_price compute statistics per town, per
+# month or per H3 cell of one large DataFrame. Sending the DataFrame to the
+# workers of a process pool would pickle all of it for every task. Instead,
+# the frame is sorted by group once, so that every group is a contiguous range
+# of rows given by an offsets array, and the columns needed are saved as .npy
+# files in shared memory (/dev/shm where available), which every worker
+# memory-maps, so all the processes read the same physical pages. The tasks
+# sent to the workers are only ranges of groups [start, stop).
+
+# Memory-mapped files are used rather than multiprocessing.shared_memory, as
+# the resource tracker of Python < 3.13 unlinks or warns about the blocks
+# attached by the workers.
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# Fixed constants.
+SHARED_MEMORY_DIR = "/dev/shm"
+TASKS_PER_JOB = 4 # More tasks than workers, so that slow ranges do not finish last.
+
+class SharedFrame:
+    """
+    Columns of a DataFrame sorted by a group column, with the row offsets of
+    each group, which worker processes can read without copies.
+        with SharedFrame(df, "town", ["year_month", "resale_price"]) as frame:
+            results = map_groups(func, frame, n_jobs = 4)
+    """
+    def __init__(self, df, by, columns):
+        """
+        Inputs
+            df: DataFrame
+            by: string, the group column, rows with a missing group are dropped
+            columns: list, the numeric or datetime columns to share
+        """
+        codes, groups = pd.factorize(df[by], sort = True)
+        valid = np.flatnonzero(codes >= 0)
+        # A stable sort keeps the rows of each group in their original order.
+        order = valid[np.argsort(codes[valid], kind = "stable")]
+        counts = np.bincount(codes[valid], minlength = len(groups))
+
+        self.by = by
+        self.groups = np.asarray(groups)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.columns = {}
+        for column in columns:
+            values = np.asarray(df[column].values)
+            if values.dtype == object:
+                raise ValueError("Column {} is not numeric and cannot be shared.".format(column))
+            self.columns[column] = values[order]
+        self.path = None
+
+    @property
+    def n_groups(self):
+        return len(self.groups)
+
+    def share(self, dir = None):
+        """
+        Save the columns to shared memory, once.
+        Inputs
+            dir: string (optional), defaults to /dev/shm, else the temporary directory
+        Outputs
+            spec: dict, to attach() the columns in another process
+        """
+        if self.path is None:
+            if dir is None and os.path.isdir(SHARED_MEMORY_DIR):
+                dir = SHARED_MEMORY_DIR
+            self.path = tempfile.mkdtemp(prefix = "resale-", dir = dir)
+            # The files are numbered, as the column names may not be valid file names.
+            for i, values in enumerate(self.columns.values()):
+                np.save(os.path.join(self.path, "{}.npy".format(i)), values)
+        return {"path": self.path, "columns": list(self.columns), "offsets": self.offsets}
+
+    def close(self):
+        """
+        Delete the shared files.
+        """
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors = True)
+            self.path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+def attach(spec):
+    """
+    Memory-map the columns of a shared frame.
+    Inputs
+        spec: dict, from SharedFrame.share()
+    Outputs
+        columns: dict, mapping the column names to read-only arrays
+    """
+    return {column: np.load(os.path.join(spec["path"], "{}.npy".format(i)), mmap_mode = "r")
+            for i, column in enumerate(spec["columns"])}
+
+# The shared frame in the worker processes.
+_COLUMNS = None
+_OFFSETS = None
+
+def _init_worker(spec):
+    global _COLUMNS, _OFFSETS
+    _COLUMNS = attach(spec)
+    _OFFSETS = spec["offsets"]
+
+def _run_task(task):
+    # Must be at the module level to be pickled.
+    func, start, stop, args = task
+    return func(_COLUMNS, _OFFSETS, start, stop, *args)
+
+def split_groups(offsets, n_ranges):
+    """
+    Split the groups into contiguous ranges with about the same number of rows.
+    Inputs
+        offsets: array (n_groups + 1,)
+        n_ranges: int
+    Outputs
+        ranges: list of (start, stop)
+    """
+    targets = np.linspace(0, offsets[-1], n_ranges + 1)[1:-1]
+    bounds = np.unique(np.concatenate([[0], np.searchsorted(offsets, targets),
+                                       [len(offsets) - 1]]))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def map_groups(func, frame, args = (), n_jobs = 1, tasks_per_job = TASKS_PER_JOB):
+    """
+    Call func(columns, offsets, start, stop, *args) on ranges of groups of a
+    SharedFrame, in a process pool if n_jobs > 1. The rows of group i are
+    columns[name][offsets[i]:offsets[i + 1]], and func returns a list with
+    one result per group in [start, stop).
+    Inputs
+        func: function, at the module level so that it can be pickled
+        frame: SharedFrame
+        args: tuple (optional), more arguments of func, sent with every task
+        n_jobs: int (optional), -1 uses all CPUs
+        tasks_per_job: int (optional)
+    Outputs
+        results: list, with one result per group, in group order
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if n_jobs is None or n_jobs <= 1 or frame.n_groups <= 1:
+        return list(func(frame.columns, frame.offsets, 0, frame.n_groups, *args))
+
+    spec = frame.share()
+    tasks = [(func, start, stop, args)
+             for start, stop in split_groups(frame.offsets, n_jobs * tasks_per_job)]
+    with ProcessPoolExecutor(max_workers = n_jobs, initializer = _init_worker,
+                             initargs = (spec,)) as executor:
+        return [result for results in executor.map(_run_task, tasks) for result in results]
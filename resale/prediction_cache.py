@@ -0,0 +1,369 @@
+# Cache the predicted prices of repeated inference queries.
+
+# Users of the app repeatedly price the same blocks with the same flat type and
+# storey range. The predictions are cached in a bounded least recently used
+# (LRU) dict, keyed by the rounded feature row and the version of the model,
+# so that the popular blocks are served without touching the model at all.
+# Entries may also expire after a time to live (TTL), and an optional sqlite
+# file shares the cached predictions between worker processes. Several caches,
+# e.g. of different models, may share one file under their own namespaces.
+
+# CachedPredictor wraps a model and the geocoded addresses, and invalidates
+# the cache when either of them changes.
+
+from collections import OrderedDict
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+# Relative imports.
+from . import geocode
+from . import inference_data
+from . import model
+
+# Fixed constants for the normalization of the feature rows. Rows which are
+# the same to this many decimals share a cache entry.
+DECIMALS = 6
+# The fraction of max_size which may be written to the shared file before it
+# is counted and trimmed back to max_size.
+TRIM_FRACTION = 0.1
+
+# Versions of the inputs of the predictions.
+def model_version(m):
+    """
+    A hash of the trees of a model, which changes whenever it is retrained.
+    Inputs
+        m: LGBMRegressor, lgb.Booster or tree_predictor.TreePredictor
+    Outputs
+        version: string
+    """
+    m = getattr(m, "booster_", m)
+    h = hashlib.sha1()
+    if hasattr(m, "model_to_string"):
+        h.update(m.model_to_string().encode())
+    else:
+        for name in ["roots", "split_feature", "threshold", "children", "value"]:
+            h.update(np.ascontiguousarray(getattr(m, name)).tobytes())
+    return h.hexdigest()[:16]
+
+def file_version(path):
+    """
+    A cheap version of a file from its modification time and size.
+    Inputs
+        path: string
+    Outputs
+        version: string, or None if the file does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return "{}-{}".format(stat.st_mtime_ns, stat.st_size)
+
+def normalize_features(X, decimals = DECIMALS):
+    """
+    Round the feature rows, so that the same query always gets the same key.
+    Inputs
+        X: array (n_samples, n_features) or (n_features,)
+        decimals: int (optional)
+    Outputs
+        X: array (n_samples, n_features)
+    """
+    # Adding 0.0 turns -0.0 into 0.0, which have different bytes.
+    return np.round(np.atleast_2d(np.asarray(X, dtype = float)), decimals) + 0.0
+
+class PredictionCache:
+    """
+    A bounded LRU cache of predictions with an optional TTL, keyed by the
+    feature rows, and with hit rate metrics. The cache belongs to a single
+    version, and changing the version clears it.
+    """
+    def __init__(self, max_size = 100000, ttl = None, version = None, shared_path = None,
+                 namespace = "default", decimals = DECIMALS):
+        """
+        Inputs
+            max_size: int (optional), the maximum number of cached predictions
+            ttl: float (optional), seconds after which the predictions expire
+            version: string (optional), e.g. from model_version()
+            shared_path: string (optional), a sqlite file shared between processes
+            namespace: string (optional), the rows of the shared file owned by
+                       this cache, which is only ever cleared or trimmed within it
+            decimals: int (optional)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = version
+        self.namespace = namespace
+        self.decimals = decimals
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.metrics = {"hits": 0, "misses": 0, "shared_hits": 0, "evictions": 0,
+                        "expirations": 0, "invalidations": 0}
+
+        self.shared_path = shared_path
+        self.connection = None
+        # The rows written to the shared file since it was last counted.
+        self.shared_writes = 0
+        if shared_path is not None:
+            self.connection = sqlite3.connect(shared_path, timeout = 30,
+                                              check_same_thread = False)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS predictions "
+                                    "(namespace TEXT, version TEXT, key BLOB, value REAL, "
+                                    "time REAL, PRIMARY KEY (namespace, version, key))")
+            self.connection.commit()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def hit_rate(self):
+        n = self.metrics["hits"] + self.metrics["misses"]
+        return self.metrics["hits"] / n if n > 0 else 0.0
+
+    def stats(self):
+        """
+        The hit rate metrics.
+        Outputs
+            stats: dict
+        """
+        return dict(self.metrics, size = len(self.entries), hit_rate = self.hit_rate)
+
+    def set_version(self, version):
+        """
+        Change the version of the cache, which drops every cached prediction
+        of the old versions in its namespace.
+        Inputs
+            version: string
+        """
+        with self.lock:
+            if version == self.version:
+                return
+            self.version = version
+            self.entries.clear()
+            self.metrics["invalidations"] += 1
+            if self.connection is not None:
+                self.connection.execute("DELETE FROM predictions WHERE namespace = ? "
+                                        "AND version != ?", (self.namespace, str(version)))
+                self.connection.commit()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.connection is not None:
+                self.connection.execute("DELETE FROM predictions WHERE namespace = ?",
+                                        (self.namespace,))
+                self.connection.commit()
+
+    def keys(self, X):
+        """
+        The cache keys of the feature rows.
+        Inputs
+            X: array (n_samples, n_features)
+        Outputs
+            keys: list of bytes
+        """
+        return [row.tobytes() for row in normalize_features(X, self.decimals)]
+
+    def _get_shared(self, keys, now):
+        # Look up the keys missing locally in the shared sqlite file.
+        found = {}
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            rows = self.connection.execute(
+                "SELECT key, value, time FROM predictions WHERE namespace = ? AND version = ? "
+                "AND key IN ({})".format(",".join("?" * len(batch))),
+                [self.namespace, str(self.version)] + batch).fetchall()
+            for key, value, t in rows:
+                if self.ttl is None or now - t <= self.ttl:
+                    found[bytes(key)] = (value, t)
+        return found
+
+    def get(self, keys):
+        """
+        Look up the cached predictions.
+        Inputs
+            keys: list of bytes, from keys()
+        Outputs
+            values: array, NaN for the misses
+            found: array of bool, False for the misses
+        """
+        now = time.time()
+        values = np.full(len(keys), np.nan)
+        found = np.zeros(len(keys), dtype = bool)
+        missing = []
+        with self.lock:
+            for i, key in enumerate(keys):
+                entry = self.entries.get(key, None)
+                if entry is not None and self.ttl is not None and now - entry[1] > self.ttl:
+                    del self.entries[key]
+                    self.metrics["expirations"] += 1
+                    entry = None
+                if entry is None:
+                    missing.append(i)
+                else:
+                    self.entries.move_to_end(key)
+                    values[i] = entry[0]
+                    found[i] = True
+
+            if self.connection is not None and len(missing) > 0:
+                shared = self._get_shared([keys[i] for i in missing], now)
+                self.metrics["shared_hits"] += len(shared)
+                for i in missing:
+                    if keys[i] in shared:
+                        values[i] = shared[keys[i]][0]
+                        found[i] = True
+                        self._put_local(keys[i], shared[keys[i]])
+                missing = [i for i in missing if keys[i] not in shared]
+
+            self.metrics["hits"] += len(keys) - len(missing)
+            self.metrics["misses"] += len(missing)
+        return values, found
+
+    def _put_local(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last = False)
+            self.metrics["evictions"] += 1
+
+    def put(self, keys, values):
+        """
+        Cache predictions.
+        Inputs
+            keys: list of bytes, from keys()
+            values: array
+        """
+        now = time.time()
+        with self.lock:
+            for key, value in zip(keys, values):
+                self._put_local(key, (float(value), now))
+            if self.connection is not None:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)",
+                    [(self.namespace, str(self.version), key, float(value), now)
+                     for key, value in zip(keys, values)])
+                self.shared_writes += len(keys)
+                if self.shared_writes > self.max_size * TRIM_FRACTION:
+                    self._trim_shared()
+                self.connection.commit()
+
+    def _trim_shared(self):
+        # Keep the namespace bounded in the shared file too, dropping the 
+        # oldest entries once it has grown past max_size.
+        self.shared_writes = 0
+        n = self.connection.execute("SELECT COUNT(*) FROM predictions WHERE namespace = ?",
+                                    (self.namespace,)).fetchone()[0]
+        if n > self.max_size:
+            self.connection.execute(
+                "DELETE FROM predictions WHERE rowid IN (SELECT rowid FROM predictions "
+                "WHERE namespace = ? ORDER BY time DESC LIMIT -1 OFFSET ?)",
+                (self.namespace, self.max_size))
+
+    def predict(self, predict, X):
+        """
+        Predict the feature rows, calling predict() once for all the rows
+        which are not cached.
+        Inputs
+            predict: function, mapping an array (n_samples, n_features) to an
+                     array (n_samples,)
+            X: array (n_samples, n_features) or (n_features,)
+        Outputs
+            y: array (n_samples,)
+        """
+        # Only the keys are rounded, the model predicts the rows as given.
+        X = np.atleast_2d(np.asarray(X))
+        keys = self.keys(X)
+        y, found = self.get(keys)
+        missing = np.flatnonzero(~found)
+        if len(missing) > 0:
+            y[missing] = predict(X[missing])
+            self.put([keys[i] for i in missing], y[missing])
+        return y
+
+class CachedPredictor:
+    """
+    Predicts resale prices with a model, through a PredictionCache. The cache
+    is invalidated when the model is replaced with set_model(), or when the
+    geocoded addresses json file changes on disk.
+    """
+    def __init__(self, m, base = 10, cache = None,
+                 geocode_dir = geocode.DIR, geocode_json = geocode.GEOCODED_ADDRESSES,
+                 check_interval = 10):
+        """
+        Inputs
+            m: LGBMRegressor, lgb.Booster or tree_predictor.TreePredictor
+            base: int (optional), the base of model.y_scaler() used for the target
+            cache: PredictionCache (optional)
+            geocode_dir, geocode_json: string (optional)
+            check_interval: float (optional), seconds between checks of the
+                            geocoded addresses file
+        """
+        self.base = base
+        self.cache = PredictionCache() if cache is None else cache
+        self.geocode_dir = geocode_dir
+        self.geocode_json = geocode_json
+        self.check_interval = check_interval
+        self.last_check = -np.inf
+        self.address_dict = None
+        self.geocode_version = None
+        self.set_model(m)
+
+    def set_model(self, m):
+        """
+        Replace the model, e.g. after retraining.
+        Inputs
+            m: LGBMRegressor, lgb.Booster or tree_predictor.TreePredictor
+        """
+        self.model = m
+        self.model_version = model_version(m)
+        self.cache.set_version("{}/{}".format(self.model_version, self.geocode_version))
+
+    def check_geocode(self):
+        """
+        Reload the geocoded addresses if the json file has changed.
+        """
+        now = time.monotonic()
+        if now - self.last_check < self.check_interval and self.address_dict is not None:
+            return
+        self.last_check = now
+        version = file_version(os.path.join(self.geocode_dir, self.geocode_json))
+        if version != self.geocode_version or self.address_dict is None:
+            self.address_dict = geocode.load_geocoded_addresses_json(self.geocode_dir,
+                                                                     self.geocode_json)
+            self.geocode_version = version
+            self.cache.set_version("{}/{}".format(self.model_version, self.geocode_version))
+
+    def _predict(self, X):
+        return model.y_descaler(self.model.predict(X), self.base)
+
+    def predict(self, X):
+        """
+        Predict the resale prices of feature rows.
+        Inputs
+            X: array (n_samples, n_features) or (n_features,), see model.FEATURES
+        Outputs
+            prices: array (n_samples,)
+        """
+        self.check_geocode()
+        return self.cache.predict(self._predict, X)
+
+    def predict_query(self, address = None, latitude = None, longitude = None,
+                      flat_type = None, storey_range = None, age = None):
+        """
+        Predict the resale price of one flat, with the same inputs as
+        inference_data.make_inference_data(). Unknown flat types raise a
+        ValueError.
+        Outputs
+            price: float
+        """
+        self.check_geocode()
+        if address is not None:
+            latitude, longitude = inference_data.address_to_latlon(address, self.address_dict)
+        X = inference_data.make_inference_data(None, latitude, longitude, flat_type,
+                                               storey_range, age)
+        if X[0, 2] < 0: # The error value of unknown flat types.
+            raise ValueError("Unknown flat_type: {}.".format(flat_type))
+        return float(self.cache.predict(self._predict, X)[0])
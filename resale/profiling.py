@@ -0,0 +1,332 @@
+# Opt-in profiling and tracing of the pipeline stages.
+
+# The public stage functions are decorated with @profile, and any block of
+# code can be wrapped in `with span(name):`. While profiling is disabled, which
+# is the default, the decorator only checks a flag before calling the function
+# and span() returns a shared no-op context, so the cost is close to nothing.
+# Once enabled, with enable() or the RESALE_PROFILE environment variable, every
+# call records its wall time, CPU time, rows in and out, and peak memory.
+
+# Peak memory is either the resident memory of the process, sampled by a
+# background thread, which includes memory allocated outside of Python and
+# does not slow the code down, or the tracemalloc peak, which is exact for
+# Python and NumPy allocations but slows down pure Python code. Nested spans
+# each get their own peak.
+
+# The records can be exported in the Chrome trace event format, which can be
+# opened in chrome://tracing or https://ui.perfetto.dev, or summarized per
+# function as a table.
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+# Fixed constants.
+MEMORY_MODES = ["rss", "tracemalloc", None]
+SAMPLE_INTERVAL = 0.005 # Seconds between the resident memory samples.
+
+def resident_memory():
+    """
+    The resident memory of this process in bytes, or None where /proc is not
+    available.
+    """
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+class _State:
+    # The global profiling state.
+    enabled = False
+    memory = None
+    events = []
+    lock = threading.Lock()
+    local = threading.local() # The stack of open spans of each thread.
+    start_time = time.perf_counter()
+    # The running peak of the resident memory, updated by the sampler thread.
+    rss_peak = 0
+    sampler = None
+    sampler_done = None
+    # Whether enable() started tracemalloc, so that disable() only stops it then.
+    started_tracemalloc = False
+
+def _sample_rss():
+    while not _State.sampler_done.wait(SAMPLE_INTERVAL):
+        rss = resident_memory()
+        if rss is not None and rss > _State.rss_peak:
+            _State.rss_peak = rss
+
+def _current_and_peak():
+    # The current and peak memory since the last _reset_peak().
+    if _State.memory == "tracemalloc":
+        return tracemalloc.get_traced_memory()
+    if _State.memory == "rss":
+        rss = resident_memory() or 0
+        _State.rss_peak = max(_State.rss_peak, rss)
+        return rss, _State.rss_peak
+    return 0, 0
+
+def _reset_peak():
+    if _State.memory == "tracemalloc":
+        tracemalloc.reset_peak()
+    elif _State.memory == "rss":
+        _State.rss_peak = resident_memory() or 0
+
+# Switching profiling on and off.
+def enable(memory = "rss"):
+    """
+    Start recording the profiled functions and spans.
+    Inputs
+        memory: string (optional), "rss", "tracemalloc" or None, how to
+                measure the peak memory
+    """
+    if memory not in MEMORY_MODES:
+        raise ValueError("memory must be one of {}.".format(MEMORY_MODES))
+    disable()
+    _State.memory = memory
+    if memory == "tracemalloc":
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _State.started_tracemalloc = True
+    elif memory == "rss" and resident_memory() is not None:
+        _State.rss_peak = resident_memory()
+        _State.sampler_done = threading.Event()
+        _State.sampler = threading.Thread(target = _sample_rss, daemon = True)
+        _State.sampler.start()
+    elif memory == "rss":
+        _State.memory = None
+    _State.enabled = True
+
+def disable():
+    """
+    Stop recording. The recorded events are kept until reset().
+    """
+    _State.enabled = False
+    if _State.sampler is not None:
+        _State.sampler_done.set()
+        _State.sampler.join()
+        _State.sampler = None
+    if _State.started_tracemalloc == True:
+        tracemalloc.stop()
+        _State.started_tracemalloc = False
+    _State.memory = None
+
+def is_enabled():
+    return _State.enabled
+
+def reset():
+    """
+    Drop the recorded events.
+    """
+    with _State.lock:
+        _State.events = []
+    _State.start_time = time.perf_counter()
+
+# Recording.
+def _rows(x):
+    # The number of rows of a DataFrame or array, or of the first element of
+    # a tuple such as (df, temporal_models).
+    if isinstance(x, tuple) and len(x) > 0:
+        x = x[0]
+    shape = getattr(x, "shape", None)
+    return int(shape[0]) if shape is not None and len(shape) > 0 else None
+
+class _Span:
+    # A recorded span. Use span() or @profile instead of creating these.
+    __slots__ = ["name", "category", "args", "rows_in", "rows_out", "start", "start_cpu",
+                 "start_memory", "peak"]
+
+    def __init__(self, name, category, rows_in = None, args = None):
+        self.name = name
+        self.category = category
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.args = args
+
+    def __enter__(self):
+        stack = getattr(_State.local, "stack", None)
+        if stack is None:
+            stack = _State.local.stack = []
+        current, peak = _current_and_peak()
+        # Keep the peak of the parent span so far, before it is reset.
+        if len(stack) > 0:
+            stack[-1].peak = max(stack[-1].peak, peak)
+        _reset_peak()
+        self.start_memory, self.peak = current, current
+        stack.append(self)
+        self.start_cpu = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        cpu_time = time.process_time() - self.start_cpu
+        stack = _State.local.stack
+        stack.pop()
+        _, peak = _current_and_peak()
+        self.peak = max(self.peak, peak)
+        if len(stack) > 0:
+            stack[-1].peak = max(stack[-1].peak, self.peak)
+
+        event = {"name": self.name,
+                 "category": self.category,
+                 "start": self.start - _State.start_time,
+                 "time": end - self.start,
+                 "cpu_time": cpu_time,
+                 "rows_in": self.rows_in,
+                 "rows_out": self.rows_out,
+                 "peak_memory_mb": ((self.peak - self.start_memory) / 2 ** 20
+                                    if _State.memory is not None else None),
+                 "depth": len(stack),
+                 "pid": os.getpid(),
+                 "tid": threading.get_ident()}
+        if self.args is not None:
+            event["args"] = self.args
+        with _State.lock:
+            _State.events.append(event)
+        return False
+
+class _NullSpan:
+    # The shared span returned while disabled, which records nothing.
+    rows_out = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+def span(name, category = "span", rows_in = None, **args):
+    """
+    A context manager recording a block of code. Set .rows_out on the
+    returned span to record the output size.
+        with profiling.span("merge", rows_in = len(df)) as s:
+            ...
+            s.rows_out = len(new_df)
+    Inputs
+        name, category: string
+        rows_in: int (optional)
+        args: extra values to record with the span
+    Outputs
+        span: a context manager
+    """
+    if _State.enabled == False:
+        return _NULL_SPAN
+    return _Span(name, category, rows_in, args or None)
+
+def profile(func = None, name = None):
+    """
+    Decorator recording every call of a function, with the rows of its first
+    argument and of its output.
+        @profile
+        def clean_data(df): ...
+    Inputs
+        func: function
+        name: string (optional), defaults to module.function
+    """
+    if func is None:
+        return functools.partial(profile, name = name)
+    if name is None:
+        name = "{}.{}".format(func.__module__.split(".")[-1], func.__qualname__)
+    category = func.__module__.split(".")[-1]
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _State.enabled == False:
+            return func(*args, **kwargs)
+        rows_in = _rows(args[0]) if len(args) > 0 else None
+        with _Span(name, category, rows_in) as s:
+            result = func(*args, **kwargs)
+            s.rows_out = _rows(result)
+        return result
+    return wrapper
+
+@contextlib.contextmanager
+def session(trace_path = None, memory = "rss", verbose = True):
+    """
+    Profile a block of code, then print the summary and optionally save the
+    Chrome trace.
+        with profiling.session("trace.json"):
+            df = clean_data.clean_data(df)
+    Inputs
+        trace_path: string (optional)
+        memory: string (optional)
+        verbose: bool (optional)
+    """
+    reset()
+    enable(memory)
+    try:
+        yield
+    finally:
+        disable()
+        if trace_path is not None:
+            to_chrome_trace(trace_path)
+        if verbose == True:
+            print(summary().to_string())
+
+# Exporting.
+def events():
+    """
+    The recorded events, in the order they finished.
+    Outputs
+        events: list of dict
+    """
+    with _State.lock:
+        return list(_State.events)
+
+def to_chrome_trace(path = None):
+    """
+    Export the events in the Chrome trace event format.
+    Inputs
+        path: string (optional), the json file to write
+    Outputs
+        trace: dict
+    """
+    trace_events = []
+    for e in events():
+        args = {k: e[k] for k in ["cpu_time", "rows_in", "rows_out", "peak_memory_mb"]
+                if e[k] is not None}
+        args.update(e.get("args", {}))
+        trace_events.append({"name": e["name"], "cat": e["category"], "ph": "X",
+                             "ts": e["start"] * 1e6, "dur": e["time"] * 1e6,
+                             "pid": e["pid"], "tid": e["tid"], "args": args})
+    trace = {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+    if path is not None:
+        with open(path, "w") as fp:
+            json.dump(trace, fp, default = str)
+    return trace
+
+def summary():
+    """
+    Summarize the events per name, with the total and mean wall time, the
+    total CPU time, the rows and the largest peak memory, slowest first.
+    Outputs
+        summary: DataFrame
+    """
+    import pandas as pd
+    columns = ["calls", "time", "mean_time", "cpu_time", "rows_in", "rows_out",
+               "peak_memory_mb"]
+    df = pd.DataFrame(events())
+    if len(df) == 0:
+        return pd.DataFrame(columns = columns)
+    grouped = df.groupby("name")
+    return pd.DataFrame({"calls": grouped.size(),
+                         "time": grouped["time"].sum(),
+                         "mean_time": grouped["time"].mean(),
+                         "cpu_time": grouped["cpu_time"].sum(),
+                         "rows_in": grouped["rows_in"].sum(min_count = 1),
+                         "rows_out": grouped["rows_out"].sum(min_count = 1),
+                         "peak_memory_mb": grouped["peak_memory_mb"].max()},
+                        columns = columns).sort_values("time", ascending = False)
+
+# Profiling can also be switched on for a whole run from the environment.
+if os.environ.get("RESALE_PROFILE", "") not in ["", "0"]:
+    _memory = os.environ.get("RESALE_PROFILE_MEMORY", "rss")
+    enable(None if _memory in ["", "none", "None"] else _memory)
@@ -0,0 +1,117 @@
+# Block level features from the HDB property information dataset.
+
+# The dataset, downloaded by raw_data_download.py from
+# https://data.gov.sg/dataset/hdb-property-information, has one row per block
+# with its highest floor, year of completion, number of flats and facilities.
+# It is parsed into a compact table indexed by the same "address" as
+# clean_data.make_address(), i.e. the block and the cleaned street name.
+
+# The table is joined to the transactions on the integer codes of their
+# distinct addresses: only the few thousand distinct addresses are looked up
+# in the index of the table, and every column is then gathered with one NumPy
+# take over the codes, rather than merging the DataFrames on the address
+# strings of every transaction.
+
+import os
+import numpy as np
+
+# Relative imports.
+from . import clean_data
+from . import profiling
+
+# pandas is imported inside the functions, so that clean_data imports quickly.
+
+# Fixed constants for the raw data on local disk.
+CURR_PATH = os.path.dirname(__file__)
+RAW_DATA_FILE = os.path.join(CURR_PATH, "../raw data/hdb-property-information.csv")
+
+# The columns of the table and their compact data types.
+NUMERIC_COLUMNS = {"max_floor_lvl": np.int16, "year_completed": np.int16,
+                   "total_dwelling_units": np.int16}
+# Y/N facilities of the block.
+FLAG_COLUMNS = ["commercial", "market_hawker", "miscellaneous", "multistorey_carpark",
+                "precinct_pavilion"]
+RENTAL_COLUMNS = ["1room_rental", "2room_rental", "3room_rental", "other_room_rental"]
+COLUMNS = list(NUMERIC_COLUMNS) + FLAG_COLUMNS + ["rental_dwelling_units"]
+
+@profiling.profile
+def load_property_information(file_path = RAW_DATA_FILE):
+    """
+    Load the raw HDB property information into a table indexed by address.
+    Inputs
+        file_path: string
+    Outputs
+        table: DataFrame, see make_property_table()
+    """
+    import pandas as pd
+    raw = pd.read_csv(file_path, dtype = {"blk_no": str, "street": str})
+    return make_property_table(raw)
+
+def make_property_table(raw):
+    """
+    Inputs
+        raw: DataFrame, with the columns of the raw HDB property information,
+             blk_no, street, residential, NUMERIC_COLUMNS, FLAG_COLUMNS and
+             RENTAL_COLUMNS
+    Outputs
+        table: DataFrame, with the COLUMNS of the residential blocks,
+               indexed by a unique "address"
+    """
+    import pandas as pd
+    raw = raw[raw["residential"] == "Y"]
+
+    # Clean every distinct street name once.
+    streets, street_names = pd.factorize(raw["street"])
+    street_names = np.array([clean_data.street_name_cleaner(x) for x in street_names],
+                            dtype = object)
+    address = raw["blk_no"].str.strip().values + " " + street_names[streets]
+
+    table = pd.DataFrame(index = pd.Index(address, name = "address"))
+    for column, dtype in NUMERIC_COLUMNS.items():
+        table[column] = raw[column].fillna(0).values.astype(dtype)
+    for column in FLAG_COLUMNS:
+        table[column] = (raw[column] == "Y").values.astype(np.int8)
+    table["rental_dwelling_units"] = raw[RENTAL_COLUMNS].fillna(0).sum(axis = 1).values.astype(np.int16)
+    return table[~table.index.duplicated(keep = "first")]
+
+@profiling.profile
+def join_property_information(df, table, columns = None, verbose = True):
+    """
+    Add the columns of the property table of the block of every transaction.
+    The columns are float32, and NaN for the addresses not in the table. The
+    fraction of transactions matched is printed if verbose, and saved in
+    df.attrs["property_information_match_rate"].
+    Inputs
+        df: DataFrame, with "address"
+        table: DataFrame, from load_property_information()
+        columns: list (optional), defaults to all the columns of table
+        verbose: bool (optional)
+    Outputs
+        df: DataFrame
+    """
+    import pandas as pd
+    if columns is None:
+        columns = list(table.columns)
+
+    if isinstance(df["address"].dtype, pd.CategoricalDtype):
+        codes, addresses = df["address"].cat.codes.values, df["address"].cat.categories
+    else:
+        codes, addresses = pd.factorize(df["address"])
+    # The row of the table of every distinct address, then of every
+    # transaction. Missing addresses, with code -1, take the last row, and
+    # unmatched rows point past the end of the table, to a NaN.
+    address_rows = table.index.get_indexer(addresses)
+    address_rows[address_rows < 0] = len(table)
+    rows = np.append(address_rows, len(table))[codes]
+
+    for column in columns:
+        values = np.append(table[column].values.astype(np.float32), np.float32(np.nan))
+        df[column] = values[rows]
+
+    matched = rows < len(table)
+    match_rate = matched.mean() if len(matched) > 0 else np.nan
+    df.attrs["property_information_match_rate"] = match_rate
+    if verbose == True:
+        print("Matched {:.2%} of transactions ({} of {} addresses) to the property information.".format(
+            match_rate, (address_rows < len(table)).sum(), len(addresses)))
+    return df
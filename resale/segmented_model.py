@@ -0,0 +1,185 @@
+# Train one model per segment of the data, e.g. per town or flat type.
+
+# A single global model on model.FEATURES underfits towns and flat types with
+# very different dynamics. The adjusted data is instead partitioned by a key,
+# and a model is trained for every segment in a process pool, together with
+# the global model, which is used for the segments too small to train on.
+# Predictions are routed to the segment models with one grouped call per model.
+
+from concurrent.futures import ProcessPoolExecutor
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# Relative imports.
+from . import model
+from . import profiling
+
+# Fixed constants.
+MIN_SEGMENT_SIZE = 1000 # Segments with fewer rows use the global model.
+GLOBAL = "__global__" # The key of the global model.
+
+def segment_keys(df, by = "town", h3_resolution = None):
+    """
+    The segment key of every row.
+    Inputs
+        df: DataFrame
+        by: string (optional), the column to segment by, e.g. "town",
+            "flat_type" or "h3"
+        h3_resolution: int (optional), segment by the parent cells of the
+                       H3 column at this coarser resolution
+    Outputs
+        keys: array of string
+    """
+    if h3_resolution is None:
+        return df[by].values.astype(str)
+    import h3
+    # Only compute the parent of each distinct cell.
+    cells, inverse = np.unique(df[by].values.astype(str), return_inverse = True)
+    parents = np.array([h3.h3_to_parent(cell, h3_resolution) for cell in cells])
+    return parents[inverse]
+
+def group_indices(keys):
+    """
+    Group the row indices by key with one sort, instead of one boolean mask
+    per key.
+    Inputs
+        keys: array
+    Outputs
+        groups: dict, mapping each key to an array of its row indices
+    """
+    unique, inverse = np.unique(keys, return_inverse = True)
+    order = np.argsort(inverse, kind = "stable")
+    bounds = np.searchsorted(inverse[order], np.arange(len(unique) + 1))
+    return {key: order[bounds[i]:bounds[i + 1]] for i, key in enumerate(unique)}
+
+# Training, which runs in the worker processes.
+def _train_segment(args):
+    # Must be at the module level to be pickled.
+    key, X, y, model_params, random_state, threads, base, cache_dir = args
+    result = model.train_model(X, y, model_params = model_params, random_state = random_state,
+                               n_jobs = threads, base = base, cache_dir = cache_dir,
+                               verbose = False)
+    return key, result["model"], result["metrics"]
+
+class SegmentedModel:
+    """
+    Segment models with a global fallback, and a router for batched predictions.
+    """
+    def __init__(self, models, global_model, by = "town", h3_resolution = None,
+                 features = model.FEATURES, metrics = None):
+        """
+        Inputs
+            models: dict, mapping segment keys to lgb.Booster
+            global_model: lgb.Booster
+            by: string (optional)
+            h3_resolution: int (optional)
+            features: list (optional)
+            metrics: DataFrame (optional), the validation metrics of each model
+        """
+        self.models = models
+        self.global_model = global_model
+        self.by = by
+        self.h3_resolution = h3_resolution
+        self.features = features
+        self.metrics = metrics
+
+    def predict(self, X, keys):
+        """
+        Predict with the model of each row's segment, or the global model for
+        unknown segments. Each model is called once on all of its rows.
+        Inputs
+            X: array (n_samples, n_features)
+            keys: array (n_samples,), from segment_keys()
+        Outputs
+            y: array (n_samples,), scaled like the training targets
+        """
+        X = np.asarray(X)
+        keys = np.asarray(keys).astype(str)
+        # Map the distinct keys to models first, so that all the rows using
+        # the global model are predicted together.
+        unique, inverse = np.unique(keys, return_inverse = True)
+        names = np.array([k if k in self.models else GLOBAL for k in unique])
+        y = np.empty(len(X))
+        for name, index in group_indices(names[inverse]).items():
+            m = self.global_model if name == GLOBAL else self.models[name]
+            y[index] = m.predict(X[index])
+        return y
+
+    def predict_df(self, df):
+        """
+        Inputs
+            df: DataFrame, with the features and the segment column
+        Outputs
+            y: array
+        """
+        return self.predict(df[self.features].values,
+                            segment_keys(df, self.by, self.h3_resolution))
+
+@profiling.profile
+def train_segmented_models(df,
+                           by = "town",
+                           h3_resolution = None,
+                           features = model.FEATURES,
+                           target = model.TARGET,
+                           min_segment_size = MIN_SEGMENT_SIZE,
+                           model_params = None,
+                           global_model = None,
+                           random_state = None,
+                           n_jobs = 1,
+                           threads_per_model = 1,
+                           base = 10,
+                           cache_dir = None,
+                           verbose = True):
+    """
+    Train a model for every segment with at least min_segment_size rows, and
+    a global model on all rows, in a process pool.
+    Inputs
+        df: DataFrame, with the adjusted target
+        by: string (optional), "town", "flat_type", "h3"...
+        h3_resolution: int (optional), see segment_keys()
+        features: list (optional)
+        target: string (optional), scaled with model.y_scaler() using base
+        min_segment_size: int (optional)
+        model_params: dict (optional)
+        global_model: lgb.Booster (optional), an already trained global model
+        random_state: int (optional)
+        n_jobs: int (optional), the number of processes
+        threads_per_model: int (optional)
+        base: int (optional)
+        cache_dir: string (optional), for the binned datasets, defaults to a
+                   temporary directory deleted at the end
+        verbose: bool (optional)
+    Outputs
+        segmented_model: SegmentedModel
+    """
+    X, y = model.make_Xy(df, features, target, scale_y = True, base = base)
+    keys = segment_keys(df, by, h3_resolution)
+
+    with tempfile.TemporaryDirectory(prefix = "segments-") as tmp_dir:
+        run_dir = tmp_dir if cache_dir is None else cache_dir
+        tasks = [(key, X[index], y[index], model_params, random_state, threads_per_model, base,
+                  run_dir)
+                 for key, index in group_indices(keys).items() if len(index) >= min_segment_size]
+        if global_model is None:
+            tasks.append((GLOBAL, X, y, model_params, random_state, threads_per_model, base,
+                          run_dir))
+        # Train the biggest models first, so that they do not finish last.
+        tasks = sorted(tasks, key = lambda task: -len(task[1]))
+
+        if n_jobs is None or n_jobs <= 1:
+            results = [_train_segment(task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers = n_jobs) as executor:
+                results = list(executor.map(_train_segment, tasks))
+
+    models = {key: booster for key, booster, _ in results}
+    if global_model is None:
+        global_model = models.pop(GLOBAL)
+    metrics = pd.DataFrame([dict(metrics, segment = key, n = len(task[1]))
+                            for (key, _, metrics), task in zip(results, tasks)])
+    if verbose == True:
+        print("Trained {} segment models by {}, {} segments use the global model.".format(
+            len(models), by, len(np.unique(keys)) - len(models)))
+    return SegmentedModel(models, global_model, by, h3_resolution, features, metrics)
@@ -1,7 +1,19 @@
 # Calculate statistics such as the monthly mean resale price from data.
 
+# With n_jobs > 1, the monthly statistics are computed in a process pool with
+# the shared memory backend of parallel.py: the rows are sorted by month once,
+# and each worker reads the months it is given from shared memory.
+
+import numpy as np
+import pandas as pd
+
+# Relative imports.
+from . import parallel
+from . import profiling
+
+@profiling.profile
 def get_monthly_median_price(df, date_column = "year_month", price_column = "resale_price", 
-                             groupby_column = None):
+                             groupby_column = None, n_jobs = 1):
     """
     Get monthly median price for the entire dataset.
     Inputs
@@ -9,9 +21,15 @@ def get_monthly_median_price(df, date_column = "year_month", price_column = "res
         date_column: string
         price_column: string
         groupby_column: string (optional)
+        n_jobs: int (optional), the number of processes, -1 uses all CPUs
     Outputs
         median_price: DataFrame
     """
+    if n_jobs is not None and n_jobs != 1:
+        median_price = get_monthly_price_in_parallel(df, date_column, price_column,
+                                                     groupby_column, "median", n_jobs)
+        return median_price.sort_values(date_column)
+
     if groupby_column is None:
         want = [date_column, price_column]
         groupby_column = [date_column]
@@ -23,8 +41,9 @@ def get_monthly_median_price(df, date_column = "year_month", price_column = "res
     median_price = median_price.sort_values(date_column)
     return median_price
 
+@profiling.profile
 def get_monthly_mean_price(df, date_column = "year_month", price_column = "resale_price", 
-                           groupby_column = None):
+                           groupby_column = None, n_jobs = 1):
     """
     Get monthly mean price for the entire dataset.
     Inputs
@@ -32,9 +51,15 @@ def get_monthly_mean_price(df, date_column = "year_month", price_column = "resal
         date_column: string
         price_column: string
         groupby_column: string (optional)
+        n_jobs: int (optional), the number of processes, -1 uses all CPUs
     Outputs
         mean_price: DataFrame
     """
+    if n_jobs is not None and n_jobs != 1:
+        mean_price = get_monthly_price_in_parallel(df, date_column, price_column,
+                                                   groupby_column, "mean", n_jobs)
+        return mean_price.sort_values(date_column)
+
     if groupby_column is None:
         want = [date_column, price_column]
         groupby_column = [date_column]
@@ -46,3 +71,79 @@ def get_monthly_mean_price(df, date_column = "year_month", price_column = "resal
     mean_price = mean_price.sort_values(date_column)
     return mean_price
 
+# The shared memory implementation.
+def group_median(keys, values):
+    """
+    The median of the values of each key, with one sort instead of a groupby.
+    Like the groupby, missing values are skipped.
+    Inputs
+        keys: array
+        values: array
+    Outputs
+        unique_keys: array, sorted
+        medians: array of float
+        counts: array of int
+    """
+    finite = np.isfinite(values)
+    if not finite.all():
+        keys, values = keys[finite], values[finite]
+    if len(keys) == 0:
+        return keys, np.zeros(0), np.zeros(0, dtype = int)
+    order = np.lexsort((values, keys))
+    keys, values = keys[order], values[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+    # The mean of the two middle values, which are the same value for odd counts.
+    medians = (values[starts + (counts - 1) // 2] + values[starts + counts // 2]) / 2
+    return keys[starts], medians, counts
+
+def _monthly_prices(columns, offsets, start, stop, how):
+    # The median or mean price of every group code in the months [start, stop),
+    # run by parallel.map_groups().
+    results = []
+    for i in range(start, stop):
+        codes = columns["code"][offsets[i]:offsets[i + 1]]
+        prices = columns["price"][offsets[i]:offsets[i + 1]]
+        if how == "median":
+            keys, values, _ = group_median(codes, prices)
+        else:
+            counts = np.bincount(codes)
+            keys = np.flatnonzero(counts)
+            values = np.bincount(codes, weights = prices)[keys] / counts[keys]
+        results.append((keys, values))
+    return results
+
+def get_monthly_price_in_parallel(df, date_column = "year_month", price_column = "resale_price",
+                                  groupby_column = None, how = "median", n_jobs = -1):
+    """
+    The monthly median or mean price, with the months spread over a process
+    pool. The same as the groupby of get_monthly_median_price(), up to the
+    order of the rows within a month.
+    Inputs
+        df: DataFrame
+        date_column, price_column: string (optional)
+        groupby_column: string (optional)
+        how: string (optional), "median" or "mean"
+        n_jobs: int (optional)
+    Outputs
+        prices: DataFrame
+    """
+    if groupby_column is None:
+        codes, labels = np.zeros(len(df), dtype = int), None
+    else:
+        codes, labels = pd.factorize(df[groupby_column], sort = True)
+    data = pd.DataFrame({date_column: df[date_column].values, "code": codes,
+                         "price": df[price_column].values})
+    # Like the groupby, skip the missing groups and prices.
+    data = data[(data["code"] >= 0) & data["price"].notna()]
+
+    with parallel.SharedFrame(data, date_column, ["code", "price"]) as frame:
+        results = parallel.map_groups(_monthly_prices, frame, (how,), n_jobs)
+        months = frame.groups
+
+    prices = {date_column: np.repeat(months, [len(keys) for keys, _ in results])}
+    if groupby_column is not None:
+        prices[groupby_column] = np.asarray(labels)[
+            np.concatenate([keys for keys, _ in results] + [np.zeros(0, dtype = int)])]
+    prices[price_column] = np.concatenate([values for _, values in results] + [np.zeros(0)])
+    return pd.DataFrame(prices)
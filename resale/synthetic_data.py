@@ -0,0 +1,259 @@
+# Generate synthetic HDB resale transactions for tests and benchmarks.
+
+# The synthetic transactions have every column of the consolidated resale
+# flat prices file, so that they go through load_data, clean_data and the rest
+# of the pipeline like the real data, and come with a matching geocoded
+# addresses dict. Blocks are generated first, with a town, a street, a block
+# number, a location and a lease commencement year, and the transactions then
+# draw a block, a month, a flat type and a storey range, so that the number of
+# addresses stays realistic however many rows are generated. Everything is
+# vectorized, and the transactions can be generated in chunks, from 100k rows
+# up to tens of millions.
+
+import io
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+# Relative imports.
+from . import clean_data
+from . import geocode
+from . import load_data
+
+# Fixed constants for the towns and their approximate centres.
+TOWNS = {"ANG MO KIO": (1.369, 103.845), "BEDOK": (1.324, 103.930),
+         "BISHAN": (1.351, 103.848), "BUKIT BATOK": (1.349, 103.750),
+         "BUKIT MERAH": (1.282, 103.823), "BUKIT PANJANG": (1.378, 103.762),
+         "BUKIT TIMAH": (1.329, 103.802), "CENTRAL AREA": (1.287, 103.851),
+         "CHOA CHU KANG": (1.384, 103.747), "CLEMENTI": (1.315, 103.765),
+         "GEYLANG": (1.318, 103.887), "HOUGANG": (1.361, 103.886),
+         "JURONG EAST": (1.333, 103.742), "JURONG WEST": (1.340, 103.705),
+         "KALLANG/WHAMPOA": (1.311, 103.866), "MARINE PARADE": (1.302, 103.907),
+         "PASIR RIS": (1.373, 103.949), "PUNGGOL": (1.398, 103.907),
+         "QUEENSTOWN": (1.294, 103.786), "SEMBAWANG": (1.449, 103.820),
+         "SENGKANG": (1.391, 103.895), "SERANGOON": (1.355, 103.867),
+         "TAMPINES": (1.354, 103.944), "TOA PAYOH": (1.334, 103.856),
+         "WOODLANDS": (1.436, 103.786), "YISHUN": (1.430, 103.835)}
+# Street name patterns, with the abbreviations of the raw data.
+STREET_PATTERNS = ["{} AVE {}", "{} ST {}", "{} DR {}", "{} RD", "{} CRES", "LOR {} {}",
+                   "{} CTRL", "{} NTH ST {}", "UPP {} RD"]
+# Flat types with their share of the transactions, mean floor area in sqm
+# and flat models.
+FLAT_TYPES = {"1 ROOM": (0.001, 31, ["Improved"]),
+              "2 ROOM": (0.02, 45, ["Standard", "Improved", "Model A"]),
+              "3 ROOM": (0.30, 68, ["New Generation", "Improved", "Model A", "Simplified"]),
+              "4 ROOM": (0.38, 95, ["Model A", "Premium Apartment", "New Generation", "DBSS"]),
+              "5 ROOM": (0.23, 118, ["Improved", "Premium Apartment", "Model A", "DBSS"]),
+              "EXECUTIVE": (0.068, 145, ["Apartment", "Maisonette"]),
+              "MULTI-GENERATION": (0.001, 162, ["Multi Generation"])}
+STOREY_RANGES = ["{:02d} TO {:02d}".format(low, low + 2) for low in range(1, 50, 3)]
+COLUMNS = ["month", "town", "flat_type", "block", "street_name", "storey_range",
+           "floor_area_sqm", "flat_model", "lease_commence_date", "remaining_lease",
+           "resale_price"]
+
+def make_synthetic_blocks(n_blocks = 10000, lease_years = (1967, 2018), random_state = None):
+    """
+    Make HDB blocks, each with a town, street, block number, location, lease
+    commencement year and price premium.
+    Inputs
+        n_blocks: int (optional)
+        lease_years: tuple (optional)
+        random_state: int or np.random.Generator (optional)
+    Outputs
+        blocks: DataFrame
+    """
+    rng = np.random.default_rng(random_state)
+    towns = np.array(list(TOWNS.keys()))
+    centres = np.array(list(TOWNS.values()))
+    town = rng.choice(len(towns), n_blocks, p = rng.dirichlet(np.full(len(towns), 5.0)))
+
+    # A few streets per town, named after the town.
+    names = np.array([t.split("/")[0].replace("BUKIT", "BT") for t in towns])
+    street_names = np.array([p.format(n, k) if p.count("{}") == 2 else p.format(n)
+                             for n in names for p in STREET_PATTERNS for k in [1, 2, 3]])
+    street_names = street_names.reshape(len(towns), -1)
+    street = rng.integers(0, street_names.shape[1], n_blocks)
+    street_name = street_names[town, street]
+
+    # Block numbers are unique within each street.
+    order = np.lexsort([street, town])
+    first = np.r_[True, (np.diff(town[order]) != 0) | (np.diff(street[order]) != 0)]
+    rank = np.arange(n_blocks) - np.maximum.accumulate(np.where(first, np.arange(n_blocks), 0))
+    number = np.empty(n_blocks, dtype = int)
+    number[order] = 100 + rank
+    suffix = rng.choice(["", "", "", "", "A", "B", "C"], n_blocks)
+    block = np.char.add(number.astype(str), suffix).astype(object)
+
+    return pd.DataFrame({"town": towns[town],
+                         "street_name": street_name.astype(object),
+                         "block": block,
+                         "latitude": centres[town, 0] + rng.normal(0, 0.008, n_blocks),
+                         "longitude": centres[town, 1] + rng.normal(0, 0.008, n_blocks),
+                         "lease_commence_date": rng.integers(lease_years[0], lease_years[1] + 1,
+                                                             n_blocks),
+                         "premium": np.exp(rng.normal(0, 0.15, len(towns))[town] +
+                                           rng.normal(0, 0.05, n_blocks)),
+                         # Some blocks are more popular than others.
+                         "popularity": rng.dirichlet(np.full(n_blocks, 2.0))})
+
+def make_synthetic_transactions(blocks, n_rows = 100000, start_year_month = "2000-01-01",
+                                n_months = 300, random_state = None):
+    """
+    Make resale transactions of the blocks, in the format of the raw data.
+    Inputs
+        blocks: DataFrame, from make_synthetic_blocks()
+        n_rows: int (optional)
+        start_year_month: string (optional)
+        n_months: int (optional)
+        random_state: int or np.random.Generator (optional)
+    Outputs
+        df: DataFrame, with the COLUMNS of the raw data
+    """
+    rng = np.random.default_rng(random_state)
+    months = pd.date_range(start_year_month, periods = n_months, freq = "MS")
+    start_year = months[0].year
+
+    # The popularity is drawn once with the blocks, so that every call, e.g.
+    # every chunk of write_synthetic_data(), samples the same distribution.
+    popularity = blocks["popularity"].values
+    b = rng.choice(len(blocks), n_rows, p = popularity / popularity.sum())
+    lease = blocks["lease_commence_date"].values[b]
+    # Sales only happen after the lease commencement.
+    first_month = np.clip((lease - start_year) * 12 - months[0].month + 1, 0, n_months - 1)
+    m = first_month + (rng.random(n_rows) * (n_months - first_month)).astype(int)
+    year = months.year.values[m]
+
+    flat_types = np.array(list(FLAT_TYPES.keys()))
+    shares = np.array([v[0] for v in FLAT_TYPES.values()])
+    f = rng.choice(len(flat_types), n_rows, p = shares / shares.sum())
+    area = np.array([v[1] for v in FLAT_TYPES.values()])[f] * rng.normal(1, 0.06, n_rows)
+    area = np.round(np.maximum(area, 25))
+    models = [v[2] for v in FLAT_TYPES.values()]
+    model_index = (rng.random(n_rows) * np.array([len(x) for x in models])[f]).astype(int)
+    flat_model = np.array([x for ms in models for x in ms], dtype = object)[
+        np.cumsum([0] + [len(x) for x in models])[:-1][f] + model_index]
+
+    # Lower storeys are more common.
+    s = np.minimum(rng.geometric(0.25, n_rows) - 1, len(STOREY_RANGES) - 1)
+
+    # Prices follow a market trend with a cycle, depreciate with age, and
+    # increase with the storey and the location premium.
+    t = m / 12
+    trend = np.exp(0.04 * t + 0.1 * np.sin(2 * np.pi * t / 12))
+    age = year - lease
+    price_per_sqm = (2500 * trend * blocks["premium"].values[b] * (1 - 0.008 * age) *
+                     (1 + 0.006 * (3 * s + 2)) * np.exp(rng.normal(0, 0.05, n_rows)))
+    resale_price = np.round(price_per_sqm * area, -3)
+
+    # The remaining lease is formatted once per distinct (lease, month).
+    remaining = 99 * 12 - ((year - lease) * 12 + months.month.values[m] - 1)
+    unique, inverse = np.unique(remaining, return_inverse = True)
+    remaining_lease = np.array(["{} years {:02d} months".format(r // 12, r % 12)
+                                for r in unique], dtype = object)[inverse]
+
+    return pd.DataFrame({"month": months.strftime("%Y-%m").values.astype(object)[m],
+                         "town": blocks["town"].values[b],
+                         "flat_type": flat_types.astype(object)[f],
+                         "block": blocks["block"].values[b],
+                         "street_name": blocks["street_name"].values[b],
+                         "storey_range": np.array(STOREY_RANGES, dtype = object)[s],
+                         "floor_area_sqm": area,
+                         "flat_model": flat_model,
+                         "lease_commence_date": lease,
+                         "remaining_lease": remaining_lease,
+                         "resale_price": resale_price})
+
+def make_geocoded_addresses(blocks):
+    """
+    The geocoded addresses dict of the blocks, in the format of
+    geocode.load_geocoded_addresses_json(), keyed by the cleaned address.
+    Inputs
+        blocks: DataFrame
+    Outputs
+        address_dict: dict
+    """
+    # Only clean each distinct street name once.
+    streets = pd.unique(blocks["street_name"])
+    cleaned = dict(zip(streets, [clean_data.street_name_cleaner(s) for s in streets]))
+    address = blocks["block"] + " " + blocks["street_name"].map(cleaned)
+    return {a: {"latitude": "{:.10f}".format(lat),
+                "longitude": "{:.10f}".format(lon),
+                "address": "{} SINGAPORE".format(a)}
+            for a, lat, lon in zip(address, blocks["latitude"], blocks["longitude"])}
+
+def make_synthetic_data(n_rows = 100000, n_blocks = None, start_year_month = "2000-01-01",
+                        n_months = 300, random_state = None):
+    """
+    Make synthetic transactions in the format of load_data.load_data(), and
+    the matching geocoded addresses.
+    Inputs
+        n_rows: int (optional)
+        n_blocks: int (optional), defaults to about the number of real HDB
+                  blocks, or fewer for small data
+        start_year_month: string (optional)
+        n_months: int (optional)
+        random_state: int (optional)
+    Outputs
+        df: DataFrame
+        address_dict: dict
+    """
+    rng = np.random.default_rng(random_state)
+    if n_blocks is None:
+        n_blocks = int(min(10000, max(100, n_rows // 20)))
+    blocks = make_synthetic_blocks(n_blocks, random_state = rng)
+    df = make_synthetic_transactions(blocks, n_rows, start_year_month, n_months, rng)
+    df = add_load_data_columns(df)
+    return df, make_geocoded_addresses(blocks)
+
+def add_load_data_columns(df):
+    """
+    Add the columns added by load_data.load_data(), vectorized.
+    Inputs
+        df: DataFrame
+    Outputs
+        df: DataFrame
+    """
+    df["year_month"] = pd.to_datetime(df["month"], format = "%Y-%m")
+    df["year"] = df["year_month"].dt.year
+    df["mth"] = df["year_month"].dt.month
+    return df
+
+def write_synthetic_data(n_rows = 100000, n_blocks = None, start_year_month = "2000-01-01",
+                         n_months = 300, chunk_size = 1000000, random_state = None,
+                         local_data_dir = None):
+    """
+    Write synthetic transactions and geocoded addresses to disk, in the files
+    read by load_data.load_data(online = False) and clean_data. The rows are
+    generated and compressed chunk by chunk, so that large files never need
+    to fit in memory.
+    Inputs
+        n_rows: int (optional)
+        n_blocks: int (optional)
+        start_year_month: string (optional)
+        n_months: int (optional)
+        chunk_size: int (optional)
+        random_state: int (optional)
+        local_data_dir: string, the directory to write to
+    """
+    rng = np.random.default_rng(random_state)
+    if n_blocks is None:
+        n_blocks = int(min(10000, max(100, n_rows // 20)))
+    blocks = make_synthetic_blocks(n_blocks, random_state = rng)
+    os.makedirs(local_data_dir, exist_ok = True)
+
+    path = os.path.join(local_data_dir, load_data.DATA_FILE)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        with z.open(load_data.DATA_FILE.replace(".zip", ""), "w", force_zip64 = True) as fp:
+            text = io.TextIOWrapper(fp, encoding = "utf-8", newline = "")
+            for start in range(0, n_rows, chunk_size):
+                chunk = make_synthetic_transactions(blocks, min(chunk_size, n_rows - start),
+                                                    start_year_month, n_months, rng)
+                chunk.to_csv(text, header = start == 0, index = False)
+            text.flush()
+            text.detach()
+
+    geocode.store_geocoded_addresses_json(make_geocoded_addresses(blocks),
+                                          os.path.join(local_data_dir, ""),
+                                          geocode.GEOCODED_ADDRESSES)
@@ -0,0 +1,118 @@
+# Move resale prices through time with the fitted temporal trend models.
+
+# The adjustment factor of add_price_adjustment_factor() only depends on the
+# location, the month of the sale and the targeted month. Instead of refitting
+# the trend models to change the targeted month, precompute the trend values of
+# every (location, month) in a dense table once, and convert prices between
+# any two months with vectorized look ups of the table.
+
+import numpy as np
+import pandas as pd
+
+# Relative imports.
+from . import linear_regression
+
+class PriceTimeMachine:
+    """
+    Converts prices between months using a (location x month) table of the
+    trend values of a TrendModelRegistry.
+    """
+    def __init__(self, temporal_models, n_future_months = 0):
+        """
+        Inputs
+            temporal_models: TrendModelRegistry
+            n_future_months: int (optional), months after the fitted data to
+                             extrapolate the trends to. The default 0 ends at
+                             the last fitted month, the target of
+                             adjust_resale_price_by_location(next_month = False),
+                             and 1 ends at the next month, for next_month = True
+        """
+        self.temporal_models = temporal_models
+        self.start_year_month = temporal_models.start_year_month
+        self.first_month = temporal_models.domain[0]
+        # The last fitted month moves past the basis domain with update().
+        self.last_month = temporal_models.last_month + n_future_months
+
+        months = np.arange(self.first_month, self.last_month + 1)
+        G = linear_regression.make_basis(months, temporal_models.vander_order,
+                                         temporal_models.basis, temporal_models.domain)
+        self.trend_table = np.ascontiguousarray(np.dot(temporal_models.model, G.T))
+
+    def month_index(self, year_month):
+        """
+        Column index in the trend table of each month. Months outside of the
+        table get the index -1.
+        Inputs
+            year_month: datetime, string or array of those
+        Outputs
+            index: array of int
+        """
+        # Whole months since 1970 are differenced instead of going through pandas.
+        year_month = np.asarray(pd.to_datetime(np.atleast_1d(year_month)), dtype = "datetime64[M]")
+        start = np.datetime64(self.start_year_month, "M")
+        months = (year_month - start).astype(int) + 1
+        index = months - self.first_month
+        return np.where((months >= self.first_month) & (months <= self.last_month), index, -1)
+
+    def convert(self, prices, locations, from_year_month, to_year_month = None):
+        """
+        Convert prices from the months they were sold in to the targeted months.
+        Scalars are broadcast against the arrays. Unknown locations and months
+        outside of the trend table result in NaN.
+        Inputs
+            prices: array
+            locations: array, use "" or None for a global model
+            from_year_month: array of datetime
+            to_year_month: array of datetime (optional), defaults to the last month
+        Outputs
+            new_prices: array
+        """
+        return np.asarray(prices, dtype = float) * self.factors(locations, from_year_month,
+                                                                to_year_month)
+
+    def factors(self, locations, from_year_month, to_year_month = None):
+        """
+        The adjustment factors from from_year_month to to_year_month, the same
+        as the "adj_factor" of adjust_price.add_price_adjustment_factors().
+        Inputs
+            locations: array
+            from_year_month: array of datetime
+            to_year_month: array of datetime (optional)
+        Outputs
+            factors: array
+        """
+        if self.temporal_models.which is None:
+            codes = np.zeros(len(np.atleast_1d(locations)), dtype = int)
+        else:
+            codes = self.temporal_models.location_codes(np.atleast_1d(locations))
+        start = self.month_index(from_year_month)
+        if to_year_month is None:
+            end = np.array([self.last_month - self.first_month])
+        else:
+            end = self.month_index(to_year_month)
+        codes, start, end = np.broadcast_arrays(codes, start, end)
+
+        valid = (codes >= 0) & (start >= 0) & (end >= 0)
+        factors = np.full(codes.shape, np.nan)
+        factors[valid] = (self.trend_table[codes[valid], end[valid]] /
+                          self.trend_table[codes[valid], start[valid]])
+        return factors
+
+    def rebase(self, to_year_month):
+        """
+        The factors converting every (location, month) to a single targeted
+        month, without refitting the trend models.
+        Inputs
+            to_year_month: datetime
+        Outputs
+            factor_table: DataFrame, with locations as rows and months as columns
+        """
+        end = self.month_index(to_year_month)[0]
+        if end < 0:
+            raise ValueError("{} is outside of the trend table.".format(to_year_month))
+        table = self.trend_table[:, end][:, None] / self.trend_table
+
+        columns = pd.date_range(self.start_year_month + 
+                                pd.DateOffset(months = self.first_month - 1),
+                                periods = table.shape[1], freq = "MS")
+        return pd.DataFrame(table, index = self.temporal_models.locations, columns = columns)
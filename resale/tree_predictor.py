@@ -0,0 +1,151 @@
+# Predict with a trained LightGBM model using only NumPy.
+
+# The trees exported with model.export_tree_predictor() are stored as flat
+# node arrays, and a batch is evaluated by level-synchronous traversal: every
+# (row, tree) pair advances by one level at a time with vectorized look ups,
+# so the number of Python iterations is only the depth of the deepest tree.
+# Leaves are nodes whose two children are themselves, so pairs which reach a
+# leaf early simply stay there, and the children of each node are interleaved
+# in one array so that a step is a single look up at 2 * node + go_right.
+
+# This module does not import lightgbm, so that an exported predictor can be
+# loaded and used where lightgbm is not installed.
+
+import numpy as np
+
+# Fixed constants for the missing value handling of the splits, in the same
+# order as LightGBM's MissingType.
+MISSING_TYPES = ["None", "Zero", "NaN"]
+# Values within this distance of zero are missing with MissingType Zero.
+ZERO_THRESHOLD = 1e-35
+# The arrays saved by TreePredictor.save().
+ARRAYS = ["roots", "split_feature", "threshold", "default_left", "missing_type",
+          "children", "value"]
+
+class TreePredictor:
+    """
+    The trees of a LightGBM regression model as flat node arrays, with the
+    leaves as nodes which point to themselves.
+    """
+    def __init__(self, roots, split_feature, threshold, default_left, missing_type,
+                 children, value, n_features = None, objective = "regression",
+                 average_output = False):
+        """
+        Inputs
+            roots: array of int (n_trees,), the root node of each tree
+            split_feature, threshold, default_left, missing_type: arrays (n_nodes,),
+                the splits, with thresholds of inf for the leaves
+            children: array of int (2 * n_nodes,), the left and right child of
+                      node i at 2 * i and 2 * i + 1
+            value: array (n_nodes,), the leaf values, 0 for the internal nodes
+            n_features: int (optional)
+            objective: string (optional), LightGBM's objective
+            average_output: bool (optional), True for random forests
+        """
+        self.roots = np.asarray(roots, dtype = np.intp)
+        self.split_feature = np.asarray(split_feature, dtype = np.intp)
+        self.threshold = np.asarray(threshold, dtype = float)
+        self.default_left = np.asarray(default_left, dtype = bool)
+        self.missing_type = np.asarray(missing_type, dtype = np.int8)
+        self.children = np.asarray(children, dtype = np.intp)
+        self.value = np.asarray(value, dtype = float)
+        self.n_features = n_features
+        self.objective = objective
+        self.average_output = bool(average_output)
+
+        # The depth of the deepest tree, the number of traversal steps.
+        is_leaf = self.children[0::2] == np.arange(len(self.value))
+        level, self.depth = self.roots, 0
+        while (~is_leaf[level]).any():
+            level = level[~is_leaf[level]]
+            level = np.concatenate([self.children[2 * level], self.children[2 * level + 1]])
+            self.depth += 1
+        self.has_zero_missing = bool((self.missing_type == 1).any())
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    # Persistence.
+    def save(self, path):
+        """
+        Save the node arrays to a single .npz file.
+        Inputs
+            path: string
+        """
+        np.savez(path, n_features = -1 if self.n_features is None else self.n_features,
+                 objective = self.objective, average_output = self.average_output,
+                 **{name: getattr(self, name) for name in ARRAYS})
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a predictor saved with save().
+        Inputs
+            path: string
+        Outputs
+            predictor: TreePredictor
+        """
+        with np.load(path) as f:
+            arrays = {name: f[name] for name in ARRAYS}
+            n_features = int(f["n_features"])
+            return cls(n_features = None if n_features < 0 else n_features,
+                       objective = str(f["objective"]),
+                       average_output = bool(f["average_output"]),
+                       **arrays)
+
+    # Prediction.
+    def _go_left(self, x, nodes):
+        # LightGBM's numerical decision: NaN counts as 0 unless the missing
+        # type is NaN, and missing values follow the default direction.
+        missing_type = self.missing_type[nodes]
+        is_nan = np.isnan(x)
+        x = np.where(is_nan & (missing_type != 2), 0.0, x)
+        missing = np.where(missing_type == 2, is_nan,
+                           (missing_type == 1) & (np.abs(x) <= ZERO_THRESHOLD))
+        return np.where(missing, self.default_left[nodes], x <= self.threshold[nodes])
+
+    def predict_nodes(self, X):
+        """
+        The leaf node reached by every row in every tree.
+        Inputs
+            X: array (n_samples, n_features) or (n_features,)
+        Outputs
+            nodes: array of int (n_samples, n_trees)
+        """
+        X = np.atleast_2d(np.asarray(X, dtype = float))
+        if self.n_features is not None and X.shape[1] != self.n_features:
+            raise ValueError("Expected {} features, got {}.".format(self.n_features, X.shape[1]))
+        n_samples, n_features = X.shape
+        X_flat = X.ravel()
+        offsets = (np.arange(n_samples) * n_features)[:, None]
+
+        # Without missing values a split is a plain comparison.
+        missing = np.isnan(X_flat).any() or (self.has_zero_missing and
+                                             (np.abs(X_flat) <= ZERO_THRESHOLD).any())
+        nodes = np.broadcast_to(self.roots, (n_samples, self.n_trees))
+        for level in range(self.depth):
+            x = X_flat[self.split_feature[nodes] + offsets]
+            if missing == True:
+                go_right = ~self._go_left(x, nodes)
+            else:
+                go_right = x > self.threshold[nodes]
+            nodes = self.children[2 * nodes + go_right]
+        return nodes
+
+    def predict(self, X, raw_score = False):
+        """
+        Predict like lgb.Booster.predict().
+        Inputs
+            X: array (n_samples, n_features) or (n_features,)
+            raw_score: bool (optional), skip the output transformation of the
+                       objective, e.g. the exp() of poisson regression
+        Outputs
+            y: array (n_samples,)
+        """
+        y = self.value[self.predict_nodes(X)].sum(axis = 1)
+        if self.average_output == True:
+            y = y / self.n_trees
+        if raw_score == False and self.objective.split(" ")[0] in ["poisson", "gamma", "tweedie"]:
+            y = np.exp(y)
+        return y
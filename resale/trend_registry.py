@@ -0,0 +1,296 @@
+# Compact storage for the temporal trend models fitted in adjust_price.py.
+
+# Instead of keeping copies of the training data d, the kernel G and the model
+# for every location, the registry keeps only the coefficient arrays, the basis
+# metadata, N and R2 in contiguous arrays indexed by location. Each array is
+# saved as its own .npy file so that they can be memory-mapped on load.
+
+# Least squares models also keep the normal equations of each location, so 
+# that new months of data can be added with recursive least squares updates.
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Relative imports.
+from . import linear_regression
+
+# Fixed constants for the files in a saved registry directory.
+ARRAYS = ["locations", "model", "r2", "N"]
+STATISTICS = ["A", "b", "P", "dd", "sd", "sw"]
+# Per-location diagnostics which only some models have: the chosen order and
+# its cross validation score, or the convergence report of the IRLS models.
+OPTIONAL_ARRAYS = ["order", "cv_score", "n_iter", "converged"]
+METADATA_FILE = "metadata.json"
+
+class TrendModelRegistry:
+    """
+    Temporal trend models for many locations. Behaves like the old temporal_models
+    dict, i.e. registry[location]["model"], but the diagnostics (G, d, r2, N)
+    are only reconstructed when a location is looked up.
+    """
+    def __init__(self, locations, model, r2, N, basis = "legendre", domain = None,
+                 vander_order = 4, start_year_month = None, which = "town",
+                 price_column = "resale_price", model_name = "least_squares",
+                 statistics = None, last_month = None, **optional_arrays):
+        """
+        Inputs
+            locations: array of string, sorted
+            model: array (n_locations, vander_order)
+            r2, N: array (n_locations,)
+            basis: string (optional)
+            domain: tuple (optional)
+            vander_order: int (optional)
+            start_year_month: datetime (optional)
+            which, price_column, model_name: string (optional)
+            statistics: dict (optional)
+            last_month: int (optional), the last month fitted, defaults to
+                        the end of the domain
+            optional_arrays: arrays (n_locations,) named in OPTIONAL_ARRAYS (optional)
+        """
+        self.locations = locations
+        self.model = model
+        self.r2 = r2
+        self.N = N
+        self.basis = basis
+        self.domain = domain
+        self.vander_order = vander_order
+        self.start_year_month = start_year_month
+        self.which = which
+        self.price_column = price_column
+        self.model_name = model_name
+        self.statistics = statistics
+        if last_month is None and domain is not None:
+            last_month = int(domain[1])
+        self.last_month = last_month
+        for name in OPTIONAL_ARRAYS:
+            setattr(self, name, optional_arrays.get(name, None))
+
+        # Training data is never saved, but may be attached for diagnostics.
+        self.median_prices = None
+        # The hash index of the locations, built on the first look up.
+        self._location_index = None
+
+    @classmethod
+    def from_fits(cls, fits, which = "town", price_column = "resale_price"):
+        """
+        Create a registry from the output of adjust_price.build_price_adjustment_models().
+        Inputs
+            fits: dict
+            which, price_column: string (optional)
+        Outputs
+            registry: TrendModelRegistry
+        """
+        # A global model has the single location None, stored as "". Numeric
+        # locations keep their type, so that they are looked up by value.
+        locations = np.asarray(fits["locations"])
+        if locations.dtype == object:
+            locations = np.array(["" if l is None else str(l) for l in locations])
+        return cls(locations = locations,
+                   model = np.ascontiguousarray(fits["model"], dtype = float),
+                   r2 = np.asarray(fits["r2"], dtype = float),
+                   N = np.asarray(fits["N"], dtype = int),
+                   basis = fits["basis"],
+                   domain = tuple(int(x) for x in fits["domain"]),
+                   vander_order = fits["vander_order"],
+                   start_year_month = pd.Timestamp(fits["start_year_month"]),
+                   which = which,
+                   price_column = price_column,
+                   model_name = fits.get("model_name", "least_squares"),
+                   statistics = fits.get("statistics", None),
+                   **{name: np.asarray(fits[name]) for name in OPTIONAL_ARRAYS if name in fits})
+
+    # Persistence.
+    def save(self, path):
+        """
+        Save the registry to a directory of .npy files and a json metadata file.
+        Inputs
+            path: string
+        """
+        os.makedirs(path, exist_ok = True)
+        for name in ARRAYS:
+            np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+        for name in OPTIONAL_ARRAYS:
+            if getattr(self, name) is not None:
+                np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+        if self.statistics is not None:
+            for name in STATISTICS:
+                np.save(os.path.join(path, name + ".npy"), self.statistics[name])
+
+        metadata = {"basis": self.basis,
+                    "domain": list(self.domain),
+                    "vander_order": int(self.vander_order),
+                    "start_year_month": str(self.start_year_month.date()),
+                    "which": self.which,
+                    "price_column": self.price_column,
+                    "model_name": self.model_name,
+                    "last_month": self.last_month}
+        with open(os.path.join(path, METADATA_FILE), "w") as fp:
+            json.dump(metadata, fp)
+
+    @classmethod
+    def load(cls, path, mmap_mode = "r"):
+        """
+        Load a registry saved with save(). By default the arrays are memory-mapped
+        and only read from disk when used.
+        Inputs
+            path: string
+            mmap_mode: string (optional)
+        Outputs
+            registry: TrendModelRegistry
+        """
+        with open(os.path.join(path, METADATA_FILE)) as fp:
+            metadata = json.load(fp)
+
+        arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode = mmap_mode)
+                  for name in ARRAYS}
+        for name in OPTIONAL_ARRAYS:
+            if os.path.exists(os.path.join(path, name + ".npy")):
+                arrays[name] = np.load(os.path.join(path, name + ".npy"), mmap_mode = mmap_mode)
+        if os.path.exists(os.path.join(path, STATISTICS[0] + ".npy")):
+            arrays["statistics"] = {name: np.load(os.path.join(path, name + ".npy"), 
+                                                  mmap_mode = mmap_mode)
+                                    for name in STATISTICS}
+        metadata["domain"] = tuple(metadata["domain"])
+        metadata["start_year_month"] = pd.Timestamp(metadata["start_year_month"])
+        return cls(**arrays, **metadata)
+
+    # Look ups.
+    def location_codes(self, locations):
+        """
+        Vectorized look up of the row index of each location. Unknown locations
+        get the index -1.
+        Inputs
+            locations: array
+        Outputs
+            codes: array of int
+        """
+        if self._location_index is None:
+            self._location_index = pd.Index(np.asarray(self.locations))
+        return self._location_index.get_indexer(np.asarray(locations))
+
+    def predict(self, codes, months):
+        """
+        Evaluate the trend models at the given months. Unknown locations with
+        the index -1 evaluate to NaN.
+        Inputs
+            codes: array of int, row indices from location_codes()
+            months: array of int, month counts from the start_year_month
+        Outputs
+            values: array
+        """
+        codes = np.asarray(codes)
+        G = linear_regression.make_basis(np.broadcast_to(months, codes.shape).ravel(),
+                                         self.vander_order, self.basis, self.domain)
+        values = np.einsum("np,np->n", G, self.model[codes.ravel()])
+        values[codes.ravel() < 0] = np.nan
+        return values.reshape(codes.shape)
+
+    def update(self, median_prices, forgetting = 1.0):
+        """
+        Add new months of median prices to the least squares models with 
+        recursive least squares, month by month. The basis domain is kept 
+        fixed, so the new months are extrapolated from the original domain.
+        Locations not already in the registry, and months at or before the
+        last month already fitted, are skipped.
+        Inputs
+            median_prices: DataFrame, in the format of statistics.get_monthly_median_price()
+            forgetting: float (optional), the decay of the old data per month
+        """
+        if self.statistics is None:
+            raise ValueError("Only least squares models with statistics can be updated.")
+        
+        # Memory-mapped arrays are read only, so take copies before updating.
+        self.model = np.array(self.model)
+        self.N = np.array(self.N)
+        self.statistics = {k: np.array(v) for k, v in self.statistics.items()}
+        
+        if self.which is None:
+            codes = np.zeros(len(median_prices), dtype = int)
+        else:
+            codes = self.location_codes(median_prices[self.which].values)
+        if (codes < 0).any():
+            print("Skipping {} rows with unknown locations.".format((codes < 0).sum()))
+        
+        months = linear_regression.months_to_G(median_prices["year_month"], self.start_year_month)
+        prices = median_prices[self.price_column].values.astype(float)
+        known = codes >= 0
+        # Months already fitted would be counted twice.
+        fitted = known & (months <= self.last_month)
+        if fitted.any():
+            print("Skipping {} rows of months already fitted.".format(fitted.sum()))
+            known = known & ~fitted
+        for month in np.unique(months[known]):
+            rows = known & (months == month)
+            g = linear_regression.make_basis(np.full(rows.sum(), month), self.vander_order,
+                                             self.basis, self.domain)
+            linear_regression.batch_rls_update(self.model, self.statistics, codes[rows], g, 
+                                               prices[rows], forgetting)
+            self.N[codes[rows]] += 1
+            self.last_month = int(month)
+        
+        self.r2 = linear_regression.r2_from_statistics(self.model, self.statistics)
+        if self.median_prices is not None:
+            self.median_prices = pd.concat([self.median_prices, median_prices], 
+                                           ignore_index = True)
+
+    def attach_data(self, median_prices):
+        """
+        Attach the monthly median prices used for training, so that the data d
+        can be reconstructed in the diagnostics.
+        Inputs
+            median_prices: DataFrame
+        """
+        self.median_prices = median_prices
+
+    def diagnostics(self, location):
+        """
+        Reconstruct the old temporal_models[location] entry for one location.
+        Inputs
+            location: string
+        Outputs
+            diagnostics: dict
+        """
+        if location is None:
+            location = ""
+        i = self.location_codes([location])[0]
+        if i < 0:
+            raise KeyError(location)
+
+        diagnostics = {"model": np.array(self.model[i]),
+                       "r2": float(self.r2[i]),
+                       "N": int(self.N[i])}
+        for name in OPTIONAL_ARRAYS:
+            if getattr(self, name) is not None:
+                diagnostics[name] = getattr(self, name)[i].item()
+
+        if self.median_prices is not None:
+            if self.which is None or location in ("", None):
+                d = self.median_prices
+            else:
+                d = self.median_prices[self.median_prices[self.which] == location]
+            months = linear_regression.months_to_G(d["year_month"], self.start_year_month)
+            diagnostics["d"] = d.assign(months = months)
+        else:
+            months = np.arange(self.domain[0], self.last_month + 1)
+        diagnostics["G"] = linear_regression.make_basis(months, self.vander_order,
+                                                        self.basis, self.domain)
+        return diagnostics
+
+    # Dict-like interface for compatibility with the old temporal_models dict.
+    def __getitem__(self, location):
+        return self.diagnostics(location)
+
+    def __contains__(self, location):
+        return self.location_codes([location])[0] >= 0
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.locations)
+
+    def keys(self):
+        return [str(l) for l in self.locations]
@@ -0,0 +1,26 @@
+import numpy as np
+
+from resale import adjust_price
+from resale import benchmark
+
+def test_build_price_adjustment_models_bases():
+    median_prices = benchmark.make_synthetic_median_prices(5, 36, random_state = 0)
+    start_year_month = median_prices["year_month"].min()
+    fits = {basis: adjust_price.build_price_adjustment_models(median_prices, "resale_price",
+                                                              start_year_month, "town", 4,
+                                                              basis = basis)
+            for basis in ["vander", "legendre"]}
+    assert fits["vander"]["basis"] == "vander"
+    assert fits["legendre"]["basis"] == "legendre"
+    assert not np.allclose(fits["vander"]["model"], fits["legendre"]["model"])
+
+def test_benchmark_trend_fitting_bases(monkeypatch):
+    bases = []
+    build = adjust_price.build_price_adjustment_models
+    def recording_build(*args, **kwargs):
+        fits = build(*args, **kwargs)
+        bases.append(fits["basis"])
+        return fits
+    monkeypatch.setattr(adjust_price, "build_price_adjustment_models", recording_build)
+    benchmark.benchmark_trend_fitting(n_locations = 3, n_months = 24, verbose = False)
+    assert bases == list(benchmark.linear_regression.BASES)
@@ -0,0 +1,20 @@
+import h3
+import numpy as np
+import pandas as pd
+
+from resale import h3_statistics
+
+def test_k_ring_median_price_missing_cell():
+    cell = h3.geo_to_h3(1.35, 103.8, 8)
+    cells = [cell] + sorted(h3.k_ring(cell, 1) - {cell})[:2]
+    df = pd.DataFrame({"year_month": pd.to_datetime(["2020-01-01", "2020-01-01", "2020-02-01",
+                                                     "2020-02-01", "2020-01-01"]),
+                       "resale_price": [1.0, 3.0, 5.0, 7.0, 100.0],
+                       "h3": cells + [cells[0], np.nan]})
+    for n_jobs in [1, 2]:
+        median_price = h3_statistics.get_all_k_ring_monthly_median_price(df, n_jobs = n_jobs)
+        assert set(median_price["h3"]) == set(cells)
+        # The row without a cell is not counted in any k-ring.
+        first = median_price[median_price["h3"] == cell]
+        assert first["resale_price"].tolist() == [2.0, 6.0]
+        assert (first["N"] == 4).all()
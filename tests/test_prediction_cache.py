@@ -0,0 +1,22 @@
+import numpy as np
+
+from resale import prediction_cache
+
+def test_shared_namespaces(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    X = np.arange(20, dtype = float).reshape(10, 2)
+    a = prediction_cache.PredictionCache(max_size = 5, version = "a1", shared_path = path,
+                                         namespace = "a")
+    b = prediction_cache.PredictionCache(version = "b1", shared_path = path, namespace = "b")
+    a.predict(lambda X: X[:, 0], X)
+    b.predict(lambda X: X[:, 1], X)
+    a.set_version("a2")
+
+    other = prediction_cache.PredictionCache(version = "b1", shared_path = path,
+                                             namespace = "b")
+    values, found = other.get(other.keys(X))
+    assert found.all()
+    np.testing.assert_array_equal(values, X[:, 1])
+    counts = dict(b.connection.execute("SELECT namespace, COUNT(*) FROM predictions "
+                                       "GROUP BY namespace").fetchall())
+    assert counts == {"b": 10}
@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+
+from resale import adjust_price
+from resale import benchmark
+from resale import time_machine
+from resale import trend_registry
+
+def test_time_machine_after_update():
+    median_prices = benchmark.make_synthetic_median_prices(4, 25, missing_fraction = 0,
+                                                           random_state = 0)
+    last_year_month = median_prices["year_month"].max()
+    history = median_prices[median_prices["year_month"] < last_year_month]
+    start_year_month = history["year_month"].min()
+    fits = adjust_price.build_price_adjustment_models(history, "resale_price",
+                                                      start_year_month, "town", 4)
+    registry = trend_registry.TrendModelRegistry.from_fits(fits)
+    registry.update(median_prices[median_prices["year_month"] == last_year_month])
+    assert registry.last_month == registry.domain[1] + 1
+
+    tm = time_machine.PriceTimeMachine(registry)
+    assert tm.last_month == registry.last_month
+    locations = registry.locations
+    factors = tm.factors(locations, start_year_month, last_year_month)
+    assert np.isfinite(factors).all()
+    # The default target is the month added by the update.
+    np.testing.assert_allclose(tm.factors(locations, start_year_month), factors)
+    assert np.isnan(tm.factors(locations, last_year_month + pd.DateOffset(months = 1))).all()
@@ -0,0 +1,15 @@
+from resale import adjust_price
+from resale import benchmark
+from resale import trend_registry
+
+def test_diagnostics_after_update():
+    median_prices = benchmark.make_synthetic_median_prices(3, 25, missing_fraction = 0,
+                                                           random_state = 0)
+    last_year_month = median_prices["year_month"].max()
+    history = median_prices[median_prices["year_month"] < last_year_month]
+    fits = adjust_price.build_price_adjustment_models(history, "resale_price",
+                                                      history["year_month"].min(), "town", 4)
+    registry = trend_registry.TrendModelRegistry.from_fits(fits)
+    registry.update(median_prices[median_prices["year_month"] == last_year_month])
+    location = registry.keys()[0]
+    assert len(registry[location]["G"]) == registry.last_month - registry.domain[0] + 1